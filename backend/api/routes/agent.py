@@ -2,34 +2,36 @@
 Agent API Route - 智能问答接口
 集成 rag single 中的 Agent 系统，提供多步推理能力
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import sys
 import json
 import asyncio
+import threading
 from pathlib import Path
 import os
 from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
 
 router = APIRouter()
 
 # 加载环境变量
 load_dotenv()
 
-# 添加 rag single 到路径
-rag_path = Path(__file__).parent.parent.parent.parent / "rag single"
-sys.path.insert(0, str(rag_path))
+# 添加 rag single 到路径（services.knowledge 导入时完成）
+from services.knowledge import get_kb
+from services.agent_streams import coalesce, get_stream_registry, sse_events
+from services.conversation_history import ConversationHistory
 
 # 延迟导入，确保路径已添加
 try:
-    from knowledge_base.kb import KnowledgeBase
     from agent import Agent
+    from knowledge_base.answer_cache import SemanticAnswerCache
 except ImportError as e:
     print(f"⚠️ Warning: Could not import Agent module: {e}")
     Agent = None
-    KnowledgeBase = None
 
 
 class AgentRequest(BaseModel):
@@ -43,55 +45,84 @@ class AgentResponse(BaseModel):
     data: Dict[str, Any]
 
 
+def _answer_cache_from_env():
+    """
+    AGENT_CACHE_SIZE: 答案缓存条目数（0 关闭）
+    AGENT_CACHE_THRESHOLD: 问题向量的余弦相似度阈值
+    AGENT_CACHE_TTL_S: 条目有效期（秒，0 表示不过期）
+    """
+    size = int(os.getenv("AGENT_CACHE_SIZE", 1000))
+    if size <= 0:
+        return None
+    return SemanticAnswerCache(
+        threshold=float(os.getenv("AGENT_CACHE_THRESHOLD", 0.95)),
+        maxsize=size,
+        ttl=float(os.getenv("AGENT_CACHE_TTL_S", 3600)) or None
+    )
+
+
 # 全局 Agent 实例（懒加载）
 _agent_instance = None
+_agent_lock = threading.Lock()
+# 对话历史管理：滚动摘要用 Agent 的 LLM 生成，缓存在进程内
+_history_instance = None
 
 
 def get_agent():
-    """获取或创建 Agent 实例"""
-    global _agent_instance
+    """获取或创建 Agent 实例（首次创建会加载模型和索引，接口中通过线程池调用，不阻塞事件循环）"""
+    global _agent_instance, _history_instance
     
-    if _agent_instance is None:
-        if Agent is None or KnowledgeBase is None:
-            raise HTTPException(
-                status_code=500, 
-                detail="Agent module not loaded correctly, please check rag single directory"
-            )
-        
-        # 初始化知识库
-        kb_dir = rag_path / "knowledge_base"
-        kb = KnowledgeBase(str(kb_dir), use_english=True)
-        
-        # 获取 LLM 配置
-        api_key = os.getenv("DASHSCOPE_API_KEY") or os.getenv("OPENAI_API_KEY")
-        model_name = os.getenv("LLM_MODEL", "qwen-max")
-        base_url = os.getenv("LLM_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
-        
-        if not api_key:
-            raise HTTPException(
-                status_code=500,
-                detail="API Key not configured, please set DASHSCOPE_API_KEY or OPENAI_API_KEY in .env file"
-            )
-        
-        # 创建 Agent 实例
-        try:
-            _agent_instance = Agent(
-                knowledge_base=kb,
-                model_name=model_name,
-                api_key=api_key,
-                base_url=base_url
-            )
-                
-            print(f"✅ Agent initialized successfully (Model: {model_name})")
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Agent initialization failed: {str(e)}"
-            )
+    with _agent_lock:
+        if _agent_instance is None:
+            if Agent is None:
+                raise HTTPException(
+                    status_code=500, 
+                    detail="Agent module not loaded correctly, please check rag single directory"
+                )
+            
+            # 使用与上传 / 搜索路由共享的知识库，上传后立即可被 Agent 检索
+            kb = get_kb()
+            
+            # 获取 LLM 配置
+            api_key = os.getenv("DASHSCOPE_API_KEY") or os.getenv("OPENAI_API_KEY")
+            model_name = os.getenv("LLM_MODEL", "qwen-max")
+            base_url = os.getenv("LLM_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
+            
+            if not api_key:
+                raise HTTPException(
+                    status_code=500,
+                    detail="API Key not configured, please set DASHSCOPE_API_KEY or OPENAI_API_KEY in .env file"
+                )
+            
+            # 创建 Agent 实例
+            try:
+                _agent_instance = Agent(
+                    knowledge_base=kb,
+                    model_name=model_name,
+                    api_key=api_key,
+                    base_url=base_url,
+                    # 检索线程池大小：并发对话的检索在这里排队，LLM 调用不占线程
+                    retrieval_workers=int(os.getenv("AGENT_RETRIEVAL_WORKERS", 4)),
+                    answer_cache=_answer_cache_from_env()
+                )
+                    
+                # 加载 tokenizer 可能需要下载编码表，同样放在线程池中完成
+                _history_instance = ConversationHistory(_agent_instance.asummarize_history)
+                print(f"✅ Agent initialized successfully (Model: {model_name})")
+            except Exception as e:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Agent initialization failed: {str(e)}"
+                )
     
     return _agent_instance
 
 
+async def _full_input(request: AgentRequest) -> str:
+    """构建完整的输入：最近几轮对话原样保留，更早的合并为摘要，总长度不超过 HISTORY_TOKEN_BUDGET（在 get_agent 之后调用）"""
+    return await _history_instance.build_input(request.query, request.context)
+
+
 @router.post("/agent/chat", response_model=AgentResponse)
 async def agent_chat(request: AgentRequest):
     """
@@ -104,19 +135,13 @@ async def agent_chat(request: AgentRequest):
         Agent 的推理结果和答案
     """
     try:
-        agent = get_agent()
+        agent = await run_in_threadpool(get_agent)
         
-        # 构建完整的输入（包含上下文）
-        full_input = request.query
-        if request.context:
-            context_str = "\n".join([
-                f"Q: {item.get('question', '')}\nA: {item.get('answer', '')}"
-                for item in request.context
-            ])
-            full_input = f"Conversation History:\n{context_str}\n\nCurrent Question: {request.query}"
+        full_input = await _full_input(request)
         
-        # 调用 Agent
-        result = agent.run(full_input)
+        # 调用 Agent（异步执行，等待 LLM / 检索期间事件循环可以处理其他请求）
+        # 带对话历史的问题依赖上下文，不使用答案缓存
+        result = await agent.arun(full_input, use_cache=not request.context)
         
         # 格式化返回结果
         if isinstance(result, dict):
@@ -137,7 +162,8 @@ async def agent_chat(request: AgentRequest):
                 message="Agent execution successful",
                 data={
                     "answer": result.get("output", ""),
-                    "reasoning": reasoning_steps
+                    "reasoning": reasoning_steps,
+                    "cached": result.get("cached", False)
                 }
             )
         else:
@@ -167,20 +193,14 @@ async def agent_chat_stream(request: AgentRequest):
     """
     流式智能问答接口 - 实时返回 Agent 的思考步骤
     """
-    agent = get_agent()
+    agent = await run_in_threadpool(get_agent)
     
-    # 构建完整的输入
-    full_input = request.query
-    if request.context:
-        context_str = "\n".join([
-            f"Q: {item.get('question', '')}\nA: {item.get('answer', '')}"
-            for item in request.context
-        ])
-        full_input = f"Conversation History:\n{context_str}\n\nCurrent Question: {request.query}"
+    full_input = await _full_input(request)
 
     async def event_generator():
         try:
-            async for event in agent.run_stream(full_input):
+            # 连续的 token 合并成帧发送，前端按类型拼接内容，帧的粒度不影响显示
+            async for event in coalesce(agent.run_stream(full_input, use_cache=not request.context)):
                 # 将事件转换为 JSON 字符串并添加换行符，方便前端解析
                 yield json.dumps(event, ensure_ascii=False) + "\n"
         except Exception as e:
@@ -191,11 +211,46 @@ async def agent_chat_stream(request: AgentRequest):
     return StreamingResponse(event_generator(), media_type="application/x-ndjson")
 
 
+_SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+@router.post("/agent/chat_sse")
+async def agent_chat_sse(request: AgentRequest):
+    """
+    SSE 流式问答 - Agent 在后台运行，事件带递增 id；
+    第一个事件 {"type": "stream", "streamId": ...} 给出流 id，断线后通过
+    GET /agent/chat_sse/{stream_id}（Last-Event-ID）从断点继续
+    """
+    agent = await run_in_threadpool(get_agent)
+    full_input = await _full_input(request)
+    stream = get_stream_registry().start(
+        coalesce(agent.run_stream(full_input, use_cache=not request.context))
+    )
+    return StreamingResponse(sse_events(stream), media_type="text/event-stream",
+                             headers=dict(_SSE_HEADERS, **{"X-Stream-Id": stream.id}))
+
+
+@router.get("/agent/chat_sse/{stream_id}")
+async def agent_chat_sse_resume(stream_id: str, last_event_id: Optional[int] = None,
+                                last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID")):
+    """重连 SSE 流：返回 Last-Event-ID（或 ?last_event_id=）之后的事件，流未结束时继续推送"""
+    stream = get_stream_registry().get(stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    if last_event_id is None:
+        try:
+            last_event_id = int(last_event_id_header or 0)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    return StreamingResponse(sse_events(stream, last_event_id), media_type="text/event-stream",
+                             headers=_SSE_HEADERS)
+
+
 @router.get("/agent/status")
 async def agent_status():
     """检查 Agent 服务状态"""
     try:
-        agent = get_agent()
+        agent = await run_in_threadpool(get_agent)
         return {
             "status": "healthy",
             "message": "Agent service running normally",
@@ -0,0 +1,23 @@
+"""
+Ingest Jobs API Route - 查询后台索引任务状态
+"""
+from fastapi import APIRouter, HTTPException
+
+from services.ingest_queue import get_ingest_queue
+
+router = APIRouter()
+
+
+@router.get("/jobs")
+async def list_jobs():
+    """最近的索引任务（新任务在前）"""
+    return {"status": "success", "data": get_ingest_queue().list()}
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查询单个索引任务的阶段、进度和 chunk 数量"""
+    job = get_ingest_queue().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"status": "success", "data": job}
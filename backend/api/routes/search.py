@@ -3,45 +3,84 @@ Search API Route - 简化版
 """
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-import sys
-from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional
+from starlette.concurrency import run_in_threadpool
+import os
+
+from services.knowledge import get_kb
 
 router = APIRouter()
 
-# 添加 rag single 到路径
-rag_path = Path(__file__).parent.parent.parent.parent / "rag single"
-sys.path.insert(0, str(rag_path))
+
+# dense：纯向量检索；hybrid：向量 + BM25 倒排索引，RRF 融合
+SearchMode = Literal["dense", "hybrid"]
 
 
 class SearchRequest(BaseModel):
     query: str
+    mode: SearchMode = "dense"
+    # 元数据过滤，如 {"source": "paper.pdf", "page_no": {"$gte": 2, "$lte": 5}}
+    filter: Optional[Dict[str, Any]] = None
+    # 是否用 CrossEncoder 重排序及延迟预算（毫秒）；不传时使用本接口的默认配置
+    rerank: Optional[bool] = None
+    rerank_budget_ms: Optional[float] = None
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[str]
+    k: int = 5
+    mode: SearchMode = "dense"
+    filter: Optional[Dict[str, Any]] = None
+    rerank: Optional[bool] = None
+    rerank_budget_ms: Optional[float] = None
+
+
+# 与单条搜索一致的分数阈值
+SCORE_THRESHOLD = 1.2
+
+# 搜索接口的重排序默认配置（与智能体使用的 KB_RERANK* 相互独立）
+SEARCH_RERANK = os.getenv("SEARCH_RERANK", "").lower() in ("1", "true", "yes", "on")
+SEARCH_RERANK_BUDGET_MS = float(os.getenv("SEARCH_RERANK_BUDGET_MS", 0)) or None
+
+
+def _search_kwargs(request) -> Dict[str, Any]:
+    return {
+        "mode": request.mode,
+        "filter": request.filter,
+        "rerank": SEARCH_RERANK if request.rerank is None else request.rerank,
+        "rerank_budget_ms": request.rerank_budget_ms or SEARCH_RERANK_BUDGET_MS,
+    }
+
+
+def _format_result(res: Dict[str, Any]) -> Dict[str, Any]:
+    item = {
+        "section": res["metadata"].get("title") or res["metadata"].get("source", "Unknown Document"),
+        "content": res["text"],
+        "score": float(res["score"]),
+        "source": res["metadata"].get("source", "Unknown Source")
+    }
+    if res.get("rerank_score") is not None:
+        item["rerankScore"] = res["rerank_score"]
+    return item
 
 
 @router.post("/search")
 async def search_documents(request: SearchRequest):
     """使用 rag single 的知识库搜索"""
     try:
-        from knowledge_base.kb import KnowledgeBase
-        
-        # 初始化知识库
-        kb_dir = rag_path / "knowledge_base"
-        kb = KnowledgeBase(str(kb_dir), use_english=True)
+        # 使用进程内共享的知识库，避免每次请求重新加载模型和索引
+        kb = await run_in_threadpool(get_kb)
         
-        # 搜索
-        # 修改 kb.retrieve 以返回原始结果或更易解析的格式
-        # 这里我们直接调用 vector_store 进行搜索以获取更多元数据
+        # 搜索（返回带元数据的原始结果，按需重排序）
         if kb.vector_store:
-            results_with_scores = kb.vector_store.similarity_search_with_score(request.query, k=5)
+            results = await run_in_threadpool(
+                lambda: kb.search(request.query, 5, **_search_kwargs(request))
+            )
             
-            formatted_results = []
-            for doc, score in results_with_scores:
-                if score < 1.2: # 稍微放宽一点阈值
-                    formatted_results.append({
-                        "section": doc.metadata.get("title", "Unknown Document"),
-                        "content": doc.page_content,
-                        "score": float(score),
-                        "source": doc.metadata.get("source", "Unknown Source")
-                    })
+            formatted_results = [
+                _format_result(res) for res in results
+                if res["score"] < SCORE_THRESHOLD  # 稍微放宽一点阈值
+            ]
             
             return {
                 "status": "success",
@@ -55,6 +94,9 @@ async def search_documents(request: SearchRequest):
             "data": []
         }
         
+    except ValueError as e:
+        # 非法的检索模式或过滤条件
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -66,3 +108,37 @@ async def search_documents(request: SearchRequest):
             "message": f"Search failed: {str(e)}",
             "data": []
         }
+
+
+@router.post("/search/batch")
+async def search_documents_batch(request: BatchSearchRequest):
+    """批量搜索：N 个查询只做一次编码和一次向量检索"""
+    try:
+        kb = await run_in_threadpool(get_kb)
+        if not kb.vector_store:
+            return {"status": "success", "message": "Knowledge base not loaded", "data": []}
+
+        all_results = await run_in_threadpool(
+            lambda: kb.search_many(request.queries, request.k, **_search_kwargs(request))
+        )
+
+        data = []
+        for query, results in zip(request.queries, all_results):
+            data.append({
+                "query": query,
+                "results": [_format_result(res) for res in results if res["score"] < SCORE_THRESHOLD]
+            })
+
+        return {
+            "status": "success",
+            "message": f"Searched {len(data)} queries",
+            "data": data
+        }
+
+    except ValueError as e:
+        # 非法的检索模式或过滤条件
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
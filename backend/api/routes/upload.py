@@ -1,56 +1,145 @@
 """
-File Upload API Route - 上传并索引到知识库
+File Upload API Route - 上传并提交后台索引任务
 """
 from fastapi import APIRouter, UploadFile, File, HTTPException
 import os
 import hashlib
-import shutil
-import sys
+import json
+import uuid
 from pathlib import Path
 from starlette.concurrency import run_in_threadpool
 
-router = APIRouter()
-
-# 添加 rag single 路径到 Python path
-RAG_DIR = Path(__file__).parent.parent.parent.parent / "rag single"
-if str(RAG_DIR) not in sys.path:
-    sys.path.insert(0, str(RAG_DIR))
+from services.knowledge import RAG_DIR, get_kb
+from services.ingest_queue import get_ingest_queue
+from services.upload_index import UploadHashIndex
 
-# 延迟导入，确保路径已添加
-from knowledge_base.kb import KnowledgeBase  # type: ignore
+router = APIRouter()
 
 # 创建上传目录 - 放在 rag single 目录下
 UPLOAD_DIR = RAG_DIR / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True)
 
-# 初始化知识库
-kb = KnowledgeBase(kb_dir=str(RAG_DIR / "knowledge_base"), use_english=True)
+# 上传中的临时文件目录（与 UPLOAD_DIR 同一文件系统，保证 os.replace 是原子重命名）
+UPLOAD_TMP_DIR = RAG_DIR / "uploads_tmp"
+UPLOAD_TMP_DIR.mkdir(exist_ok=True)
+
+# 流式读取上传内容的块大小，以及单个文件的大小上限（MB）
+UPLOAD_BLOCK_SIZE = int(os.getenv("UPLOAD_BLOCK_SIZE", 1024 * 1024))
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", 200)) * 1024 * 1024)
+
+# 内容哈希索引（放在上传目录之外，避免被静态目录和文档列表暴露）
+hash_index = UploadHashIndex(RAG_DIR / "uploads_index.sqlite", UPLOAD_DIR)
+
+
+# 请求体上限：multipart 包装开销很小，留一个块的余量
+MAX_REQUEST_BYTES = MAX_UPLOAD_BYTES + UPLOAD_BLOCK_SIZE
+
+
+def exceeds_upload_limit(content_length: str) -> bool:
+    """请求声明的长度是否已超限"""
+    return content_length.isdigit() and int(content_length) > MAX_REQUEST_BYTES
+
+
+def _too_large() -> HTTPException:
+    return HTTPException(status_code=413,
+                         detail=f"File too large, limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+
+
+class UploadSizeLimit:
+    """
+    ASGI 中间件（main.py 注册）：限制上传接口的请求体大小。
+    声明的 Content-Length 超限时在读取请求体之前直接返回 413；没有 Content-Length 的
+    分块传输在接收时计数，超限立即中止，multipart 解析器不会先把整个请求体写入磁盘。
+    """
+
+    def __init__(self, app, path: str = "/api/upload"):
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        if exceeds_upload_limit(headers.get(b"content-length", b"").decode("latin-1")):
+            await self._reject(send)
+            return
+
+        received = 0
+        started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_REQUEST_BYTES:
+                    # 在路由内读取请求体时抛出，由 FastAPI 的异常处理返回 413
+                    raise _too_large()
+            return message
+
+        async def tracked_send(message):
+            nonlocal started
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except HTTPException as e:
+            # 请求体在路由之外被读取（异常未被处理）时，在这里返回 413
+            if e.status_code != 413 or started:
+                raise
+            await self._reject(send)
+
+    @staticmethod
+    async def _reject(send):
+        error = _too_large()
+        body = json.dumps({"detail": error.detail}).encode("utf-8")
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode("latin-1"))]})
+        await send({"type": "http.response.body", "body": body})
+
+
+async def _receive_to_temp(file: UploadFile):
+    """按固定块大小把上传内容写入临时文件并增量计算 sha256，内存占用与文件大小无关。
+    超过 MAX_UPLOAD_BYTES 立即中止；任何失败都会清理临时文件。"""
+    tmp_path = UPLOAD_TMP_DIR / f"{uuid.uuid4().hex}.part"
+    digest = hashlib.sha256()
+    file_size = 0
+    try:
+        with open(tmp_path, "wb") as buffer:
+            while True:
+                block = await file.read(UPLOAD_BLOCK_SIZE)
+                if not block:
+                    break
+                file_size += len(block)
+                if file_size > MAX_UPLOAD_BYTES:
+                    raise _too_large()
+                digest.update(block)
+                await run_in_threadpool(buffer.write, block)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return tmp_path, digest.hexdigest(), file_size
 
 
 @router.post("/upload")
 async def upload_document(file: UploadFile = File(...)):
-    """上传文档并添加到RAG知识库（带去重）"""
+    """上传文档并提交后台索引任务（带去重），立即返回任务 ID"""
     try:
         print(f"\n[UPLOAD] Start processing file: {file.filename}")
-        file_ext = os.path.splitext(file.filename or "")[1]
-        
-        # 1. 读取文件内容并计算哈希值
-        print(f"[UPLOAD] Reading file content...")
-        file_content = await file.read()
-        file_size = len(file_content)
-        print(f"[UPLOAD] File read complete, size: {file_size / 1024:.2f} KB")
         
-        file_hash = hashlib.md5(file_content).hexdigest()
+        # 1. 分块写入临时文件，同时增量计算哈希（不把整个文件读入内存）
+        print(f"[UPLOAD] Receiving file content...")
+        tmp_path, file_hash, file_size = await _receive_to_temp(file)
+        print(f"[UPLOAD] File received, size: {file_size / 1024:.2f} KB")
         
-        # 2. 检查是否已存在相同文件
-        existing_file = None
-        for existing in UPLOAD_DIR.glob(f"*{file_ext}"):
-            with open(existing, "rb") as f:
-                if hashlib.md5(f.read()).hexdigest() == file_hash:
-                    existing_file = existing
-                    break
-        
-        if existing_file:
+        # 2. 通过哈希索引检查是否已存在相同文件（一次查询）
+        existing = hash_index.lookup(file_hash)
+        if existing:
+            tmp_path.unlink(missing_ok=True)
+            existing_file = UPLOAD_DIR / existing["filename"]
             print(f"[UPLOAD] Duplicate file detected: {existing_file.name}, skipping upload")
             return {
                 "status": "success",
@@ -68,35 +157,33 @@ async def upload_document(file: UploadFile = File(...)):
         file_path = UPLOAD_DIR / file.filename
         paper_id = Path(file.filename).stem
         
+        # 原子重命名：UPLOAD_DIR 中不会出现写了一半的文件
         print(f"[UPLOAD] Saving file to: {file_path}")
-        with open(file_path, "wb") as buffer:
-            buffer.write(file_content)
+        os.replace(tmp_path, file_path)
+        kb = await run_in_threadpool(get_kb)
+        hash_index.add(file_hash, file.filename, kb.vector_store.collection_name, file_size)
         
-        # 4. 添加到知识库 - 使用线程池避免阻塞
-        print(f"[UPLOAD] Starting indexing phase (Embedding)... This may take some time")
-        try:
-            index_result = await run_in_threadpool(kb.add_document, str(file_path), file.filename)
-            if index_result.get("success"):
-                print(f"[UPLOAD] Indexing successful! Generated {index_result.get('chunks')} knowledge chunks")
-            else:
-                print(f"[UPLOAD] Indexing failed: {index_result.get('message')}")
-        except Exception as e:
-            print(f"[UPLOAD] Exception during indexing: {str(e)}")
-            index_result = {"success": False}
+        # 4. 提交后台索引任务，不阻塞请求（进度见 GET /api/jobs/{jobId}）
+        job = get_ingest_queue().submit(str(file_path), file.filename)
+        print(f"[UPLOAD] Indexing job queued: {job['jobId']}")
         
         return {
             "status": "success",
-            "message": "File uploaded and indexed successfully",
+            "message": "File uploaded, indexing started",
             "data": {
                 "paperId": paper_id,
                 "title": file.filename,
                 "abstract": "File uploaded",
-                "indexed": index_result.get("success", False) if index_result else False,
-                "chunks": index_result.get("chunks", 0) if index_result else 0,
+                "indexed": False,
+                "chunks": 0,
+                "jobId": job["jobId"],
+                "jobStatus": job["status"],
                 "duplicate": False
             }
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
@@ -105,7 +192,7 @@ async def list_documents():
     """获取已上传文档列表"""
     docs = []
     for file_path in UPLOAD_DIR.glob("*"):
-        if file_path.is_file():
+        if file_path.is_file() and not file_path.name.startswith("."):
             docs.append({
                 "paperId": file_path.name,  # 使用完整文件名作为 ID
                 "title": file_path.name,
@@ -124,13 +211,19 @@ async def delete_document(filename: str):
         
         if not target_file.exists():
             raise HTTPException(status_code=404, detail="File not found")
+        if get_ingest_queue().is_pending(filename):
+            raise HTTPException(status_code=409, detail="Document is still being indexed, try again later")
             
         # 2. 从向量库删除 (使用文件名作为 title 匹配)
-        kb.delete_document(filename)
+        kb = await run_in_threadpool(get_kb)
+        await run_in_threadpool(kb.delete_document, filename)
         
-        # 3. 删除物理文件
+        # 3. 删除物理文件及其哈希记录
         os.remove(target_file)
+        hash_index.remove(filename)
         
         return {"status": "success", "message": f"Document deleted: {filename}"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Delete failed: {str(e)}")
\ No newline at end of file
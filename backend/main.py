@@ -4,7 +4,7 @@ FastAPI Backend for RAG Research Assistant
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from api.routes import upload, search, retrieve, parse, agent
+from api.routes import upload, search, retrieve, parse, agent, jobs
 import uvicorn
 import os
 from pathlib import Path
@@ -37,12 +37,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 上传大小限制：声明的 Content-Length 超限时在读取请求体之前拒绝，分块传输在接收时计数
+app.add_middleware(upload.UploadSizeLimit, path="/api/upload")
+
+
 # 注册路由
 app.include_router(upload.router, prefix="/api", tags=["Upload"])
 app.include_router(search.router, prefix="/api", tags=["Search"])
 app.include_router(retrieve.router, prefix="/api", tags=["Retrieve"])
 app.include_router(parse.router, prefix="/api", tags=["Parse"])
 app.include_router(agent.router, prefix="/api", tags=["Agent"])
+app.include_router(jobs.router, prefix="/api", tags=["Jobs"])
 
 
 @app.get("/")
@@ -60,10 +65,19 @@ async def root():
 
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="RAG Research Assistant API")
+    # 多个 worker 进程共享向量库：写入经进程间写锁串行化并发布为不可变快照，其他 worker 自动切换
+    parser.add_argument("--workers", type=int, default=int(os.getenv("BACKEND_WORKERS", 1)),
+                        help="number of worker processes (default: BACKEND_WORKERS or 1)")
+    args = parser.parse_args()
+
     port = int(os.getenv("BACKEND_PORT", 8000))
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=port,
-        reload=False  # 关闭自动重载，避免多进程争用向量库文件
+        workers=args.workers,
+        reload=False  # 自动重载与多 worker 不兼容
     )
@@ -0,0 +1,185 @@
+"""
+Agent Stream Service - Agent 流式事件的分帧与可续传的 SSE 流
+连续的小 token 合并成帧后再发送；SSE 流在后台运行并缓存已产生的帧，
+客户端断线后带 Last-Event-ID 重连即可从断点继续。
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+# 合并窗口：同类 chunk 累计到 FRAME_MAX_CHARS 个字符，或第一个 token 到达 FRAME_WINDOW_MS 后发送
+FRAME_WINDOW_MS = float(os.getenv("STREAM_FRAME_WINDOW_MS", 50))
+FRAME_MAX_CHARS = int(os.getenv("STREAM_FRAME_MAX_CHARS", 256))
+# 没有新事件时发送 SSE 注释作为心跳，防止代理断开空闲连接
+HEARTBEAT_S = float(os.getenv("STREAM_HEARTBEAT_S", 15))
+# 结束的流保留多久供断线重连（秒），以及最多保留的流数量
+STREAM_TTL_S = float(os.getenv("STREAM_TTL_S", 300))
+MAX_STREAMS = int(os.getenv("STREAM_MAX_STREAMS", 200))
+# 客户端重连间隔（毫秒）
+SSE_RETRY_MS = 2000
+
+COALESCED_TYPES = ("thought_chunk", "answer_chunk")
+
+
+async def coalesce(events: AsyncIterator[Dict[str, Any]], window_ms: float = FRAME_WINDOW_MS,
+                   max_chars: int = FRAME_MAX_CHARS) -> AsyncIterator[Dict[str, Any]]:
+    """合并连续的同类 chunk 事件；其他事件先发送已合并的内容再原样透传"""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+
+    async def pump():
+        try:
+            async for event in events:
+                await queue.put(event)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await queue.put(finished)
+
+    pump_task = asyncio.create_task(pump())
+    pending: Optional[Dict[str, Any]] = None
+    deadline = 0.0
+    try:
+        while True:
+            timeout = None if pending is None else max(deadline - loop.time(), 0)
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield pending
+                pending = None
+                continue
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if item["type"] in COALESCED_TYPES:
+                if pending is not None and pending["type"] == item["type"]:
+                    pending["content"] += item["content"]
+                else:
+                    if pending is not None:
+                        yield pending
+                    pending = dict(item)
+                    deadline = loop.time() + window_ms / 1000
+                if len(pending["content"]) >= max_chars:
+                    yield pending
+                    pending = None
+                continue
+            if pending is not None:
+                yield pending
+                pending = None
+            yield item
+        if pending is not None:
+            yield pending
+    finally:
+        pump_task.cancel()
+
+
+class AgentStream:
+    """一次流式回答：事件按顺序编号（SSE 事件 id 从 1 开始），运行与客户端连接解耦"""
+
+    def __init__(self, stream_id: str):
+        self.id = stream_id
+        self.events: List[Dict[str, Any]] = []
+        self.done = False
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def append(self, event: Dict[str, Any]):
+        self.events.append(event)
+        self._notify()
+
+    def close(self):
+        self.done = True
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    def _notify(self):
+        # 唤醒所有等待者，之后的等待使用新的 Event
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self, after: int, timeout: float) -> bool:
+        """等待第 after 个之后的事件或流结束；超时返回 False"""
+        if len(self.events) > after or self.done:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class StreamRegistry:
+    """进程内的流表：多 worker 部署时重连需要落到同一个 worker（会话保持）"""
+
+    def __init__(self, ttl: float = STREAM_TTL_S, max_streams: int = MAX_STREAMS):
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self._streams: "OrderedDict[str, AgentStream]" = OrderedDict()
+
+    def start(self, events: AsyncIterator[Dict[str, Any]]) -> AgentStream:
+        """在后台运行事件流；第一个事件告诉客户端流 id"""
+        self._prune()
+        stream = AgentStream(uuid.uuid4().hex)
+        stream.append({"type": "stream", "streamId": stream.id})
+        stream.task = asyncio.create_task(self._produce(stream, events))
+        self._streams[stream.id] = stream
+        return stream
+
+    def get(self, stream_id: str) -> Optional[AgentStream]:
+        return self._streams.get(stream_id)
+
+    @staticmethod
+    async def _produce(stream: AgentStream, events: AsyncIterator[Dict[str, Any]]):
+        try:
+            async for event in events:
+                stream.append(event)
+        except Exception as e:
+            stream.append({"type": "error", "content": str(e)})
+        finally:
+            stream.close()
+
+    def _prune(self):
+        """清理过期的已结束流；超过上限时淘汰最早的流（仍在运行的会被取消）"""
+        now = time.monotonic()
+        for stream_id in [sid for sid, s in self._streams.items() if s.done and now - s.finished_at > self.ttl]:
+            del self._streams[stream_id]
+        while len(self._streams) >= self.max_streams:
+            _, stream = self._streams.popitem(last=False)
+            if stream.task is not None and not stream.done:
+                stream.task.cancel()
+
+
+def format_sse(event_id: int, event: Dict[str, Any]) -> str:
+    return f"id: {event_id}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+async def sse_events(stream: AgentStream, last_event_id: int = 0,
+                     heartbeat_s: float = HEARTBEAT_S) -> AsyncIterator[str]:
+    """从 last_event_id 之后开始输出 SSE 帧，直到流结束；空闲时发送心跳注释"""
+    yield f"retry: {SSE_RETRY_MS}\n\n"
+    sent = max(last_event_id, 0)
+    while True:
+        while sent < len(stream.events):
+            sent += 1
+            yield format_sse(sent, stream.events[sent - 1])
+        if stream.done:
+            break
+        if not await stream.wait(sent, heartbeat_s):
+            yield ": ping\n\n"
+
+
+_registry: Optional[StreamRegistry] = None
+
+
+def get_stream_registry() -> StreamRegistry:
+    global _registry
+    if _registry is None:
+        _registry = StreamRegistry()
+    return _registry
@@ -0,0 +1,180 @@
+"""
+Conversation History Service - 按 token 预算组装带对话历史的输入
+最近 HISTORY_KEEP_TURNS 轮原样保留，更早的轮次合并进滚动摘要。摘要按对话前缀缓存，
+每累计 HISTORY_FOLD_TURNS 轮在后台增量更新一次（旧摘要 + 新增轮次），请求不等待摘要生成，
+每轮的 prompt 大小与延迟不随对话变长而增长。
+"""
+import asyncio
+import functools
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# 输入（摘要 + 历史 + 当前问题）的 token 上限
+TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 3000))
+KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", 4))
+FOLD_TURNS = int(os.getenv("HISTORY_FOLD_TURNS", 4))
+SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", 400))
+SUMMARY_CACHE_SIZE = int(os.getenv("HISTORY_SUMMARY_CACHE", 1000))
+TOKENIZER = os.getenv("HISTORY_TOKENIZER", "cl100k_base")
+# 小节标题和 "Current Question:" 预留的 token
+_SECTION_OVERHEAD = 10
+
+Turn = Tuple[str, str]
+Summarizer = Callable[[str, List[Turn], int], Awaitable[str]]
+
+
+class TokenCounter:
+    """tiktoken 计数；未安装或编码表无法加载（离线）时按字符估算：ASCII 约 4 字符 1 token，其他字符 1 token"""
+
+    def __init__(self, encoding_name: str = TOKENIZER):
+        self._encoding = None
+        try:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(encoding_name)
+        except Exception as e:
+            print(f"⚠️ tiktoken unavailable ({type(e).__name__}), using approximate token counts")
+        # 同一段历史每轮请求都会重新计数，按文本缓存
+        self.count = functools.lru_cache(maxsize=4096)(self._count)
+
+    @staticmethod
+    def _char_cost(ch: str) -> float:
+        return 0.25 if ord(ch) < 128 else 1.0
+
+    def _count(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return int(sum(self._char_cost(ch) for ch in text) + 0.999)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """保留开头不超过 max_tokens 的部分"""
+        if max_tokens <= 0:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        # 预留省略号的 1 个 token
+        max_tokens -= 1
+        if self._encoding is not None:
+            return self._encoding.decode(self._encoding.encode(text, disallowed_special=())[:max_tokens]) + "…"
+        cost = 0.0
+        for i, ch in enumerate(text):
+            cost += self._char_cost(ch)
+            if cost > max_tokens:
+                return text[:i] + "…"
+        return text
+
+
+def _format_turns(turns: List[Turn]) -> str:
+    return "\n".join(f"Q: {q}\nA: {a}" for q, a in turns)
+
+
+class ConversationHistory:
+    """
+    前端每次请求都带完整的 Q/A 列表（服务端无会话状态），摘要用对话前缀的链式哈希做键：
+    前缀 turns[:k] 的摘要 = summarize(前缀 turns[:k - fold] 的摘要, turns[k - fold:k])。
+    只有 fold 的整数倍前缀会被摘要，查找时从最长的前缀往回找已有摘要。
+    """
+
+    def __init__(self, summarize: Summarizer, budget: int = TOKEN_BUDGET, keep_turns: int = KEEP_TURNS,
+                 fold_turns: int = FOLD_TURNS, summary_tokens: int = SUMMARY_TOKENS,
+                 cache_size: int = SUMMARY_CACHE_SIZE, counter: Optional[TokenCounter] = None):
+        self.summarize = summarize
+        self.budget = budget
+        self.keep_turns = max(keep_turns, 0)
+        self.fold_turns = max(fold_turns, 1)
+        self.summary_tokens = summary_tokens
+        self.cache_size = cache_size
+        self.counter = counter or TokenCounter()
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def _prefix_keys(turns: List[Turn]) -> List[str]:
+        """keys[k] 标识前缀 turns[:k]"""
+        keys = [""]
+        for q, a in turns:
+            digest = hashlib.sha1(f"{keys[-1]}\x00{q}\x00{a}".encode("utf-8")).hexdigest()
+            keys.append(digest)
+        return keys
+
+    def _cached(self, key: str) -> Optional[str]:
+        summary = self._summaries.get(key)
+        if summary is not None:
+            self._summaries.move_to_end(key)
+        return summary
+
+    def _store(self, key: str, summary: str):
+        self._summaries[key] = summary
+        while len(self._summaries) > self.cache_size:
+            self._summaries.popitem(last=False)
+
+    async def build_input(self, query: str, context: Optional[List[Dict[str, Any]]]) -> str:
+        """返回不超过预算的完整输入；需要时在后台启动摘要更新（在事件循环中调用）"""
+        turns = [(str(item.get("question", "")), str(item.get("answer", ""))) for item in context or []]
+        if not turns:
+            return query
+        keys = self._prefix_keys(turns)
+        fold_to = max(len(turns) - self.keep_turns, 0) // self.fold_turns * self.fold_turns
+
+        start, summary = 0, ""
+        for k in range(fold_to, 0, -self.fold_turns):
+            cached = self._cached(keys[k])
+            if cached is not None:
+                start, summary = k, cached
+                break
+        if start < fold_to:
+            self._schedule(turns, keys, start, summary, fold_to)
+        # 摘要还没覆盖到的较早轮次也原样放入，超出预算的部分在 _render 中从最早的开始丢弃
+        return self._render(query, summary, turns[start:])
+
+    def _schedule(self, turns: List[Turn], keys: List[str], start: int, summary: str, fold_to: int):
+        target = keys[fold_to]
+        if target in self._pending:
+            return
+        task = asyncio.create_task(self._fold(turns[:fold_to], keys[:fold_to + 1], start, summary))
+        self._pending[target] = task
+        task.add_done_callback(lambda t: self._pending.pop(target, None))
+
+    async def _fold(self, turns: List[Turn], keys: List[str], start: int, summary: str):
+        """每次把 fold 轮并入摘要，逐步缓存中间前缀（一次 LLM 调用的输入有上限）"""
+        clip = self.summary_tokens * 2
+        try:
+            for k in range(start, len(turns), self.fold_turns):
+                end = k + self.fold_turns
+                cached = self._cached(keys[end])
+                if cached is None:
+                    chunk = [(self.counter.truncate(q, clip), self.counter.truncate(a, clip)) for q, a in turns[k:end]]
+                    cached = self.counter.truncate(await self.summarize(summary, chunk, self.summary_tokens),
+                                                   self.summary_tokens)
+                    self._store(keys[end], cached)
+                summary = cached
+        except Exception as e:
+            print(f"⚠️ Conversation summary update failed: {e}")
+
+    def _render(self, query: str, summary: str, turns: List[Turn]) -> str:
+        """按预算组装：当前问题完整保留，其次摘要，然后从最近一轮往前放历史"""
+        remaining = self.budget - self.counter.count(query) - 2 * _SECTION_OVERHEAD
+        sections = []
+        if summary and remaining > 0:
+            summary = self.counter.truncate(summary, min(self.summary_tokens, remaining))
+            remaining -= self.counter.count(summary) + _SECTION_OVERHEAD
+            sections.append(f"Conversation Summary:\n{summary}")
+
+        kept: List[str] = []
+        for q, a in reversed(turns):
+            text = _format_turns([(q, a)])
+            cost = self.counter.count(text) + 1
+            if cost > remaining:
+                # 最近一轮放不下时截断保留，更早的轮次直接丢弃
+                if not kept and remaining > 0:
+                    kept.append(self.counter.truncate(text, remaining))
+                break
+            kept.append(text)
+            remaining -= cost
+        if kept:
+            sections.append("Conversation History:\n" + "\n".join(reversed(kept)))
+
+        if not sections:
+            return query
+        return "\n\n".join(sections) + f"\n\nCurrent Question: {query}"
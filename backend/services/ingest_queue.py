@@ -0,0 +1,114 @@
+"""
+Ingest Queue Service - 后台文档索引任务队列
+上传接口只保存文件并提交任务，解析 → 切分 → 编码 → 写索引在有界线程池中执行，
+通过 GET /api/jobs/{id} 查询阶段与进度。
+索引写入由 EnhancedVectorStore 的锁按集合串行化，编码阶段可并发。
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from services.knowledge import get_kb
+
+# 任务状态：queued → parsing → chunking → embedding → indexing → done / failed
+FINISHED_STATUSES = ("done", "failed")
+
+
+class IngestQueue:
+    """有界线程池 + 内存中的任务状态表"""
+
+    def __init__(self, max_workers: int = 2, max_jobs: int = 500):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_jobs = max_jobs
+
+    def submit(self, file_path: str, title: str) -> Dict[str, Any]:
+        """提交索引任务，立即返回任务快照"""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        job = {
+            "jobId": job_id,
+            "title": title,
+            "status": "queued",
+            "progress": 0.0,
+            "done": 0,
+            "total": 0,
+            "chunks": 0,
+            "message": "",
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            self._prune()
+            snapshot = dict(job)
+        self._executor.submit(self._run, job_id, file_path, title)
+        return snapshot
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(job) for job in reversed(self._jobs.values())]
+
+    def is_pending(self, title: str) -> bool:
+        """该文档是否仍有未完成的索引任务"""
+        with self._lock:
+            return any(job["title"] == title and job["status"] not in FINISHED_STATUSES
+                       for job in self._jobs.values())
+
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updatedAt=time.time())
+
+    def _prune(self):
+        """只保留最近 max_jobs 个任务，优先淘汰已结束的任务"""
+        excess = len(self._jobs) - self.max_jobs
+        if excess <= 0:
+            return
+        for job_id in [jid for jid, job in self._jobs.items() if job["status"] in FINISHED_STATUSES][:excess]:
+            del self._jobs[job_id]
+
+    def _run(self, job_id: str, file_path: str, title: str):
+        def progress(stage: str, done: int, total: int):
+            self._update(job_id, status=stage, done=done, total=total,
+                         progress=round(done / total, 4) if total else 0.0)
+
+        print(f"[INGEST] Job {job_id} started: {title}")
+        try:
+            kb = get_kb()
+            # 同名文档重新上传时只重新编码变化的 chunk
+            result = kb.upsert_document(file_path, title, progress=progress)
+        except Exception as e:
+            result = {"success": False, "message": str(e)}
+
+        if result.get("success"):
+            self._update(job_id, status="done", progress=1.0, chunks=result.get("chunks", 0),
+                         message=result.get("message", ""))
+            print(f"[INGEST] Job {job_id} done: {result.get('chunks')} chunks")
+        else:
+            self._update(job_id, status="failed", message=result.get("message", "Indexing failed"))
+            print(f"[INGEST] Job {job_id} failed: {result.get('message')}")
+
+
+_queue: Optional[IngestQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_ingest_queue() -> IngestQueue:
+    """进程内共享的任务队列；INGEST_WORKERS 控制并发任务数"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = IngestQueue(max_workers=int(os.getenv("INGEST_WORKERS", 2)))
+        return _queue
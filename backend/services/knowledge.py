@@ -0,0 +1,52 @@
+"""
+Knowledge Base Service - 后端共享的知识库入口
+所有路由通过 get_kb() 获取同一个 KnowledgeBase / EnhancedVectorStore 实例
+"""
+import os
+import sys
+from pathlib import Path
+
+# 添加 rag single 路径到 Python path
+RAG_DIR = Path(__file__).parent.parent.parent / "rag single"
+if str(RAG_DIR) not in sys.path:
+    sys.path.insert(0, str(RAG_DIR))
+
+KB_DIR = RAG_DIR / "knowledge_base"
+
+from knowledge_base.registry import get_knowledge_base  # type: ignore
+from knowledge_base.index_factory import IndexConfig  # type: ignore
+
+
+def _index_config_from_env():
+    """
+    KB_INDEX_TYPE: auto / flat / ivf_flat / ivf_pq / hnsw
+    KB_INDEX_STORAGE: float32 / float16 / int8（向量存储精度）
+    都未设置时沿用集合已保存的配置
+    """
+    index_type = os.getenv("KB_INDEX_TYPE")
+    storage = os.getenv("KB_INDEX_STORAGE")
+    if not index_type and not storage:
+        return None
+    return IndexConfig(index_type=index_type or "auto", storage=storage or "float32")
+
+
+def _env_flag(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    return default if value is None else value.lower() in ("1", "true", "yes", "on")
+
+
+def get_kb():
+    """获取进程内共享的英文知识库（首次调用时加载模型和索引）"""
+    return get_knowledge_base(
+        str(KB_DIR),
+        use_english=True,
+        index_config=_index_config_from_env(),
+        nprobe=int(os.getenv("KB_NPROBE", 0)) or None,
+        ef_search=int(os.getenv("KB_EF_SEARCH", 0)) or None,
+        # 智能体检索使用的默认模式：dense / hybrid
+        search_mode=os.getenv("KB_SEARCH_MODE", "dense"),
+        # 智能体检索默认是否重排序，以及候选数与延迟预算
+        rerank=_env_flag("KB_RERANK"),
+        rerank_candidates=int(os.getenv("KB_RERANK_CANDIDATES", 20)),
+        rerank_budget_ms=float(os.getenv("KB_RERANK_BUDGET_MS", 0)) or None
+    )
@@ -0,0 +1,84 @@
+"""
+Upload Hash Index - 已上传文件的持久化内容哈希索引
+content hash → 文件名 / 集合，去重检查只需一次查询，无需重新读取已存文件
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(path: Path) -> str:
+    """分块计算文件的 sha256，不把整个文件读入内存"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadHashIndex:
+    """SQLite 表：content_hash → (filename, collection, size)"""
+
+    def __init__(self, db_path: Path, upload_dir: Path):
+        self.upload_dir = upload_dir
+        self._lock = threading.Lock()
+        is_new = not db_path.exists()
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                content_hash TEXT PRIMARY KEY,
+                filename TEXT NOT NULL UNIQUE,
+                collection TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            );
+        """)
+        self._conn.commit()
+        if is_new:
+            self._backfill()
+
+    def _backfill(self):
+        """首次创建时为已存在的上传文件建立索引（一次性迁移）"""
+        count = 0
+        for path in self.upload_dir.glob("*"):
+            if path.is_file() and not path.name.startswith("."):
+                self.add(hash_file(path), path.name, "", path.stat().st_size)
+                count += 1
+        if count:
+            print(f"[UPLOAD] Hash index built for {count} existing files")
+
+    def lookup(self, content_hash: str) -> Optional[Dict[str, Any]]:
+        """按内容哈希查找已上传文件；文件已不在磁盘上时清理过期记录"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT filename, collection, size FROM uploads WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+            if row is None:
+                return None
+            if not (self.upload_dir / row[0]).exists():
+                self._conn.execute("DELETE FROM uploads WHERE content_hash = ?", (content_hash,))
+                self._conn.commit()
+                return None
+        return {"filename": row[0], "collection": row[1], "size": row[2]}
+
+    def add(self, content_hash: str, filename: str, collection: str, size: int):
+        with self._lock:
+            # 同名文件被覆盖时替换旧记录
+            self._conn.execute("DELETE FROM uploads WHERE filename = ?", (filename,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO uploads (content_hash, filename, collection, size, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (content_hash, filename, collection, size, time.time())
+            )
+            self._conn.commit()
+
+    def remove(self, filename: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM uploads WHERE filename = ?", (filename,))
+            self._conn.commit()
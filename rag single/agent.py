@@ -1,20 +1,150 @@
 """
 使用Agent架构，自主搜索知识库并生成详细解决方案
 """
+import asyncio
+import functools
 import json
-from typing import Dict, List, Any
-from langchain.tools import tool
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Any, Optional, Tuple
+from langchain.tools import StructuredTool
 from langchain.agents import create_openai_tools_agent, AgentExecutor
 from langchain_openai import ChatOpenAI
+from langchain_core.agents import AgentAction
 from langchain_core.prompts import ChatPromptTemplate
 from knowledge_base.kb import KnowledgeBase
+from knowledge_base.answer_cache import SemanticAnswerCache
+
+
+class _RetrievalBatcher:
+    """
+    合并同一时间窗口内发起的检索：一步中并行的多个工具调用（以及同时进行的其他对话）
+    只做一次 retrieve_many（一次编码、一次 FAISS 搜索），N 个查询只付一次检索延迟
+    """
+
+    def __init__(self, retrieve_many: Callable[[List[str]], List[str]], offload, window: float = 0.005):
+        self._retrieve_many = retrieve_many
+        self._offload = offload
+        self.window = window
+        self._pending: List[Tuple[List[str], asyncio.Future]] = []
+        self._tasks = set()
+
+    async def retrieve(self, queries: List[str]) -> List[str]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((queries, future))
+        if len(self._pending) == 1:
+            # 工具调用经过回调后才到达这里，不一定在同一轮事件循环中：等一个短窗口再合并
+            loop.call_later(self.window, self._schedule_flush, loop)
+        return await future
+
+    def _schedule_flush(self, loop):
+        task = loop.create_task(self._flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self):
+        batch, self._pending = self._pending, []
+        queries = [q for qs, _ in batch for q in qs]
+        try:
+            results = await self._offload(self._retrieve_many, queries)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        offset = 0
+        for qs, future in batch:
+            if not future.done():
+                future.set_result(results[offset:offset + len(qs)])
+            offset += len(qs)
+
+
+class _MarkerScanner:
+    """
+    增量识别流式输出中的 ReAct 标记："Final Answer" 之后是回答，"Action" 之后到工具执行结束前隐藏，
+    "Thought:" 前缀去掉。只保留可能是标记开头的最后几个字符（标记跨 token 时也能识别），
+    每个 token 的处理代价只与 token 本身长度有关，不随已输出内容增长。
+    """
+
+    THOUGHT, ACTION, ANSWER = "thought", "action", "answer"
+    # 同一位置优先匹配更长的标记
+    _MARKERS = (("Final Answer", "answer"), ("Action", "action"), ("Thought:", None), ("Thought", None))
+    _PREFIXES = frozenset(m[:i] for m, _ in _MARKERS for i in range(1, len(m)))
+    _MAX_PREFIX = max(len(m) for m, _ in _MARKERS) - 1
+
+    def __init__(self):
+        self.mode = self.THOUGHT
+        self._tail = ""
+        # 段落开头：去掉标记之后紧跟的 ":" 和空白
+        self._segment_start = True
+
+    def _emit(self, kind: str, text: str) -> List[Tuple[str, str]]:
+        if self._segment_start:
+            text = text.lstrip(": \n") if kind == self.ANSWER else text.lstrip()
+            if not text:
+                return []
+            self._segment_start = False
+        return [(kind, text)] if text else []
+
+    def feed(self, token: str) -> List[Tuple[str, str]]:
+        """输入一个 token，返回可以输出的 [(thought / answer, 文本)]"""
+        if self.mode == self.ACTION:
+            return []
+        if self.mode == self.ANSWER:
+            return self._emit(self.ANSWER, token)
+        out: List[Tuple[str, str]] = []
+        text, self._tail = self._tail + token, ""
+        while text:
+            hits = [(text.find(m), -len(m), m, target) for m, target in self._MARKERS if m in text]
+            if not hits:
+                keep = next((i for i in range(min(len(text), self._MAX_PREFIX), 0, -1)
+                             if text[-i:] in self._PREFIXES), 0)
+                out += self._emit(self.THOUGHT, text[:len(text) - keep])
+                self._tail = text[len(text) - keep:]
+                break
+            pos, _, marker, target = min(hits)
+            out += self._emit(self.THOUGHT, text[:pos])
+            if text[pos:] in self._PREFIXES:
+                # 完整的短标记同时是更长标记的开头（"Thought" / "Thought:"）：等下一个 token
+                self._tail = text[pos:]
+                break
+            text = text[pos + len(marker):]
+            if target is not None:
+                self.mode = target
+                self._segment_start = True
+                if target == self.ANSWER:
+                    out += self.feed(text)
+                break
+        return out
+
+    def flush(self) -> List[Tuple[str, str]]:
+        """工具调用开始 / 运行结束时输出保留的尾部"""
+        tail, self._tail = self._tail, ""
+        if not tail or self.mode != self.THOUGHT or tail == "Thought":
+            return []
+        return self._emit(self.THOUGHT, tail)
+
+    def tool_finished(self):
+        if self.mode == self.ACTION:
+            self.mode = self.THOUGHT
+            self._segment_start = True
 
 
 class Agent:
     """规划Agent：基于知识库和工具接口json schema，生成分步、结构化的解决方案计划"""
     
-    def __init__(self, knowledge_base: KnowledgeBase, tools_schema_path: str = None, model_name: str = "qwen-max", api_key: str = None, base_url: str = None):
+    def __init__(self, knowledge_base: KnowledgeBase, tools_schema_path: str = None, model_name: str = "qwen-max", api_key: str = None, base_url: str = None,
+                 retrieval_workers: int = 4, answer_cache: Optional[SemanticAnswerCache] = None,
+                 batch_tool_calls: bool = True):
         self.kb = knowledge_base
+        # 语义答案缓存：相似问题（且数值相同、知识库版本相同）直接返回已有答案，不调用 LLM
+        self.answer_cache = answer_cache
+        # 异步执行（arun / run_stream）时检索在独立线程池中运行，不阻塞事件循环
+        self._retrieval_pool = ThreadPoolExecutor(max_workers=retrieval_workers, thread_name_prefix="retrieval")
+        # 异步执行时同一步的多个工具调用并发运行（AgentExecutor 用 asyncio.gather），
+        # batch_tool_calls 再把它们的检索合并成一次 retrieve_many
+        self._batcher = _RetrievalBatcher(functools.partial(self.kb.retrieve_many, k=3), self._offload) \
+            if batch_tool_calls else None
         
         # 默认在当前文件所在目录查找 tools_schema.json
         if tools_schema_path is None:
@@ -24,16 +154,36 @@ class Agent:
             
         self.tools_schema = self._load_tools_schema(tools_schema_path)
         
-        # 创建知识库搜索工具
-        @tool
+        # 创建知识库搜索工具（同步实现供 run 使用，异步实现把同一检索放到线程池中执行）
         def search_knowledge(query: str) -> str:
             """
             Search the knowledge base for relevant information.
             """
             return self.kb.retrieve(query, k=3)
-        
 
-        self.tools = [search_knowledge]
+        async def asearch_knowledge(query: str) -> str:
+            if self._batcher is not None:
+                return (await self._batcher.retrieve([query]))[0]
+            return await self._offload(search_knowledge, query)
+
+        def search_knowledge_batch(queries: List[str]) -> str:
+            """
+            Search the knowledge base for several related queries in one call.
+            Use this when the problem needs information on multiple sub-topics.
+            """
+            results = self.kb.retrieve_many(queries, k=3)
+            return "\n\n".join(f"### Query: {q}\n{r}" for q, r in zip(queries, results))
+
+        async def asearch_knowledge_batch(queries: List[str]) -> str:
+            if self._batcher is None:
+                return await self._offload(search_knowledge_batch, queries)
+            results = await self._batcher.retrieve(queries)
+            return "\n\n".join(f"### Query: {q}\n{r}" for q, r in zip(queries, results))
+
+        self.tools = [
+            StructuredTool.from_function(func=search_knowledge, coroutine=asearch_knowledge),
+            StructuredTool.from_function(func=search_knowledge_batch, coroutine=asearch_knowledge_batch),
+        ]
 
         # 初始化LLM和Agent
         self.llm = ChatOpenAI(
@@ -46,6 +196,11 @@ class Agent:
         # 设置规划Agent
         self._setup_planning_agent()
     
+    async def _offload(self, func, *args):
+        """在检索线程池中运行阻塞的知识库调用"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._retrieval_pool, functools.partial(func, *args))
+
     def _load_tools_schema(self, schema_path: str) -> List[Dict]:
         """加载工具schema"""
         try:
@@ -63,6 +218,7 @@ IMPORTANT: You must ALWAYS output in ENGLISH, regardless of the user's input lan
 
 Available Tools:
 - search_knowledge: Query the knowledge base for relevant methods and principles.
+- search_knowledge_batch: Query the knowledge base for several sub-topics at once (e.g. ["RGB to CMY", "ratio calculation"]). Prefer it over repeated search_knowledge calls when you already know the sub-topics.
 
 Workflow:
 1. Encountering unknown problems or concepts → Call search_knowledge to query the knowledge base.
@@ -112,21 +268,149 @@ User: "Prepare RGB(128,20,190) color"
             handle_parsing_errors=True
         )
        
-    def run(self, user_input: str) -> Dict[str, Any]:
+    # --- 语义答案缓存 ---
+    def _cache_key(self, user_input: str):
+        """(规范化的问题, 问题向量, 知识库版本)；向量编码会阻塞，异步路径中放到线程池执行"""
+        query = " ".join(user_input.split())
+        return query, self.kb.embed_query(query), self.kb.version()
+
+    @staticmethod
+    def _answer_from_result(result: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """AgentExecutor 的结果 → 可缓存的答案（失败的结果不缓存）"""
+        if not isinstance(result, dict) or "output" not in result:
+            return None
+        steps = [(getattr(action, "tool", ""), getattr(action, "tool_input", ""), getattr(action, "log", ""),
+                  str(observation)) for action, observation in result.get("intermediate_steps", [])]
+        return {"output": result["output"], "steps": steps, "events": None}
+
+    @staticmethod
+    def _answer_from_events(events: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """run_stream 的事件序列 → 可缓存的答案（保留原事件，命中时原样重放）"""
+        if any(e["type"] == "error" for e in events):
+            return None
+        final = next((e for e in reversed(events) if e["type"] == "final_answer"), None)
+        # 没有 final_answer 事件时，答案由 answer_chunk 拼接而成
+        output = final["content"] if final else "".join(e["content"] for e in events if e["type"] == "answer_chunk")
+        if not output.strip():
+            return None
+        tools = [e for e in events if e["type"] == "thought" and "tool" in e]
+        observations = [e for e in events if e["type"] == "observation"]
+        steps = [(t["tool"], t["tool_input"], "", o["content"]) for t, o in zip(tools, observations)]
+        return {"output": output.strip(), "steps": steps, "events": events}
+
+    @staticmethod
+    def _result_from_answer(user_input: str, answer: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "input": user_input,
+            "output": answer["output"],
+            "intermediate_steps": [(AgentAction(tool=tool, tool_input=tool_input, log=log), observation)
+                                   for tool, tool_input, log, observation in answer["steps"]],
+            "cached": True
+        }
+
+    @staticmethod
+    def _events_from_answer(answer: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """命中缓存时重放的事件：与 run_stream 的格式相同，final_answer 带 cached 标记"""
+        events = answer["events"]
+        if events is None:
+            events = []
+            for tool, tool_input, _, observation in answer["steps"]:
+                events.append({"type": "thought", "content": f"Using {tool}...", "tool": tool, "tool_input": tool_input})
+                events.append({"type": "observation", "content": observation, "tool": tool})
+            output = answer["output"].replace("Final Answer:", "").replace("Final Answer", "").strip()
+            events.append({"type": "final_answer", "content": output})
+        return [dict(e, cached=True) if e["type"] == "final_answer" else e for e in events]
+
+    # --- 对话历史摘要 ---
+    async def asummarize_history(self, summary: str, turns: List[Tuple[str, str]], max_tokens: int = 400) -> str:
+        """把较早的对话轮次合并进已有摘要：只输入旧摘要和新增轮次，不重新生成整段历史"""
+        new_turns = "\n".join(f"Q: {q}\nA: {a}" for q, a in turns)
+        prompt = ChatPromptTemplate.from_messages([
+            ("system", "You maintain a running summary of a conversation between a user and a solution "
+                       "planning assistant. Merge the new turns into the existing summary. Keep the user's "
+                       "goals, given values (numbers, colors, ratios), decisions and results; drop small talk. "
+                       "Write in English, at most {max_words} words."),
+            ("human", "Existing summary:\n{summary}\n\nNew turns:\n{turns}\n\nUpdated summary:")
+        ])
+        llm = self.llm.bind(max_tokens=max_tokens)
+        message = await (prompt | llm).ainvoke({
+            "summary": summary or "(none)",
+            "turns": new_turns,
+            "max_words": max_tokens * 3 // 4
+        })
+        return message.content.strip()
+
+    def run(self, user_input: str, use_cache: bool = True) -> Dict[str, Any]:
         """
         根据用户输入创建详细的解决方案计划
         使用Agent架构，让LLM自主决定何时搜索知识库
         """
         try:
+            key = self._cache_key(user_input) if use_cache and self.answer_cache is not None else None
+            cached = self.answer_cache.get(*key) if key else None
+            if cached:
+                return self._result_from_answer(user_input, cached)
+
             # 使用Agent执行器处理用户输入
             result = self.agent_executor.invoke({
                 "input": f"Please formulate a detailed solution plan for the following problem:\n\n{user_input}"
             })
+            answer = self._answer_from_result(result)
+            if key and answer:
+                self.answer_cache.put(*key, answer)
+            return result
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    async def arun(self, user_input: str, use_cache: bool = True) -> Dict[str, Any]:
+        """
+        run 的异步版本：LLM 调用走异步客户端，检索在线程池中执行，
+        同一事件循环可以同时处理多个对话
+        """
+        try:
+            key = None
+            if use_cache and self.answer_cache is not None:
+                key = await self._offload(self._cache_key, user_input)
+            cached = self.answer_cache.get(*key) if key else None
+            if cached:
+                return self._result_from_answer(user_input, cached)
+
+            result = await self.agent_executor.ainvoke({
+                "input": f"Please formulate a detailed solution plan for the following problem:\n\n{user_input}"
+            })
+            answer = self._answer_from_result(result)
+            if key and answer:
+                self.answer_cache.put(*key, answer)
             return result
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    async def run_stream(self, user_input: str):
+    async def run_stream(self, user_input: str, use_cache: bool = True):
+        """
+        异步流式输出 Agent 的思考过程和结果；命中答案缓存时按同样的事件格式重放
+        """
+        key = None
+        if use_cache and self.answer_cache is not None:
+            try:
+                key = await self._offload(self._cache_key, user_input)
+            except Exception as e:
+                yield {"type": "error", "content": str(e)}
+                return
+            cached = self.answer_cache.get(*key)
+            if cached:
+                for event in self._events_from_answer(cached):
+                    yield event
+                return
+
+        events = []
+        async for event in self._stream_events(user_input):
+            events.append(event)
+            yield event
+        answer = self._answer_from_events(events)
+        if key and answer:
+            self.answer_cache.put(*key, answer)
+
+    async def _stream_events(self, user_input: str):
         """
         异步流式输出 Agent 的思考过程和结果
         """
@@ -134,27 +418,29 @@ User: "Prepare RGB(128,20,190) color"
         full_input = f"Please formulate a detailed solution plan for the following problem:\n\n{user_input}"
         
         try:
-            # 记录完整的思考过程和最终答案
-            buffer = ""
-            final_answer_started = False
-            action_started = False
+            scanner = _MarkerScanner()
+            chunk_types = {_MarkerScanner.THOUGHT: "thought_chunk", _MarkerScanner.ANSWER: "answer_chunk"}
+            # 最外层 AgentExecutor 的 run_id：它结束时的输出就是最终答案
+            root_run = None
+            # 并行工具调用的 on_tool_end 按完成顺序到达：按调用顺序输出 observation
+            tool_runs: List[str] = []
+            tool_outputs: Dict[str, Dict[str, Any]] = {}
             
             async for event in self.agent_executor.astream_events(
                 {"input": full_input},
                 version="v1"
             ):
                 kind = event["event"]
+                if root_run is None and kind == "on_chain_start":
+                    root_run = event["run_id"]
                 
                 # 捕获工具调用开始
                 if kind == "on_tool_start":
-                    # 如果有未发送的缓冲内容（通常是思考），先发送
-                    if buffer.strip() and not action_started:
-                        # 清理 "Thought:" 前缀
-                        content_to_send = buffer.replace("Thought:", "").replace("Thought", "").strip()
-                        if content_to_send:
-                            yield {"type": "thought_chunk", "content": content_to_send}
-                    buffer = ""
+                    # 先发送保留的思考内容
+                    for part, text in scanner.flush():
+                        yield {"type": chunk_types[part], "content": text}
                     
+                    tool_runs.append(event["run_id"])
                     action = event['data'].get('input')
                     # 兼容不同版本的 LangChain
                     if hasattr(action, 'tool'):
@@ -176,88 +462,36 @@ User: "Prepare RGB(128,20,190) color"
                     content = event["data"]["chunk"].content
                     if not content:
                         continue
-                    
-                    # 1. 如果已经进入 Final Answer 阶段，直接作为回答发送
-                    if final_answer_started:
-                        yield {"type": "answer_chunk", "content": content}
-                        continue
-
-                    # 2. 如果已经进入 Action 阶段（正在生成工具调用代码），则不发送给前端（隐藏 Action 声明）
-                    if action_started:
-                        continue
-
-                    # 3. 缓冲内容以进行检测
-                    buffer += content
-                    
-                    # 检测 Final Answer
-                    if "Final Answer" in buffer:
-                        final_answer_started = True
-                        # 找到分割点
-                        split_marker = "Final Answer:" if "Final Answer:" in buffer else "Final Answer"
-                        parts = buffer.split(split_marker, 1)
-                        
-                        # 分割点之前的内容属于思考
-                        thought_content = parts[0].replace("Thought:", "").replace("Thought", "").strip()
-                        if thought_content:
-                            yield {"type": "thought_chunk", "content": thought_content}
-                        
-                        # 分割点之后的内容属于回答
-                        if len(parts) > 1 and parts[1]:
-                            yield {"type": "answer_chunk", "content": parts[1]}
-                        
-                        buffer = "" # 清空缓冲
-                        continue
-
-                    # 检测 Action (隐藏 Action: ... 及其后的内容直到工具调用)
-                    if "Action" in buffer:
-                        # 找到 Action 的位置
-                        action_index = buffer.find("Action")
-                        # Content before Action is thought
-                        thought_content = buffer[:action_index].replace("Thought:", "").replace("Thought", "").strip()
-                        if thought_content:
-                            yield {"type": "thought_chunk", "content": thought_content}
-                        
-                        action_started = True
-                        buffer = "" # 清空缓冲，后续的 Action 内容将被忽略
-                        continue
-
-                    # 如果缓冲区过大且没有特殊标记，则将前面的内容作为思考发送
-                    # 保留最后一部分以防标记被切断 (例如 "Final A" 或 "Act")
-                    if len(buffer) > 20:
-                        to_send = buffer[:-15]
-                        buffer = buffer[-15:]
-                        # 只有当 to_send 不仅仅是 "Thought" 时才发送，避免重复
-                        clean_send = to_send.replace("Thought:", "").replace("Thought", "").strip()
-                        if clean_send:
-                            yield {"type": "thought_chunk", "content": clean_send}
+                    for part, text in scanner.feed(content):
+                        yield {"type": chunk_types[part], "content": text}
                 
                 # 捕获工具执行结束
                 elif kind == "on_tool_end":
-                    action_started = False # Action 结束，恢复正常流式输出（通常接下来是 Observation）
-                    buffer = "" # 确保缓冲清空
+                    scanner.tool_finished() # Action 结束，恢复正常流式输出
                         
                     output = event['data'].get('output')
-                    yield {
+                    observation = {
                         "type": "observation",
                         "content": str(output) if output else "No result",
                         "tool": event['name']
                     }
+                    if event["run_id"] not in tool_runs:
+                        yield observation
+                        continue
+                    tool_outputs[event["run_id"]] = observation
+                    while tool_runs and tool_runs[0] in tool_outputs:
+                        yield tool_outputs.pop(tool_runs.pop(0))
                 
                 # 捕获最终输出
-                elif kind == "on_agent_finish":
-                    # 确保所有缓冲都已处理
-                    if buffer and not final_answer_started and not action_started:
-                         # 如果缓冲区包含 Final Answer，说明它是回答的一部分，不要作为思考发送
-                         if "Final Answer" in buffer:
-                             pass
-                         else:
-                             clean_buffer = buffer.replace("Thought:", "").replace("Thought", "").strip()
-                             if clean_buffer:
-                                yield {"type": "thought_chunk", "content": clean_buffer}
+                elif kind == "on_chain_end" and event["run_id"] == root_run:
+                    for part, text in scanner.flush():
+                        yield {"type": chunk_types[part], "content": text}
                     
-                    output = event["data"]["output"]
+                    output = event["data"].get("output")
+                    if isinstance(output, dict):
+                        output = output.get("output", "")
                     # 清理 Final Answer 标记，防止重复
-                    clean_output = output.replace("Final Answer:", "").replace("Final Answer", "").strip()
+                    clean_output = str(output or "").replace("Final Answer:", "").replace("Final Answer", "").strip()
                     yield {
                         "type": "final_answer",
                         "content": clean_output
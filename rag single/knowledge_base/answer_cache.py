@@ -0,0 +1,77 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+# 题目中的数值（浓度、RGB 分量、比例等）：数值不同的题目即使语义几乎相同，答案也不同
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+
+
+def _numbers(query: str) -> Tuple[str, ...]:
+    return tuple(_NUMBER_RE.findall(query))
+
+
+class SemanticAnswerCache:
+    """
+    Agent answers keyed by normalized query embedding, scoped to a knowledge-base version.
+
+    A lookup hits when a stored query has cosine similarity >= `threshold`, the
+    same numbers in its text, and was answered against the same index version
+    (any index change invalidates every entry). Entries expire after `ttl`
+    seconds; beyond `maxsize` the least recently used entry is evicted.
+    """
+
+    def __init__(self, threshold: float = 0.95, maxsize: int = 1000, ttl: Optional[float] = 3600):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # id -> (vector, numbers, answer, expires)
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._version: Optional[str] = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _check_version(self, version: str):
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def get(self, query: str, vector: np.ndarray, version: str) -> Optional[Dict[str, Any]]:
+        numbers = _numbers(query)
+        now = time.monotonic()
+        with self._lock:
+            self._check_version(version)
+            expired = [i for i, e in self._entries.items() if e[3] is not None and e[3] < now]
+            for i in expired:
+                del self._entries[i]
+            candidates = [i for i, e in self._entries.items() if e[1] == numbers]
+            if not candidates:
+                return None
+            scores = np.vstack([self._entries[i][0] for i in candidates]) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            self._entries.move_to_end(candidates[best])
+            return self._entries[candidates[best]][2]
+
+    def put(self, query: str, vector: np.ndarray, version: str, answer: Dict[str, Any]):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._check_version(version)
+            self._entries[self._next_id] = (vector, _numbers(query), answer, expires)
+            self._next_id += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
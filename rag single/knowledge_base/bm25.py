@@ -0,0 +1,90 @@
+import heapq
+import math
+import re
+from collections import Counter
+from typing import Container, Dict, Iterable, List, Optional, Tuple
+
+# 英文 / 数字按词切分，中文按单字切分
+_TOKEN_RE = re.compile(r"[a-z0-9]+|[一-鿿]")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    """
+    In-memory BM25 inverted index keyed by vector id (vid).
+
+    Postings are updated incrementally by `add` / `remove`, so the index can be
+    kept in step with the FAISS index without rebuilding. Not thread-safe on its
+    own; EnhancedVectorStore guards it with the store lock.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._doc_terms: Dict[int, Counter] = {}
+        self._doc_len: Dict[int, int] = {}
+        self._total_len = 0
+
+    def __len__(self) -> int:
+        return len(self._doc_terms)
+
+    def add(self, vid: int, text: str):
+        if vid in self._doc_terms:
+            self.remove(vid)
+        terms = Counter(tokenize(text))
+        self._doc_terms[vid] = terms
+        self._doc_len[vid] = sum(terms.values())
+        self._total_len += self._doc_len[vid]
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[vid] = tf
+
+    def add_many(self, items: Iterable[Tuple[int, str]]):
+        for vid, text in items:
+            self.add(vid, text)
+
+    def remove(self, vid: int):
+        terms = self._doc_terms.pop(vid, None)
+        if terms is None:
+            return
+        self._total_len -= self._doc_len.pop(vid)
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(vid, None)
+                if not postings:
+                    del self._postings[term]
+
+    def search(self, query: str, k: int, allowed: Optional[Container[int]] = None) -> List[Tuple[int, float]]:
+        """
+        Top-k (vid, score) by BM25; documents sharing no term with the query are not
+        returned. `allowed` optionally restricts scoring to a set of vids.
+        """
+        n_docs = len(self._doc_terms)
+        if not n_docs:
+            return []
+        avg_len = self._total_len / n_docs or 1.0
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for vid, tf in postings.items():
+                if allowed is not None and vid not in allowed:
+                    continue
+                norm = tf + self.k1 * (1 - self.b + self.b * self._doc_len[vid] / avg_len)
+                scores[vid] = scores.get(vid, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+def reciprocal_rank_fusion(rankings: List[List[Tuple[int, float]]], k: int, rrf_k: int = 60) -> List[Tuple[int, float]]:
+    """Fuse several ranked [(vid, score)] lists: score(vid) = sum 1 / (rrf_k + rank)."""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, (vid, _) in enumerate(ranking, start=1):
+            fused[vid] = fused.get(vid, 0.0) + 1.0 / (rrf_k + rank)
+    return heapq.nlargest(k, fused.items(), key=lambda item: item[1])
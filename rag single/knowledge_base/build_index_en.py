@@ -2,70 +2,290 @@
 # -*- coding: utf-8 -*-
 """
 Build English knowledge base index
+
+增量构建：维护 (path, size, mtime, hash) 清单，只处理新增 / 修改 / 删除的文件；
+文件在多进程中并行切分，所有新 chunk 共享大批次编码。
+--full 在新目录中从头构建索引，完成后再替换旧目录；通过 /api/upload 上传的文档会被保留。
+
+用法:
+    python build_index_en.py                 # 增量更新
+    python build_index_en.py --full          # 全量重建
+    python build_index_en.py --workers 4 --batch-size 512
+    python build_index_en.py --storage int8  # 切换向量存储精度（float32 / float16 / int8）
 """
 
+import argparse
+import hashlib
+import json
 import os
+import shutil
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
 # 将 rag single 目录添加到 Python 路径，以便能够导入 knowledge_base 模块
 current_file_path = Path(__file__).parent.absolute()
 sys.path.append(str(current_file_path.parent))
 
 from knowledge_base.kb import KnowledgeBase
+from knowledge_base.enhanced_system import EnhancedVectorStore, pool_context
+from knowledge_base.index_factory import IndexConfig, STORAGE_TYPES
+from knowledge_base.meta_store import MetadataStore
+from knowledge_base.snapshots import SnapshotStore
+
+SOURCE_PATTERNS = ("*.md", "*.pdf")
+DEFAULT_BATCH_SIZE = 512
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def manifest_path_for(store: EnhancedVectorStore) -> Path:
+    """清单与向量库放在同一目录，--full 替换目录时一起替换"""
+    return store.persist_directory / f"{store.collection_name}_manifest.json"
+
+
+def load_manifest(path: Path) -> Dict[str, Dict[str, Any]]:
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f).get("files", {})
+
+
+def save_manifest(path: Path, files: Dict[str, Dict[str, Any]]):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"files": files}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def scan(source_dir: Path, manifest: Dict[str, Dict[str, Any]]) -> Tuple[Dict[str, Dict[str, Any]], List[str], List[str]]:
+    """
+    对比磁盘文件与清单：返回 (新清单, 新增或修改的文件, 已删除的文件)。
+    size 和 mtime 都未变的文件不再读取；变化时再比对内容哈希（只 touch 过的文件不重新索引）。
+    """
+    current: Dict[str, Dict[str, Any]] = {}
+    changed: List[str] = []
+    paths = sorted({p for pattern in SOURCE_PATTERNS for p in source_dir.glob(pattern) if p.is_file()})
+    for path in paths:
+        name = path.name
+        stat = path.stat()
+        old = manifest.get(name)
+        if old and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime:
+            current[name] = old
+            continue
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": file_hash(path)}
+        if old and old["hash"] == entry["hash"]:
+            current[name] = dict(old, **entry)
+            continue
+        current[name] = entry
+        changed.append(name)
+    removed = [name for name in manifest if name not in current]
+    return current, changed, removed
+
+
+def _init_chunk_worker():
+    # 切分已在进程池中并行，单个 PDF 不再嵌套开进程池
+    os.environ["KB_PDF_WORKERS"] = "1"
+
+
+def _chunk_one(path: str):
+    return KnowledgeBase.chunk_file(path)
+
+
+def chunk_files(paths: List[Path], workers: int) -> Dict[str, Any]:
+    """并行切分文件，返回 {文件名: chunks}"""
+    if workers <= 1 or len(paths) <= 1:
+        results = [_chunk_one(str(p)) for p in paths]
+    else:
+        # 增量模式下嵌入模型已加载（多线程进程），不直接 fork
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths)), initializer=_init_chunk_worker,
+                                 mp_context=pool_context()) as pool:
+            results = list(pool.map(_chunk_one, [str(p) for p in paths]))
+    return {p.name: chunks for p, chunks in zip(paths, results)}
+
+
+def sync_store(store: EnhancedVectorStore, source_dir: Path, workers: int, batch_size: int) -> Dict[str, int]:
+    """按清单增量同步向量库，返回汇总统计"""
+    manifest_path = manifest_path_for(store)
+    manifest = load_manifest(manifest_path)
+    current, changed, removed = scan(source_dir, manifest)
+    print(f"📚 Found {len(current)} documents: {len(changed)} added/changed, "
+          f"{len(removed)} removed, {len(current) - len(changed)} unchanged")
+
+    totals = {"files": len(current), "changed": len(changed), "removed": len(removed),
+              "added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+    if not changed and not removed:
+        save_manifest(manifest_path, current)
+        return totals
+
+    start = time.time()
+    chunked = chunk_files([source_dir / name for name in changed], workers)
+    print(f"✂️  Chunked {len(chunked)} files in {time.time() - start:.1f}s")
 
-def build_english_index():
+    sources: Dict[str, Dict[int, Any]] = {}
+    for name, chunks in chunked.items():
+        if chunks is None:
+            print(f"  ❌ Unsupported file type: {name}")
+            current.pop(name, None)
+            continue
+        current[name]["chunks"] = len(chunks)
+        sources[name] = chunks
+    for name in removed:
+        sources[name] = {}
+
+    start = time.time()
+    stats = store.upsert_sources(sources, batch_size=batch_size)
+    print(f"🧮 Embedded and indexed in {time.time() - start:.1f}s")
+    for source_stats in stats.values():
+        totals["added"] += source_stats["added"]
+        totals["updated"] += source_stats["updated"]
+        totals["unchanged"] += source_stats["unchanged"]
+        totals["deleted"] += source_stats["removed"]
+
+    # 索引写入成功后才更新清单，失败时下次运行会重新处理
+    save_manifest(manifest_path, current)
+    return totals
+
+
+def carry_over_uploads(persist_dir: Path, collection_name: str, store: EnhancedVectorStore,
+                       manifest_names: Set[str]) -> int:
+    """
+    把旧向量库中不属于知识库目录的 chunk（通过 /api/upload 上传的文档）写入新构建的向量库，
+    返回写入的 chunk 数。向量命中嵌入缓存，无需重新编码；调用方持有旧目录的写锁。
+    """
+    db_path = persist_dir / f"{collection_name}_meta.sqlite"
+    if not db_path.exists():
+        return 0
+    old_meta = MetadataStore(db_path.as_posix())
+    try:
+        records = [(doc, chunk_id, meta) for _, chunk_id, doc, meta in old_meta.iter_rows()
+                   if meta.get("source") not in manifest_names]
+    finally:
+        old_meta.close()
+    if records:
+        sources = {meta.get("source") for _, _, meta in records}
+        print(f"📎 Keeping {len(records)} chunks of {len(sources)} uploaded documents")
+        store.add_records(records, total=len(records))
+    return len(records)
+
+
+def swap_in(build_dir: Path, persist_dir: Path, collection_name: str,
+            before_swap: Optional[Callable[[], None]] = None):
+    """
+    用新构建的目录替换旧向量库目录（两次 rename，旧目录随后删除）。
+    替换期间持有旧目录的写锁，不会打断其他进程正在进行的写入；`before_swap` 在持锁后、
+    替换前调用（此时旧目录不会再有新的写入）。运行中的服务在下次检查快照指针时切换到新目录。
+    """
+    old_dir = persist_dir.with_name(f"{persist_dir.name}.old-{int(time.time())}")
+    if persist_dir.exists():
+        with SnapshotStore(persist_dir, collection_name).writer_lock():
+            if before_swap:
+                before_swap()
+            os.replace(persist_dir, old_dir)
+            os.replace(build_dir, persist_dir)
+    else:
+        if before_swap:
+            before_swap()
+        os.replace(build_dir, persist_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def index_config_with(config_path: Path, storage: Optional[str]) -> Optional[IndexConfig]:
+    """在集合已保存的索引配置上修改存储精度；未指定时返回 None（沿用已保存配置）"""
+    if storage is None:
+        return None
+    config = IndexConfig.load(config_path) if config_path.exists() else IndexConfig()
+    config.storage = storage
+    return config
+
+
+def build_english_index(full: bool = False, workers: Optional[int] = None,
+                        batch_size: int = DEFAULT_BATCH_SIZE, storage: Optional[str] = None):
     """构建英文知识库索引"""
-    print("🔨 Building English knowledge base index...")
-    
+    print(f"🔨 Building English knowledge base index ({'full' if full else 'incremental'})...")
+
     # 获取当前脚本所在目录
     current_dir = Path(__file__).parent.absolute()
-    # 根目录 (rag single)
-    root_dir = current_dir.parent
-    
+
     # 设置路径
     kb_dir = current_dir / "problems_en"
-    
+
     if not kb_dir.exists():
         print(f"❌ English knowledge base directory does not exist: {kb_dir}")
         return
-    
+
+    workers = workers or os.cpu_count() or 1
+    persist_dir, collection_name = KnowledgeBase.store_location(use_english=True)
+    index_config = index_config_with(persist_dir / f"{collection_name}_index.json", storage)
     try:
-        # 初始化 KnowledgeBase (它会自动处理向量库的创建和加载)
-        # 注意：KnowledgeBase 内部现在使用的是 EnhancedVectorStore
-        kb = KnowledgeBase(kb_dir=str(current_dir), use_english=True)
-        
-        # 获取所有 md 文件
-        md_files = list(kb_dir.glob("*.md"))
-        print(f"📚 Found {len(md_files)} English documents")
-        
-        for file_path in md_files:
-            print(f"📄 Processing: {file_path.name}")
-            # 使用新的 add_document 方法 (内部会调用 EnhancedMarkdownChunker)
-            # 注意：虽然 add_document 目前主要针对 PDF，但我们可以稍微调整一下 kb.py 
-            # 或者在这里直接模拟处理。
-            # 为了保持一致性，我们直接调用 kb.add_document
-            result = kb.add_document(str(file_path))
-            if result.get("success"):
-                print(f"  ✅ Indexed {result.get('chunks')} chunks")
-            else:
-                print(f"  ❌ Failed: {result.get('message')}")
-        
-        print("\n✅ English knowledge base index built successfully!")
-        
+        if full:
+            # 在新目录中从头构建，成功后再替换，构建期间旧索引保持可用
+            build_dir = persist_dir.with_name(f"{persist_dir.name}.build-{int(time.time())}")
+            build_dir.mkdir(parents=True)
+            old_config = persist_dir / f"{collection_name}_index.json"
+            if old_config.exists():
+                shutil.copy2(old_config, build_dir / old_config.name)
+            try:
+                store = EnhancedVectorStore(str(build_dir), collection_name, batch_size=batch_size,
+                                            index_config=index_config)
+                totals = sync_store(store, kb_dir, workers, batch_size)
+            except BaseException:
+                shutil.rmtree(build_dir, ignore_errors=True)
+                raise
+
+            def keep_uploads():
+                # 只重建知识库目录中的文件（包括旧清单中已删除的）；上传的文档在写锁内复制，
+                # 构建期间新上传的文档也不会丢失
+                names = set(load_manifest(manifest_path_for(store)))
+                names.update(load_manifest(persist_dir / manifest_path_for(store).name))
+                try:
+                    totals["kept"] = carry_over_uploads(persist_dir, collection_name, store, names)
+                    store.meta.close()
+                except BaseException:
+                    shutil.rmtree(build_dir, ignore_errors=True)
+                    raise
+
+            swap_in(build_dir, persist_dir, collection_name, before_swap=keep_uploads)
+        else:
+            # 存储精度变化时向量库加载后会用已存向量按新精度重建索引
+            kb = KnowledgeBase(kb_dir=str(current_dir), use_english=True, index_config=index_config)
+            totals = sync_store(kb.vector_store, kb_dir, workers, batch_size)
+
+        print(f"\n✅ English knowledge base index built successfully! "
+              f"({totals['added']} chunks embedded, {totals['deleted']} removed, "
+              f"{totals['unchanged'] + totals['updated']} reused"
+              + (f", {totals['kept']} uploaded chunks kept" if totals.get("kept") else "") + ")")
+
         # 测试检索
+        kb = KnowledgeBase(kb_dir=str(current_dir), use_english=True)
         print("\n🔍 Testing retrieval:")
         test_queries = ["RGB color conversion", "multi-component mixing", "dye preparation"]
-        
+
         for query in test_queries:
             results = kb.retrieve(query, k=2)
             print(f"\nQuery: '{query}'")
             print(results)
-        
+
     except Exception as e:
         print(f"❌ Build failed: {e}")
         import traceback
         traceback.print_exc()
 
 if __name__ == "__main__":
-    build_english_index()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Build English knowledge base index")
+    parser.add_argument("--full", action="store_true", help="rebuild from scratch in a new directory and swap it in")
+    parser.add_argument("--workers", type=int, default=None, help="chunking processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="embedding batch size")
+    parser.add_argument("--storage", choices=STORAGE_TYPES, default=None,
+                        help="vector storage precision for the collection (default: keep current)")
+    args = parser.parse_args()
+    build_english_index(full=args.full, workers=args.workers, batch_size=args.batch_size, storage=args.storage)
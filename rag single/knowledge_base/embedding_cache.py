@@ -0,0 +1,235 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows：只有进程内的锁
+    fcntl = None
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed cache of normalized embeddings.
+
+    Keys are sha256 digests of the embedded text; each model gets its own
+    directory, so (model name, text hash) identifies a vector. Vectors live in
+    a fixed-width float32 file opened with np.memmap, and a SQLite table maps
+    keys to row slots with an LRU clock. When `max_entries` is reached the
+    least recently used slots are overwritten.
+
+    The directory may be shared by several processes (uvicorn workers, the
+    index build script). Writes hold an exclusive flock on `vectors.lock` and
+    the SQLite write lock (`BEGIN IMMEDIATE`) across slot allocation, the
+    vector writes and the row inserts. Reads hold the flock shared and use a
+    deferred (read-only) transaction, so readers never wait for each other and
+    never see a slot while another process is overwriting it. LRU clock
+    updates from reads are batched and written with the next write.
+    """
+
+    GROW_ROWS = 4096
+    # 等待其他进程释放写锁的秒数
+    BUSY_TIMEOUT_S = 30
+    # 读命中的 LRU 更新累计到这么多 key 时单独写入一次（否则随下一次 put_many 写入）
+    TOUCH_BATCH = 1024
+
+    def __init__(self, cache_dir: str, model_name: str, max_entries: int = 100_000):
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        self.cache_dir = Path(cache_dir) / slug
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.vectors_path = self.cache_dir / "vectors.f32"
+
+        self._lock = threading.RLock()
+        self._lock_fd = os.open((self.cache_dir / "vectors.lock").as_posix(), os.O_RDWR | os.O_CREAT, 0o644)
+        # 读命中但还未写入 last_used 的 key
+        self._touched = set()
+        # isolation_level=None：事务显式开启（读：BEGIN，写：BEGIN IMMEDIATE）
+        self._conn = sqlite3.connect((self.cache_dir / "index.sqlite").as_posix(), check_same_thread=False,
+                                     timeout=self.BUSY_TIMEOUT_S, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                slot INTEGER NOT NULL UNIQUE,
+                last_used INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries(last_used);
+            CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        """)
+        self.dim: Optional[int] = self._get_state("dim")
+        self._vectors: Optional[np.memmap] = None
+        if self.dim and self.vectors_path.exists():
+            self._open()
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _get_state(self, key: str) -> Optional[int]:
+        row = self._conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key: str, value: int):
+        self._conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, int(value)))
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        """Inter-process lock on the vector file: shared for reads, exclusive for slot writes."""
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _transaction(self, write: bool):
+        """
+        Process lock + SQLite transaction (BEGIN IMMEDIATE when `write`); the
+        mapped file is re-synced with other processes' growth. Callers that
+        touch slots or vectors hold `_file_lock` around it.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                if self.dim is None:
+                    self.dim = self._get_state("dim")
+                self._sync_rows()
+                yield
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _tick(self) -> int:
+        """Advance the shared LRU clock (inside a transaction)."""
+        clock = (self._get_state("clock") or 0) + 1
+        self._set_state("clock", clock)
+        return clock
+
+    def _file_rows(self) -> int:
+        if not self.dim or not self.vectors_path.exists():
+            return 0
+        return self.vectors_path.stat().st_size // (4 * self.dim)
+
+    def _open(self):
+        rows = self._file_rows()
+        self._vectors = np.memmap(self.vectors_path, dtype="float32", mode="r+", shape=(rows, self.dim)) if rows else None
+
+    def _sync_rows(self):
+        """Re-open the map if another process grew the vector file since it was opened."""
+        mapped = 0 if self._vectors is None else self._vectors.shape[0]
+        if self._file_rows() != mapped:
+            self._vectors = None
+            self._open()
+
+    def _ensure_rows(self, rows: int):
+        """Grow the memory-mapped vector file to hold at least `rows` slots."""
+        current = self._file_rows()
+        if rows <= current:
+            return
+        new_rows = min(max(rows, current + self.GROW_ROWS), self.max_entries)
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(new_rows * self.dim * 4)
+        self._open()
+
+    def get_many(self, keys: Sequence[str]) -> Dict[int, np.ndarray]:
+        """Return {position in keys: vector} for cache hits."""
+        if not keys:
+            return {}
+        hits: Dict[int, np.ndarray] = {}
+        with self._lock, self._file_lock(exclusive=False), self._transaction(write=False):
+            slots: Dict[str, int] = {}
+            unique = list(set(keys))
+            for i in range(0, len(unique), 500):
+                batch = unique[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                slots.update(self._conn.execute(
+                    f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", batch
+                ).fetchall())
+            if not slots:
+                return {}
+            rows = 0 if self._vectors is None else self._vectors.shape[0]
+            for pos, k in enumerate(keys):
+                slot = slots.get(k)
+                # 行数不足说明文件被截短或损坏，按未命中处理
+                if slot is not None and slot < rows:
+                    hits[pos] = np.array(self._vectors[slot])
+        with self._lock:
+            self._touched.update(slots)
+            if len(self._touched) >= self.TOUCH_BATCH:
+                # 只更新 last_used：不涉及槽位和向量，不需要文件锁，也不刷盘
+                with self._transaction(write=True):
+                    self._write_touched()
+        return hits
+
+    def _write_touched(self):
+        """Write batched LRU updates from reads (inside a write transaction)."""
+        if not self._touched:
+            return
+        clock = self._tick()
+        self._conn.executemany("UPDATE entries SET last_used = ? WHERE key = ?", ((clock, k) for k in self._touched))
+        self._touched.clear()
+
+    def put_many(self, keys: Sequence[str], vectors: np.ndarray):
+        """Store vectors, evicting least recently used entries when full."""
+        if not len(keys):
+            return
+        vectors = np.asarray(vectors, dtype="float32")
+        with self._lock, self._file_lock(exclusive=True), self._transaction(write=True):
+            # 先写入读命中的 LRU 更新，淘汰时不会选中刚被读过的条目
+            self._write_touched()
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                self._set_state("dim", self.dim)
+            # 同一批内重复的文本只存一份
+            pending = {}
+            for k, v in zip(keys, vectors):
+                pending[k] = v
+            existing = set()
+            for k in pending:
+                if self._conn.execute("SELECT 1 FROM entries WHERE key = ?", (k,)).fetchone():
+                    existing.add(k)
+            new_items = [(k, v) for k, v in pending.items() if k not in existing][-self.max_entries:]
+            if not new_items:
+                return
+
+            count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            free = self.max_entries - count
+            slots: List[int] = list(range(count, count + min(free, len(new_items))))
+            evict = len(new_items) - len(slots)
+            if evict > 0:
+                victims = self._conn.execute(
+                    "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (evict,)
+                ).fetchall()
+                self._conn.executemany("DELETE FROM entries WHERE key = ?", ((k,) for k, _ in victims))
+                slots.extend(slot for _, slot in victims)
+            self._ensure_rows(max(slots) + 1)
+
+            # 向量在提交前写入并刷盘，其他进程在提交后才能看到这些行
+            clock = self._tick()
+            for (k, v), slot in zip(new_items, slots):
+                self._vectors[slot] = v
+            self._vectors.flush()
+            self._conn.executemany(
+                "INSERT INTO entries (key, slot, last_used) VALUES (?, ?, ?)",
+                ((k, slot, clock) for (k, _), slot in zip(new_items, slots))
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
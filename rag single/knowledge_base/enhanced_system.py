@@ -1,14 +1,26 @@
 import json
+import multiprocessing
 import os
+import queue
 import re
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Callable, Iterable, Iterator, Tuple
 
 import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from dataclasses import dataclass
 from enum import Enum
+
+from knowledge_base.meta_store import MetadataStore, Row
+from knowledge_base.lru import LRUCache
+from knowledge_base.bm25 import BM25Index, reciprocal_rank_fusion
+from knowledge_base.embedding_cache import EmbeddingCache
+from knowledge_base import index_factory
+from knowledge_base.index_factory import IndexConfig
+from knowledge_base.snapshots import SnapshotStore
 try:
     from langchain.schema import Document
 except Exception:
@@ -169,59 +181,358 @@ class DotsHierarchicalChunker:
 
 # --- From enhanced_rag_system.py ---
 
+# (document, id, metadata)
+Record = Tuple[str, str, Dict[str, Any]]
+
+
+def _length_sorted_batches(records: List[Record], batch_size: int) -> Iterator[List[Record]]:
+    """Split records into batches of similar text length to minimise padding."""
+    ordered = sorted(records, key=lambda r: len(r[0]), reverse=True)
+    for i in range(0, len(ordered), batch_size):
+        yield ordered[i:i + batch_size]
+
+
+def _exact_search(queries: np.ndarray, vectors: np.ndarray, vids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Brute-force inner-product top-k over a candidate set, in FAISS's (scores, ids) layout."""
+    scores = queries @ vectors.T
+    top = np.argsort(-scores, axis=1)[:, :k]
+    out_scores = np.full((len(queries), k), -np.finfo('float32').max, dtype='float32')
+    out_ids = np.full((len(queries), k), -1, dtype='int64')
+    out_scores[:, :top.shape[1]] = np.take_along_axis(scores, top, axis=1)
+    out_ids[:, :top.shape[1]] = vids[top]
+    return out_scores, out_ids
+
+
+def print_progress(done: int, total: int):
+    """Progress callback that reproduces the console output of earlier versions."""
+    print(f"  [EnhancedVectorStore] Embedded {done}/{total} chunks")
+
+
 class EnhancedVectorStore:
-    """Enhanced vector store backed by FAISS (cosine) with metadata sidecar."""
+    """Enhanced vector store backed by FAISS (cosine) with a SQLite metadata store."""
+
+    # 每次 encode 的文档数；SentenceTransformer 在 CPU 上 64-256 之间吞吐最好
+    DEFAULT_BATCH_SIZE = 128
+    # 按长度排序的窗口（以批次数计）与生产者/消费者队列深度
+    SORT_WINDOW_BATCHES = 8
+    PIPELINE_DEPTH = 4
+    # 查询向量 / top-k 结果缓存条目数（结果缓存在索引变更时清空）
+    QUERY_CACHE_SIZE = 1024
+    # 检索模式：dense 只用向量；hybrid 用 RRF 融合向量与 BM25 结果，
+    # 两路各取 max(top_k * HYBRID_DEPTH_FACTOR, HYBRID_MIN_DEPTH) 个候选
+    SEARCH_MODES = ("dense", "hybrid")
+    HYBRID_DEPTH_FACTOR = 4
+    HYBRID_MIN_DEPTH = 20
+    # 元数据过滤命中的 chunk 数不超过该值时精确打分，否则用 FAISS IDSelector 过滤搜索
+    FILTER_EXACT_MAX = 4096
+    # 以 mmap 只读方式打开磁盘上的索引（IVF 倒排表直接映射文件，多个 worker 共享页缓存，
+    # 启动时间与语料规模无关）；首次写入前再完整读入内存
+    MMAP_ENV = "KB_INDEX_MMAP"
+    # 读者检查快照指针文件的最小间隔（秒）：其他进程发布的新索引最多延迟这么久可见
+    SNAPSHOT_POLL_SECONDS = float(os.getenv("KB_SNAPSHOT_POLL_S", 1.0))
     
-    def __init__(self, persist_directory: str, collection_name: str = "document_chunks"):
-        # collection_name kept for compatibility; not used in FAISS persistence
+    def __init__(self, persist_directory: str, collection_name: str = "document_chunks", embedding_model=None,
+                 index_config: Optional[IndexConfig] = None, batch_size: Optional[int] = None,
+                 embedding_model_name: Optional[str] = None, embedding_cache: Optional[EmbeddingCache] = None,
+                 mmap: Optional[bool] = None):
+        self.collection_name = collection_name
         self.persist_directory = Path(persist_directory)
         self.persist_directory.mkdir(parents=True, exist_ok=True)
-        self.index_path = self.persist_directory / f"{collection_name}.faiss"
+        # 单写者 / 多读者：索引以不可变的版本化快照发布，元数据库由 SQLite WAL 在进程间共享
+        self.snapshots = SnapshotStore(self.persist_directory, collection_name)
+        # 快照化之前的索引文件，仅用于迁移
+        self.legacy_index_path = self.persist_directory / f"{collection_name}.faiss"
+        # 旧版 JSON sidecar，仅用于迁移
         self.meta_path = self.persist_directory / f"{collection_name}_meta.json"
+        self.db_path = self.persist_directory / f"{collection_name}_meta.sqlite"
+        self.config_path = self.persist_directory / f"{collection_name}_index.json"
+
+        # 索引类型配置按集合持久化；显式传入时覆盖已保存的配置
+        if index_config is None:
+            index_config = IndexConfig.load(self.config_path) if self.config_path.exists() else IndexConfig()
+        self.index_config = index_config
+        self.index_config.save(self.config_path)
 
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+        # 嵌入模型与嵌入缓存由进程级注册表共享，避免每个实例重复加载
+        from knowledge_base.registry import DEFAULT_EMBEDDING_MODEL, get_embedding_model, get_embedding_cache
+        self.embedding_model_name = embedding_model_name or DEFAULT_EMBEDDING_MODEL
+        if embedding_model is None:
+            embedding_model = get_embedding_model(self.embedding_model_name)
+        self.embedding_model = embedding_model
+        # 缓存目录放在持久化目录的上一级，使重建到新目录时仍能复用已计算的向量
+        if embedding_cache is None:
+            embedding_cache = get_embedding_cache(
+                str(self.persist_directory.parent / "embedding_cache"), self.embedding_model_name
+            )
+        self.embedding_cache = embedding_cache
+        self.batch_size = batch_size or int(os.getenv("KB_EMBED_BATCH_SIZE", self.DEFAULT_BATCH_SIZE))
         self.index: Optional[faiss.Index] = None
-        self.documents: List[str] = []
-        self.metadatas: List[Dict[str, Any]] = []
-        self.ids: List[str] = []
+        if mmap is None:
+            mmap = os.getenv(self.MMAP_ENV, "1").strip().lower() not in ("0", "false", "no", "off")
+        self.mmap = mmap
+        # 以 mmap 方式读入的索引对象；它是只读的（写入会在 C++ 层直接中止进程），
+        # 所有修改前必须经 _ensure_writable 换成内存中的副本
+        self._mapped_index: Optional[faiss.Index] = None
+        # 当前加载的快照 id、元数据库文件的 inode（--full 重建替换目录后需要重新打开）、下次检查指针的时间
+        self._snapshot: Optional[str] = None
+        self._meta_inode: Optional[int] = None
+        self._next_poll = 0.0
+        # 文档 / 元数据按稳定 int64 id（FAISS IndexIDMap2 中的 id，即 vid）存放在 SQLite 中
+        self.meta: Optional[MetadataStore] = None
+        self._next_vid = 0
+        self._lists_cache = None
+        self._query_cache = LRUCache(self.QUERY_CACHE_SIZE)
+        self._result_cache = LRUCache(self.QUERY_CACHE_SIZE)
+        # 过滤条件 → (vids, bitmap)，按索引版本缓存
+        self._filter_cache = LRUCache(64)
+        # BM25 倒排索引：首次 hybrid 查询时从元数据库构建，之后随写入 / 删除增量更新
+        self._bm25: Optional[BM25Index] = None
+        # 索引版本号：每次变更递增，结果缓存按版本区分
+        self._version = 0
+        # 保护索引与元数据的写入；检索只在 FAISS search 期间短暂持有
+        self._lock = threading.RLock()
 
         self._load()
 
+    def _new_index(self, sample: np.ndarray) -> faiss.Index:
+        """
+        创建带稳定 id 的空索引（需要训练的类型先从 flat 开始，达到阈值后迁移）；
+        int8 存储在首次写入的向量 `sample` 达到 min_train_size 时用它训练取值范围，否则先用 float32
+        """
+        index_type = index_factory.resolve_type(self.index_config, 0)
+        if index_factory.needs_training(index_type):
+            index_type = "flat"
+        return index_factory.create_index(self.index_config, sample.shape[1], index_type, train_vectors=sample)
+
+    def _maybe_migrate(self):
+        """语料规模跨过阈值（或配置的索引类型 / 存储精度变化）时，用已存向量重建索引"""
+        target = self._migration_target()
+        if target is None:
+            return
+        current = index_factory.index_type_of(self.index)
+        storage = index_factory.storage_of(self.index)
+        print(f"  [EnhancedVectorStore] Migrating index {current}/{storage} -> "
+              f"{target}/{index_factory.storage_for(self.index_config, target, self.index.ntotal)} "
+              f"({self.index.ntotal} vectors)...")
+        self.index = index_factory.rebuild(self.index_config, self.index, self.meta.all_vids(), target)
+
+    def _migration_target(self) -> Optional[str]:
+        if self.index is None:
+            return None
+        return index_factory.should_migrate(self.index_config, index_factory.index_type_of(self.index),
+                                            self.index.ntotal, index_factory.storage_of(self.index))
+
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """调整 IVF nprobe / HNSW efSearch（召回率与延迟的权衡）"""
+        with self._lock:
+            if nprobe:
+                self.index_config.nprobe = nprobe
+            if ef_search:
+                self.index_config.ef_search = ef_search
+            index_factory.apply_search_params(self.index, self.index_config)
+            self._version += 1
+            self._result_cache.clear()
+
+    # 向后兼容的完整列表视图：仅在调用方真正访问时才从 SQLite 加载
+    def _all_lists(self):
+        if self._lists_cache is None:
+            rows = list(self.meta.iter_rows())
+            self._lists_cache = (
+                [r[0] for r in rows],
+                [r[1] for r in rows],
+                [r[2] for r in rows],
+                [r[3] for r in rows],
+            )
+        return self._lists_cache
+
+    @property
+    def vids(self) -> List[int]:
+        return self._all_lists()[0]
+
+    @property
+    def ids(self) -> List[str]:
+        return self._all_lists()[1]
+
+    @property
+    def documents(self) -> List[str]:
+        return self._all_lists()[2]
+
+    @property
+    def metadatas(self) -> List[Dict[str, Any]]:
+        return self._all_lists()[3]
+
     def _load(self):
-        """Load FAISS index and metadata if present."""
-        if self.index_path.exists() and self.meta_path.exists():
-            self.index_path.parent.mkdir(parents=True, exist_ok=True)
-            self.index = faiss.read_index(self.index_path.as_posix())
-            with open(self.meta_path, "r", encoding="utf-8") as f:
-                meta = json.load(f)
-            self.documents = meta.get("documents", [])
-            self.metadatas = meta.get("metadatas", [])
-            self.ids = meta.get("ids", [])
+        """Open the metadata store and load the published index snapshot (migrating old layouts if needed)."""
+        migrate = not self.db_path.exists() and self.meta_path.exists()
+        self.meta = MetadataStore(self.db_path.as_posix())
+        if migrate:
+            with self.snapshots.writer_lock():
+                print("  [EnhancedVectorStore] Migrating JSON metadata sidecar to SQLite...")
+                count = self.meta.import_json(self.meta_path.as_posix())
+                self.meta_path.replace(self.meta_path.with_name(self.meta_path.name + ".migrated"))
+                print(f"  [EnhancedVectorStore] Migrated {count} entries.")
+        self._next_vid = int(self.meta.get_state("next_vid", "0"))
+        self._meta_inode = self._db_inode()
+
+        if self._needs_recovery():
+            with self.snapshots.writer_lock():
+                self._recover()
+        self._load_snapshot(self.snapshots.current(), self.mmap)
+        self._next_poll = time.monotonic() + self.SNAPSHOT_POLL_SECONDS
+        if self.index is None:
+            return
+
+        legacy = not isinstance(self.index, (faiss.IndexIDMap2, faiss.IndexIVF))
+        if legacy or self._migration_target() is not None:
+            with self._writing():
+                # 旧格式索引（顺序位置即 id）：直接取出已存向量包装为 IndexIDMap2，无需重新编码
+                if not isinstance(self.index, (faiss.IndexIDMap2, faiss.IndexIVF)):
+                    print("  [EnhancedVectorStore] Migrating index to stable int64 ids...")
+                    vectors = self.index.reconstruct_n(0, self.index.ntotal)
+                    self.index = index_factory.create_index(self.index_config, self.index.d, "flat",
+                                                            train_vectors=vectors)
+                    self.index.add_with_ids(vectors, np.asarray(self.vids, dtype='int64'))
+                    self._persist()
+                current = self.index
+                self._maybe_migrate()
+                if self.index is not current:
+                    self._persist()
+        index_factory.apply_search_params(self.index, self.index_config)
+
+    def _db_inode(self) -> Optional[int]:
+        try:
+            return os.stat(self.db_path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _needs_recovery(self) -> bool:
+        """Whether the on-disk layout predates snapshots, or a writer died between commit and publish."""
+        current = self.snapshots.current()
+        if current is None and self.legacy_index_path.exists():
+            return True
+        committed = self.meta.get_state("snapshot")
+        return bool(committed) and committed != current and self.snapshots.exists(committed)
+
+    def _recover(self):
+        """Caller holds the writer lock; re-checks because another process may have recovered first."""
+        current = self.snapshots.current()
+        if current is None and self.legacy_index_path.exists():
+            print("  [EnhancedVectorStore] Moving index into a versioned snapshot...")
+            current = self.snapshots.adopt(self.legacy_index_path)
+        # 元数据已提交但指针未发布（写者在两步之间退出）：元数据记录的快照才是一致的版本
+        committed = self.meta.get_state("snapshot")
+        if committed and committed != current and self.snapshots.exists(committed):
+            print(f"  [EnhancedVectorStore] Publishing committed snapshot {committed}...")
+            self.snapshots.publish(committed)
+
+    def _load_snapshot(self, snapshot: Optional[str], mmap: bool):
+        """Load `snapshot` as the current index (caller holds the lock or is still constructing)."""
+        if snapshot is not None and not self.meta.is_empty():
+            for attempt in range(3):
+                try:
+                    self.index = self._read_index(self.snapshots.index_path(snapshot), mmap)
+                    break
+                except RuntimeError:
+                    # 读到指针后、打开文件前快照已被清理：改读最新发布的快照
+                    latest = self.snapshots.current()
+                    if latest == snapshot or attempt == 2:
+                        raise
+                    snapshot = latest
         else:
             self.index = None
-            self.documents = []
-            self.metadatas = []
-            self.ids = []
+        self._snapshot = snapshot
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Hot-swap to the index snapshot most recently published by any process.
+        Searches call this at most once per SNAPSHOT_POLL_SECONDS; returns True
+        if a new snapshot (or a replaced metadata database) was loaded.
+        """
+        now = time.monotonic()
+        if not force and now < self._next_poll:
+            return False
+        self._next_poll = now + self.SNAPSHOT_POLL_SECONDS
+        if self.snapshots.current() == self._snapshot and self._db_inode() == self._meta_inode:
+            return False
+        with self._lock:
+            snapshot = self.snapshots.current()
+            inode = self._db_inode()
+            if snapshot == self._snapshot and inode == self._meta_inode:
+                return False
+            if inode != self._meta_inode:
+                # 整个目录被 --full 重建替换：旧连接仍指向已删除的文件，重新打开
+                self.meta = MetadataStore(self.db_path.as_posix())
+                self._meta_inode = inode
+            self._next_vid = int(self.meta.get_state("next_vid", "0"))
+            self._load_snapshot(snapshot, self.mmap)
+            if self.index is not None:
+                index_factory.apply_search_params(self.index, self.index_config)
+            # 其他进程的写入不经过本进程的 BM25 增量更新：丢弃，下次 hybrid 查询时重建
+            self._bm25 = None
+            self._invalidate()
+        print(f"  [EnhancedVectorStore] Switched to index snapshot {snapshot}")
+        return True
+
+    @contextmanager
+    def _writing(self):
+        """
+        Write section: holds the store lock and the inter-process writer lock, and
+        starts from the latest published snapshot (loaded into memory, since a
+        memory-mapped index is read-only) with the id counter other writers left.
+        """
+        with self._lock, self.snapshots.writer_lock():
+            self.refresh(force=True)
+            self._next_vid = int(self.meta.get_state("next_vid", "0"))
+            self._ensure_writable()
+            yield
+
+    def _read_index(self, path: Path, mmap: bool) -> faiss.Index:
+        """
+        Read an index snapshot. With `mmap`, vector data that FAISS can map
+        (IVF inverted lists; flat codes too on FAISS builds with IO_FLAG_MMAP_IFC)
+        stays in the file and is paged in on demand; other index types are read
+        into memory as usual.
+        """
+        if not mmap:
+            return faiss.read_index(path.as_posix())
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        index = faiss.read_index(path.as_posix(), flags)
+        self._mapped_index = index
+        return index
+
+    def _ensure_writable(self):
+        """Swap a memory-mapped index for an in-memory copy before mutating it (caller holds the lock)."""
+        if self.index is not None and self.index is self._mapped_index:
+            print("  [EnhancedVectorStore] Loading memory-mapped index into memory for writing...")
+            self._load_snapshot(self._snapshot, mmap=False)
+            index_factory.apply_search_params(self.index, self.index_config)
+        self._mapped_index = None
 
     def _persist(self):
-        """Persist FAISS index and metadata."""
-        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        """
+        Publish the FAISS index as a new snapshot (caller is inside `_writing`):
+        write the snapshot, commit metadata together with its id, then point
+        readers at it.
+        """
+        snapshot = None
         if self.index is not None:
-            faiss.write_index(self.index, self.index_path.as_posix())
-        with open(self.meta_path, "w", encoding="utf-8") as f:
-            json.dump({
-                "documents": self.documents,
-                "metadatas": self.metadatas,
-                "ids": self.ids,
-            }, f, ensure_ascii=False, indent=2)
-    
-    def add_chunks(self, chunks: Dict[int, DotsChunk], source_file: str = ""):
-        """Add chunks to the vector store with enhanced context preservation"""
-        print(f"  [EnhancedVectorStore] Received {len(chunks)} chunks, preparing to process...")
-        documents = []
-        ids = []
-        metadatas = []
-        
+            snapshot = self.snapshots.write(self.index)
+            self.meta.set_state("snapshot", snapshot, commit=False)
+        self.meta.set_state("next_vid", self._next_vid, commit=False)
+        self.meta.commit()
+        if snapshot is not None:
+            self.snapshots.publish(snapshot)
+            self._snapshot = snapshot
+            self.snapshots.prune()
+        self._invalidate()
+
+    def _invalidate(self):
+        self._lists_cache = None
+        self._version += 1
+        self._result_cache.clear()
+
+    def _iter_records(self, chunks: Dict[int, DotsChunk], source_file: str) -> Iterator[Record]:
+        """Yield (document, id, metadata) for each chunk, with hierarchical context prepended."""
         for chunk_id, chunk in chunks.items():
             # Prepare document content with enhanced context
             context_parts = []
@@ -254,98 +565,453 @@ class EnhancedVectorStore:
                 "context_str": " > ".join([chunks[h].text for h in chunk.headings if h in chunks])
             }
             
-            documents.append(full_context)
-            ids.append(f"{source_file}_chunk_{chunk_id}")
-            metadatas.append(metadata)
-        
-        if documents:
-            print(f"  [EnhancedVectorStore] Generating Embeddings (Document count: {len(documents)})...")
+            yield full_context, f"{source_file}_chunk_{chunk_id}", metadata
+
+    def _batches(self, records: Iterable[Record], batch_size: int) -> Iterator[List[Record]]:
+        """
+        Producer/consumer pipeline: a background thread assembles records into
+        length-sorted batches (less padding per batch) while the calling thread
+        encodes the previous ones.
+        """
+        out: "queue.Queue" = queue.Queue(maxsize=self.PIPELINE_DEPTH)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def produce():
             try:
-                # 分批处理，减小单次写入压力
-                batch_size = 5
-                total_docs = len(documents)
-                total_batches = (total_docs + batch_size - 1) // batch_size
-                
-                for i in range(0, total_docs, batch_size):
-                    end_idx = min(i + batch_size, total_docs)
-                    batch_no = i // batch_size + 1
-                    print(f"  [EnhancedVectorStore] Processing batch {batch_no}/{total_batches} (Documents {i+1}-{end_idx})...")
-                    
-                    batch_docs = documents[i:end_idx]
-                    batch_ids = ids[i:end_idx]
-                    batch_metadatas = metadatas[i:end_idx]
-                    
-                    try:
-                        print("    [EnhancedVectorStore] Starting batch Embedding calculation...")
-                        batch_embeddings = self.embedding_model.encode(batch_docs)
-                        # Normalize for cosine similarity
-                        batch_embeddings = batch_embeddings / np.linalg.norm(batch_embeddings, axis=1, keepdims=True)
-
-                        # Initialize index lazily with correct dim
-                        if self.index is None:
-                            dim = batch_embeddings.shape[1]
-                            self.index = faiss.IndexFlatIP(dim)
-
-                        # Append to in-memory stores
-                        self.documents.extend(batch_docs)
-                        self.metadatas.extend(batch_metadatas)
-                        self.ids.extend(batch_ids)
-
-                        # Add to index
-                        self.index.add(batch_embeddings.astype('float32'))
-                        print(f"    [EnhancedVectorStore] Batch {batch_no} written successfully.")
-                    except Exception as e:
-                        import traceback
-                        print(f"    [EnhancedVectorStore] Batch {batch_no} write failed: {e}")
-                        traceback.print_exc()
-                        raise e
-                
-                # Persist after all batches to avoid partial writes
-                self._persist()
-                print(f"  [EnhancedVectorStore] All {total_docs} chunks successfully written to vector store.")
-            except Exception as e:
-                print(f"  [EnhancedVectorStore] Write failed: {e}")
-                raise e
-        else:
+                window: List[Record] = []
+                window_size = batch_size * self.SORT_WINDOW_BATCHES
+                for record in records:
+                    window.append(record)
+                    if len(window) >= window_size:
+                        for batch in _length_sorted_batches(window, batch_size):
+                            put(batch)
+                        window = []
+                for batch in _length_sorted_batches(window, batch_size):
+                    put(batch)
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        producer = threading.Thread(target=produce, name="embed-producer", daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = out.get()
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+    def _encode(self, texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        embeddings = self.embedding_model.encode(texts, batch_size=batch_size or self.batch_size)
+        # Normalize for cosine similarity
+        return (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).astype('float32')
+
+    def _embed_documents(self, documents: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        """Encode documents, skipping the model for texts already in the embedding cache."""
+        if self.embedding_cache is None:
+            return self._encode(documents, batch_size)
+        keys = [EmbeddingCache.key(d) for d in documents]
+        hits = self.embedding_cache.get_many(keys)
+        misses = [i for i in range(len(documents)) if i not in hits]
+        encoded = None
+        if misses:
+            encoded = self._encode([documents[i] for i in misses], batch_size)
+            self.embedding_cache.put_many([keys[i] for i in misses], encoded)
+        dim = encoded.shape[1] if encoded is not None else len(next(iter(hits.values())))
+        out = np.empty((len(documents), dim), dtype='float32')
+        for pos, vector in hits.items():
+            out[pos] = vector
+        if encoded is not None:
+            out[misses] = encoded
+        return out
+
+    def add_chunks(self, chunks: Dict[int, DotsChunk], source_file: str = "",
+                   batch_size: Optional[int] = None,
+                   progress: Optional[Callable[[int, int], None]] = None) -> int:
+        """Add chunks to the vector store with enhanced context preservation"""
+        print(f"  [EnhancedVectorStore] Received {len(chunks)} chunks, preparing to process...")
+        return self.add_records(self._iter_records(chunks, source_file), total=len(chunks),
+                                batch_size=batch_size, progress=progress)
+
+    def add_records(self, records: Iterable[Record], total: Optional[int] = None,
+                    batch_size: Optional[int] = None,
+                    progress: Optional[Callable[[int, int], None]] = None) -> int:
+        """
+        Embed and index (document, id, metadata) records.
+        `progress(done, total)` is called after each encoded batch; returns the number of records written.
+
+        Encoding runs without holding the store lock, so concurrent writers only
+        serialize on the short index/metadata update at the end.
+        """
+        embedded, done = self._embed_records(records, total, batch_size, progress)
+        if not done:
             print("  [EnhancedVectorStore] No documents generated, skipping write.")
+            return 0
+        self._write(embedded)
+        print(f"  [EnhancedVectorStore] All {done} chunks successfully written to vector store.")
+        return done
+
+    def upsert_chunks(self, chunks: Dict[int, DotsChunk], source_file: str = "",
+                      batch_size: Optional[int] = None,
+                      progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, int]:
+        """
+        Replace the stored chunks of `source_file` with `chunks`, diffing by content hash.
+
+        Chunks whose embedded text is unchanged keep their vector (only id/metadata
+        rows are rewritten if e.g. the chunk index shifted); only new or changed
+        chunks are embedded, and stored chunks that no longer appear are removed.
+        Returns counts: added / updated / unchanged / removed.
+        """
+        return self.upsert_sources({source_file: chunks}, batch_size, progress)[source_file]
+
+    def upsert_sources(self, sources: Dict[str, Dict[int, DotsChunk]],
+                       batch_size: Optional[int] = None,
+                       progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, Dict[str, int]]:
+        """
+        Upsert several sources at once (an empty chunk dict removes the source).
+        New chunks of all sources are embedded in shared batches and written with
+        a single persist; returns per-source counts as in `upsert_chunks`.
+
+        Embedding runs without the lock against a first diff; the diff is then
+        recomputed inside the write section, so concurrent upserts of the same
+        source (ingest workers, the build script) never insert a chunk twice.
+        """
+        batch_size = batch_size or self.batch_size
+        _, candidates, _, _ = self._diff_sources(sources)
+        embedded, _ = self._embed_records(candidates, len(candidates), batch_size, progress)
+        vectors: Dict[str, np.ndarray] = {}
+        for batch, batch_embeddings in embedded:
+            for record, vector in zip(batch, batch_embeddings):
+                vectors[EmbeddingCache.key(record[0])] = vector
+
+        with self._writing():
+            stats, new_records, updated_rows, stale_vids = self._diff_sources(sources, log=True)
+            # 加锁前已匹配、期间被其他写入删除的 chunk 没有预先编码，在锁内补编码（少见）
+            missing = sorted({r[0] for r in new_records if EmbeddingCache.key(r[0]) not in vectors})
+            if missing:
+                for document, vector in zip(missing, self._embed_documents(missing, batch_size)):
+                    vectors[EmbeddingCache.key(document)] = vector
+            batches = [new_records[i:i + batch_size] for i in range(0, len(new_records), batch_size)]
+            embedded = [(batch, np.vstack([vectors[EmbeddingCache.key(r[0])] for r in batch])) for batch in batches]
+            if embedded or updated_rows or stale_vids:
+                self._apply_write(embedded, updated_rows=updated_rows, drop_vids=sorted(stale_vids))
+        return stats
 
-    def retrieve(self, query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-        """Retrieve relevant chunks based on query with full information"""
-        if self.index is None or not self.ids:
-            return []
+    def _diff_sources(self, sources: Dict[str, Dict[int, DotsChunk]], log: bool = False
+                      ) -> Tuple[Dict[str, Dict[str, int]], List[Record], List[Row], List[int]]:
+        """Compare chunks with stored rows: (per-source stats, new records, rows to rewrite, stale vids)."""
+        # 已存 chunk 按 (source, 内容哈希) 分组（同一文档内可能有重复文本）
+        stored: Dict[str, Dict[str, List[Row]]] = {source: {} for source in sources}
+        rows = self.meta.get_rows(self.meta.vids_where({"source": {"$in": list(sources)}}))
+        for vid in sorted(rows):
+            row = rows[vid]
+            stored[row[3].get("source")].setdefault(EmbeddingCache.key(row[2]), []).append(row)
 
-        query_embedding = self.embedding_model.encode([query])
-        query_embedding = query_embedding / np.linalg.norm(query_embedding, axis=1, keepdims=True)
-        scores, idxs = self.index.search(query_embedding.astype('float32'), top_k)
+        new_records: List[Record] = []
+        updated_rows: List[Row] = []
+        stale_vids: List[int] = []
+        stats: Dict[str, Dict[str, int]] = {}
+        for source_file, chunks in sources.items():
+            added = updated = unchanged = 0
+            for document, chunk_id, metadata in self._iter_records(chunks, source_file):
+                matches = stored[source_file].get(EmbeddingCache.key(document))
+                if matches:
+                    vid, old_id, _, old_metadata = matches.pop()
+                    if old_id == chunk_id and old_metadata == metadata:
+                        unchanged += 1
+                    else:
+                        updated_rows.append((vid, chunk_id, document, metadata))
+                        updated += 1
+                else:
+                    new_records.append((document, chunk_id, metadata))
+                    added += 1
+            stale = [row[0] for rows in stored[source_file].values() for row in rows]
+            stale_vids.extend(stale)
+            stats[source_file] = {"added": added, "updated": updated, "unchanged": unchanged, "removed": len(stale)}
+            if log:
+                print(f"  [EnhancedVectorStore] Upsert {source_file}: {added} new, "
+                      f"{updated} moved, {unchanged} unchanged, {len(stale)} stale")
+        return stats, new_records, updated_rows, stale_vids
 
+    def _embed_records(self, records: Iterable[Record], total: Optional[int] = None,
+                       batch_size: Optional[int] = None,
+                       progress: Optional[Callable[[int, int], None]] = None
+                       ) -> Tuple[List[Tuple[List[Record], np.ndarray]], int]:
+        """Encoding phase (no lock held): returns [(batch, embeddings)] and the record count."""
+        batch_size = batch_size or self.batch_size
+        embedded: List[Tuple[List[Record], np.ndarray]] = []
+        done = 0
+        for batch in self._batches(records, batch_size):
+            embedded.append((batch, self._embed_documents([r[0] for r in batch], batch_size)))
+            done += len(batch)
+            if progress:
+                progress(done, total or done)
+        return embedded, done
+
+    def _write(self, embedded: List[Tuple[List[Record], np.ndarray]],
+               updated_rows: Iterable[Row] = (), drop_vids: List[int] = ()):
+        """Write phase: `_apply_write` inside the write section."""
+        with self._writing():
+            self._apply_write(embedded, updated_rows, drop_vids)
+
+    def _apply_write(self, embedded: List[Tuple[List[Record], np.ndarray]],
+                     updated_rows: Iterable[Row] = (), drop_vids: List[int] = ()):
+        """
+        Add embedded batches, rewrite metadata rows in place and drop vids, then
+        persist once (caller is inside `_writing`). On failure the metadata
+        transaction is rolled back and added vectors are removed again.
+        """
+        updated_rows = list(updated_rows)
+        added_vids: List[int] = []
+        added_docs: List[str] = []
+        try:
+            # Initialize index lazily with correct dim (sample vectors train int8 ranges)
+            if self.index is None and embedded:
+                sample = np.vstack([e for _, e in embedded])[:self.index_config.train_size]
+                self.index = self._new_index(sample)
+
+            for batch, batch_embeddings in embedded:
+                batch_docs = [r[0] for r in batch]
+                batch_ids = [r[1] for r in batch]
+                batch_metadatas = [r[2] for r in batch]
+
+                # Allocate stable ids
+                batch_vids = list(range(self._next_vid, self._next_vid + len(batch_docs)))
+                self._next_vid += len(batch_docs)
+
+                # Add to index, stage metadata rows (committed in _persist)
+                self.index.add_with_ids(batch_embeddings, np.asarray(batch_vids, dtype='int64'))
+                added_vids.extend(batch_vids)
+                added_docs.extend(batch_docs)
+                self.meta.append(zip(batch_vids, batch_ids, batch_docs, batch_metadatas), commit=False)
+
+            # 向量不变的行只改写 id / 元数据
+            self.meta.append(updated_rows, commit=False)
+            if drop_vids:
+                self.meta.delete(drop_vids, commit=False)
+                self._remove_vids(drop_vids)
+
+            # Persist after all batches to avoid partial writes
+            self._maybe_migrate()
+            self._persist()
+        except Exception as e:
+            print(f"  [EnhancedVectorStore] Write failed: {e}")
+            self._rollback()
+            raise e
+
+        if self._bm25 is not None:
+            for vid in drop_vids:
+                self._bm25.remove(vid)
+            self._bm25.add_many(zip(added_vids, added_docs))
+            self._bm25.add_many((row[0], row[2]) for row in updated_rows)
+
+    def _rollback(self):
+        """Undo a failed write (caller is inside `_writing`): roll back the metadata transaction and reload the published snapshot."""
+        self.meta.rollback()
+        self._load_snapshot(self._snapshot, mmap=False)
+        if self.index is not None:
+            index_factory.apply_search_params(self.index, self.index_config)
+
+    def _remove_vids(self, vids: List[int]):
+        """Remove vectors by stable id (caller holds the lock and has already updated metadata)."""
+        if index_factory.supports_remove(self.index):
+            self.index.remove_ids(np.asarray(vids, dtype='int64'))
+        else:
+            # HNSW 不支持删除：用剩余向量重建（仍无需重新编码）
+            self.index = index_factory.rebuild(
+                self.index_config, self.index, self.meta.all_vids(), index_factory.index_type_of(self.index)
+            )
+
+    @staticmethod
+    def _query_key(query: str) -> str:
+        """Normalize whitespace so trivially different spellings of a query share cache entries."""
+        return " ".join(query.split())
+
+    def embed_query(self, query: str) -> np.ndarray:
+        """Normalized query embedding, sharing the LRU cache used by search."""
+        return self._embed_query(query)
+
+    @property
+    def index_version(self) -> str:
+        """Id of the index snapshot being served; changes whenever any process writes the collection."""
+        self.refresh()
+        return self._snapshot or ""
+
+    def _embed_query(self, query: str) -> np.ndarray:
+        """Normalized query vector, served from the LRU cache when possible."""
+        key = self._query_key(query)
+        vector = self._query_cache.get(key)
+        if vector is None:
+            vector = self._encode([key])[0]
+            self._query_cache.put(key, vector)
+        return vector
+
+    @staticmethod
+    def _filter_key(where: Optional[Dict[str, Any]]) -> Optional[str]:
+        return json.dumps(where, sort_keys=True, ensure_ascii=False) if where else None
+
+    def _allowed(self, where: Optional[Dict[str, Any]]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Resolve a metadata filter to (sorted vids, vid bitmap) via the metadata
+        store's secondary indexes; cached per index version. Caller holds the lock.
+        """
+        if not where:
+            return None
+        key = (self._filter_key(where), self._version)
+        allowed = self._filter_cache.get(key)
+        if allowed is None:
+            vids = np.asarray(self.meta.vids_where(where), dtype='int64')
+            mask = np.zeros(max(self._next_vid, int(vids[-1]) + 1 if len(vids) else 0), dtype=bool)
+            mask[vids] = True
+            allowed = (vids, np.packbits(mask, bitorder='little'))
+            self._filter_cache.put(key, allowed)
+        return allowed
+
+    def _index_search(self, vectors: np.ndarray, k: int,
+                      allowed: Optional[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+        """FAISS search, restricted to the `allowed` vids through an IDSelector (caller holds the lock)."""
+        if allowed is None:
+            return self.index.search(vectors, k)
+        vids, bitmap = allowed
+        if len(vids) <= self.FILTER_EXACT_MAX:
+            # 候选集很小时直接取出向量精确打分，避免 IVF / HNSW 在稀疏过滤下漏召回
+            return _exact_search(vectors, index_factory.reconstruct(self.index, vids), vids, k)
+        sel = faiss.IDSelectorBitmap(len(bitmap) * 8, faiss.swig_ptr(bitmap))
+        params = index_factory.search_parameters(self.index, self.index_config, sel)
+        return self.index.search(vectors, k, params=params)
+
+    def _search_many(self, queries: List[str], k: int,
+                     where: Optional[Dict[str, Any]] = None) -> List[List[Tuple[int, float]]]:
+        """Shared query path: one model call for all uncached queries and one (filtered) FAISS search."""
+        if self.index is None or self.index.ntotal == 0:
+            return [[] for _ in queries]
+        keys = [self._query_key(q) for q in queries]
+        filter_key = self._filter_key(where)
+        results: List[Optional[List[Tuple[int, float]]]] = [
+            self._result_cache.get((key, k, filter_key, self._version)) for key in keys
+        ]
+        pending = sorted({key for key, hits in zip(keys, results) if hits is None})
+        if pending:
+            vectors = {key: self._query_cache.get(key) for key in pending}
+            to_encode = [key for key, vector in vectors.items() if vector is None]
+            if to_encode:
+                for key, vector in zip(to_encode, self._encode(to_encode)):
+                    vectors[key] = vector
+                    self._query_cache.put(key, vector)
+            with self._lock:
+                version = self._version
+                scores, idxs = self._index_search(np.vstack([vectors[key] for key in pending]), k,
+                                                  self._allowed(where))
+            searched = {}
+            for key, row_scores, row_idxs in zip(pending, scores, idxs):
+                hits = [(int(vid), float(score)) for score, vid in zip(row_scores, row_idxs) if vid >= 0]
+                self._result_cache.put((key, k, filter_key, version), hits)
+                searched[key] = hits
+            results = [hits if hits is not None else searched[key] for key, hits in zip(keys, results)]
+        return results
+
+    def _lexical_index(self) -> BM25Index:
+        """BM25 index over the embedded documents, built from the metadata store on first use."""
+        with self._lock:
+            if self._bm25 is None:
+                print(f"  [EnhancedVectorStore] Building BM25 index over {self.meta.count()} chunks...")
+                bm25 = BM25Index()
+                bm25.add_many((vid, document) for vid, _, document, _ in self.meta.iter_rows())
+                self._bm25 = bm25
+            return self._bm25
+
+    def _hybrid_depth(self, k: int) -> int:
+        return max(k * self.HYBRID_DEPTH_FACTOR, self.HYBRID_MIN_DEPTH)
+
+    def _search_hybrid_many(self, queries: List[str], k: int,
+                            where: Optional[Dict[str, Any]] = None) -> List[List[Tuple[int, float]]]:
+        """Dense + BM25 candidates fused with reciprocal-rank fusion; scores are RRF scores."""
+        keys = [self._query_key(q) for q in queries]
+        filter_key = self._filter_key(where)
+        version = self._version
+        results = [self._result_cache.get(("hybrid", key, k, filter_key, version)) for key in keys]
+        pending = [i for i, hits in enumerate(results) if hits is None]
+        if pending:
+            depth = self._hybrid_depth(k)
+            dense = self._search_many([keys[i] for i in pending], depth, where)
+            bm25 = self._lexical_index()
+            with self._lock:
+                allowed = self._allowed(where)
+                allowed_set = set(allowed[0].tolist()) if allowed is not None else None
+                lexical = [bm25.search(keys[i], depth, allowed_set) for i in pending]
+            for i, dense_hits, lexical_hits in zip(pending, dense, lexical):
+                results[i] = reciprocal_rank_fusion([dense_hits, lexical_hits], k)
+                self._result_cache.put(("hybrid", keys[i], k, filter_key, version), results[i])
+        return results
+
+    def _hits(self, query: str, k: int, mode: str,
+              where: Optional[Dict[str, Any]] = None) -> List[Tuple[int, float]]:
+        return self._hits_many([query], k, mode, where)[0]
+
+    def _hits_many(self, queries: List[str], k: int, mode: str,
+                   where: Optional[Dict[str, Any]] = None) -> List[List[Tuple[int, float]]]:
+        if mode not in self.SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode} (expected one of {self.SEARCH_MODES})")
+        self.refresh()
+        if mode == "hybrid":
+            return self._search_hybrid_many(queries, k, where)
+        return self._search_many(queries, k, where)
+
+    def _hit_rows(self, hits: List[Tuple[int, float]], rows: Optional[Dict[int, Row]] = None) -> List[Tuple[Row, float]]:
+        if rows is None:
+            rows = self.meta.get_rows([vid for vid, _ in hits])
+        return [(rows[vid], score) for vid, score in hits if vid in rows]
+
+    @staticmethod
+    def _format_hits(hit_rows: List[Tuple[Row, float]]) -> List[Dict[str, Any]]:
         formatted_results = []
-        for score, idx in zip(scores[0], idxs[0]):
-            if idx < 0 or idx >= len(self.ids):
-                continue
+        for (_, chunk_id, document, metadata), score in hit_rows:
             formatted_results.append({
-                "id": self.ids[idx],
-                "text": self.metadatas[idx].get("original_text", ""),
-                "metadata": self.metadatas[idx],
-                "score": float(score),
-                "full_doc": self.documents[idx]
+                "id": chunk_id,
+                "text": metadata.get("original_text", ""),
+                "metadata": metadata,
+                "score": score,
+                "full_doc": document
             })
         return formatted_results
 
-    # LangChain-style interface for existing routes
-    def similarity_search_with_score(self, query: str, k: int = 5):
-        """Return list of (Document, score) pairs; score is inner product (higher=better)."""
-        if self.index is None or not self.ids:
-            return []
+    def retrieve(self, query: str, top_k: int = 5, mode: str = "dense",
+                 filter: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        Retrieve relevant chunks based on query with full information (mode: dense / hybrid).
+        `filter` restricts the search to matching chunks, e.g. {"source": "a.pdf"} or
+        {"source": "a.pdf", "page_no": {"$gte": 2, "$lte": 5}}.
+        """
+        return self._format_hits(self._hit_rows(self._hits(query, top_k, mode, filter)))
 
-        query_embedding = self.embedding_model.encode([query])
-        query_embedding = query_embedding / np.linalg.norm(query_embedding, axis=1, keepdims=True)
-        scores, idxs = self.index.search(query_embedding.astype('float32'), k)
+    def retrieve_many(self, queries: List[str], top_k: int = 5, mode: str = "dense",
+                      filter: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        """Retrieve for several queries at once; returns one result list per query, in order."""
+        all_hits = self._hits_many(queries, top_k, mode, filter)
+        rows = self.meta.get_rows(sorted({vid for hits in all_hits for vid, _ in hits}))
+        return [self._format_hits(self._hit_rows(hits, rows)) for hits in all_hits]
 
+    # LangChain-style interface for existing routes
+    def similarity_search_with_score(self, query: str, k: int = 5, mode: str = "dense",
+                                     filter: Optional[Dict[str, Any]] = None):
+        """Return list of (Document, score) pairs; score is inner product (RRF score for hybrid), higher=better."""
         results = []
-        for score, idx in zip(scores[0], idxs[0]):
-            if idx < 0 or idx >= len(self.ids):
-                continue
-            meta = dict(self.metadatas[idx]) if isinstance(self.metadatas[idx], dict) else {}
+        for row, score in self._hit_rows(self._hits(query, k, mode, filter)):
+            meta = dict(row[3]) if isinstance(row[3], dict) else {}
             # Provide a title fallback for callers expecting it
             meta.setdefault("title", meta.get("source", ""))
             content = meta.get("original_text", "")
@@ -353,7 +1019,7 @@ class EnhancedVectorStore:
                 doc = Document(page_content=content, metadata=meta)
             else:
                 doc = type("Doc", (), {"page_content": content, "metadata": meta})()
-            results.append((doc, float(score)))
+            results.append((doc, score))
         return results
 
     def delete_document(self, source_file: str):
@@ -362,116 +1028,148 @@ class EnhancedVectorStore:
 
     # Thin wrappers used by KnowledgeBase for listing / deletion with filters
     def get(self, where: Optional[Dict[str, Any]] = None):
-        where = where or {}
-        matched = []
-        matched_ids = []
-        matched_docs = []
-        for i, meta in enumerate(self.metadatas):
-            if all(meta.get(k) == v for k, v in where.items()):
-                matched.append(meta)
-                matched_ids.append(self.ids[i])
-                matched_docs.append(self.documents[i])
-        return {"ids": matched_ids, "metadatas": matched, "documents": matched_docs}
+        rows = self.meta.get_rows(self.meta.vids_where(where or {}))
+        ordered = [rows[vid] for vid in sorted(rows)]
+        return {
+            "ids": [r[1] for r in ordered],
+            "metadatas": [r[3] for r in ordered],
+            "documents": [r[2] for r in ordered],
+        }
 
     def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None):
-        if self.index is None:
-            return
-        to_delete = set(ids or [])
-        if where:
-            for i, meta in enumerate(self.metadatas):
-                if all(meta.get(k) == v for k, v in where.items()):
-                    to_delete.add(self.ids[i])
+        def matching_vids():
+            vids = set(self.meta.vids_for_ids(ids or []))
+            if where:
+                vids.update(self.meta.vids_where(where))
+            return vids
 
-        if not to_delete:
+        # 没有匹配时不进入写入区（避免把 mmap 索引读入内存）
+        if not matching_vids():
             return
+        with self._writing():
+            # 在写锁内按最新快照重新解析，其他进程刚写入的 chunk 也会被删除
+            to_delete = matching_vids()
+            if not to_delete or self.index is None:
+                return
 
-        # Rebuild index without the deleted ids
-        keep_docs = []
-        keep_meta = []
-        keep_ids = []
-        keep_embs = []
-        for i, id_val in enumerate(self.ids):
-            if id_val in to_delete:
-                continue
-            keep_docs.append(self.documents[i])
-            keep_meta.append(self.metadatas[i])
-            keep_ids.append(id_val)
-            keep_embs.append(self.embedding_model.encode([self.documents[i]])[0])
-
-        if keep_embs:
-            embs = np.vstack(keep_embs)
-            embs = embs / np.linalg.norm(embs, axis=1, keepdims=True)
-            dim = embs.shape[1]
-            self.index = faiss.IndexFlatIP(dim)
-            self.index.add(embs.astype('float32'))
-        else:
-            self.index = None
-
-        self.documents = keep_docs
-        self.metadatas = keep_meta
-        self.ids = keep_ids
-        self._persist()
+            # 按稳定 id 从索引和元数据库中移除，代价只与删除数量相关，无需重新编码
+            drop_vids = sorted(to_delete)
+            try:
+                self.meta.delete(drop_vids, commit=False)
+                self._remove_vids(drop_vids)
+                self._persist()
+            except Exception as e:
+                print(f"  [EnhancedVectorStore] Delete failed: {e}")
+                self._rollback()
+                raise e
+            if self._bm25 is not None:
+                for vid in drop_vids:
+                    self._bm25.remove(vid)
 
 # --- PDF Processor ---
 
+def pool_context() -> multiprocessing.context.BaseContext:
+    """
+    Start method for process pools. Callers are usually multithreaded processes
+    with torch / FAISS loaded (the server's ingest threads, the build script);
+    a forked child can inherit a lock held by another thread and deadlock, so
+    children come from a forkserver (POSIX) or are spawned (Windows).
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def _layout_for_page(text: str, page_no: int) -> List[Dict[str, Any]]:
+    """Apply the line-level header heuristics to one page of extracted text."""
+    layout_info = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        
+        # Heuristic for headers:
+        # 1. Starts with # (Markdown style)
+        # 2. Short line (<= 50 chars) and doesn't end with punctuation (roughly)
+        # 3. All caps
+        
+        category = "Text"
+        processed_text = line
+        
+        if line.startswith('#'):
+            category = "Section-header"
+        elif len(line) < 50 and not line.endswith(('.', ',', ';')):
+            # Potential header
+            # If all caps, likely header
+            if line.isupper():
+                category = "Section-header"
+                # Add # for the chunker to recognize it
+                processed_text = f"# {line}"
+            # If it looks like "1. Introduction", likely header
+            elif re.match(r'^\d+\.?\s+[A-Z]', line):
+                category = "Section-header"
+                processed_text = f"# {line}"
+        
+        layout_info.append({
+            "text": processed_text,
+            "category": category,
+            "page_no": page_no
+        })
+    return layout_info
+
+
+def _extract_page_range(file_path: str, start: int, end: int) -> List[Dict[str, Any]]:
+    """Extract pages [start, end) into page dicts; runs inside worker processes."""
+    import pypdf
+    
+    reader = pypdf.PdfReader(file_path)
+    pages = []
+    for i in range(start, min(end, len(reader.pages))):
+        text = reader.pages[i].extract_text()
+        if not text:
+            continue
+        pages.append({
+            "page_no": i + 1,
+            "full_layout_info": _layout_for_page(text, i + 1)
+        })
+    return pages
+
+
 class PDFProcessor:
     """Converts PDF to the JSON structure expected by DotsHierarchicalChunker"""
+
+    # 少于该页数的分片不值得启动子进程
+    MIN_PAGES_PER_WORKER = 16
     
     @staticmethod
-    def process(file_path: str) -> List[Dict[str, Any]]:
+    def process(file_path: str, workers: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Extract text page by page. Large PDFs are split into contiguous page
+        ranges processed by a ProcessPoolExecutor; results are concatenated in
+        page order, so the output is identical to sequential extraction.
+        `workers` defaults to KB_PDF_WORKERS or the CPU count.
+        """
         import pypdf
         
-        json_doc = []
-        reader = pypdf.PdfReader(file_path)
+        num_pages = len(pypdf.PdfReader(file_path).pages)
+        if workers is None:
+            workers = int(os.getenv("KB_PDF_WORKERS", 0)) or os.cpu_count() or 1
+        workers = max(1, min(workers, num_pages // PDFProcessor.MIN_PAGES_PER_WORKER))
+        if workers == 1:
+            return _extract_page_range(file_path, 0, num_pages)
         
-        for i, page in enumerate(reader.pages):
-            text = page.extract_text()
-            if not text:
-                continue
-                
-            lines = text.split('\n')
-            layout_info = []
-            
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                
-                # Heuristic for headers:
-                # 1. Starts with # (Markdown style)
-                # 2. Short line (<= 50 chars) and doesn't end with punctuation (roughly)
-                # 3. All caps
-                
-                category = "Text"
-                processed_text = line
-                
-                is_header = False
-                if line.startswith('#'):
-                    is_header = True
-                    category = "Section-header"
-                elif len(line) < 50 and not line.endswith(('.', ',', ';')):
-                    # Potential header
-                    # If all caps, likely header
-                    if line.isupper():
-                        is_header = True
-                        category = "Section-header"
-                        # Add # for the chunker to recognize it
-                        processed_text = f"# {line}"
-                    # If it looks like "1. Introduction", likely header
-                    elif re.match(r'^\d+\.?\s+[A-Z]', line):
-                        is_header = True
-                        category = "Section-header"
-                        processed_text = f"# {line}"
-                
-                layout_info.append({
-                    "text": processed_text,
-                    "category": category,
-                    "page_no": i + 1
-                })
-            
-            json_doc.append({
-                "page_no": i + 1,
-                "full_layout_info": layout_info
-            })
-            
+        step = (num_pages + workers - 1) // workers
+        ranges = [(start, min(start + step, num_pages)) for start in range(0, num_pages, step)]
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context()) as pool:
+                shards = list(pool.map(_extract_page_range, [file_path] * len(ranges),
+                                       [r[0] for r in ranges], [r[1] for r in ranges]))
+        except Exception as e:
+            # 进程池不可用时（如受限环境）退回单进程
+            print(f"  [PDFProcessor] Parallel extraction failed ({e}), falling back to sequential")
+            return _extract_page_range(file_path, 0, num_pages)
+        
+        json_doc = []
+        for shard in shards:
+            json_doc.extend(shard)
         return json_doc
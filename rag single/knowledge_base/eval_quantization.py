@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure recall loss of quantized vector storage (float16 / int8) against float32
+
+用集合中已入库的文档向量（经嵌入缓存取回，必要时重新编码，保证是 float32 原始向量）
+分别建立 float32 / float16 / int8 索引，以 float32 flat 的精确 top-k 为基准，
+报告 recall@k、索引大小和平均查询延迟。
+
+用法:
+    python eval_quantization.py                       # 英文知识库，当前索引类型
+    python eval_quantization.py --index-type hnsw --k 10 --queries 500
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+# 将 rag single 目录添加到 Python 路径，以便能够导入 knowledge_base 模块
+current_file_path = Path(__file__).parent.absolute()
+sys.path.append(str(current_file_path.parent))
+
+from knowledge_base import index_factory
+from knowledge_base.index_factory import IndexConfig, STORAGE_TYPES
+from knowledge_base.kb import KnowledgeBase
+
+
+def recall_at_k(truth: np.ndarray, found: np.ndarray) -> float:
+    """平均每个查询的 top-k 命中比例"""
+    k = truth.shape[1]
+    hits = sum(len(set(t[t >= 0]) & set(f[f >= 0])) for t, f in zip(truth, found))
+    return hits / (len(truth) * k)
+
+
+def evaluate(vectors: np.ndarray, queries: np.ndarray, config: IndexConfig, index_type: str, k: int):
+    ids = np.arange(len(vectors), dtype='int64')
+    baseline = faiss.IndexFlatIP(vectors.shape[1])
+    baseline.add(vectors)
+    _, truth = baseline.search(queries, k)
+
+    rows = []
+    for storage in STORAGE_TYPES:
+        # 比较量化本身的召回：int8 不等待 min_train_size
+        cfg = IndexConfig(**dict(config.__dict__, storage=storage, min_train_size=0))
+        index = index_factory.create_index(cfg, vectors.shape[1], index_type, train_vectors=vectors)
+        index.add_with_ids(vectors, ids)
+        start = time.perf_counter()
+        _, found = index.search(queries, k)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        size_mb = faiss.serialize_index(index).nbytes / (1024 * 1024)
+        rows.append((storage, recall_at_k(truth, found), size_mb, latency_ms))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall of float16 / int8 storage vs float32")
+    parser.add_argument("--index-type", choices=("flat", "ivf_flat", "hnsw"), default=None,
+                        help="index type to compare (default: the collection's current type)")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200, help="number of stored chunks used as queries")
+    parser.add_argument("--max-vectors", type=int, default=200_000)
+    parser.add_argument("--chinese", action="store_true", help="evaluate the Chinese collection")
+    args = parser.parse_args()
+
+    kb = KnowledgeBase(use_english=not args.chinese)
+    store = kb.vector_store
+    documents = store.documents[:args.max_vectors]
+    if not documents:
+        print("❌ Collection is empty")
+        return
+
+    print(f"📚 Loading float32 vectors for {len(documents)} chunks...")
+    vectors = store._embed_documents(documents)
+    rng = np.random.default_rng(0)
+    picks = rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)
+    queries = np.ascontiguousarray(vectors[picks])
+
+    index_type = args.index_type or index_factory.index_type_of(store.index)
+    if index_type == "ivf_pq":
+        index_type = "ivf_flat"
+    k = min(args.k, len(vectors))
+    print(f"🔍 {index_type}, {len(queries)} queries, recall@{k} vs exact float32 search\n")
+    print(f"{'storage':<10}{'recall':>10}{'size (MB)':>12}{'ms/query':>12}")
+    for storage, recall, size_mb, latency_ms in evaluate(vectors, queries, store.index_config, index_type, k):
+        print(f"{storage:<10}{recall:>10.4f}{size_mb:>12.2f}{latency_ms:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+FAISS index factory for EnhancedVectorStore.
+
+Supported index types (all use inner product on normalized vectors, i.e. cosine):
+- flat:     exact brute-force search (IndexIDMap2 over IndexFlatIP)
+- ivf_flat: inverted file with full vectors, search cost ~ nprobe / nlist
+- ivf_pq:   inverted file with product-quantized codes, bounded memory for millions of chunks
+- hnsw:     graph index (IndexIDMap2 over IndexHNSWFlat); no native removal, deletes rebuild
+- auto:     flat for small corpora, migrating to ivf_flat / ivf_pq as size thresholds are crossed
+
+Vector storage for flat / ivf_flat / hnsw (ivf_pq always stores PQ codes):
+- float32:  full precision
+- float16:  IndexScalarQuantizer QT_fp16, half the memory, no training
+- int8:     IndexScalarQuantizer QT_8bit, a quarter of the memory, per-dimension ranges trained on data;
+            a collection stays float32 until it holds min_train_size vectors, then migrates
+"""
+import json
+import math
+import os
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import Optional, Sequence
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("auto", "flat", "ivf_flat", "ivf_pq", "hnsw")
+STORAGE_TYPES = ("float32", "float16", "int8")
+
+_SQ_TYPES = {
+    "float16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+# int8 的取值范围按训练数据的 min/max 再向两侧各放宽该比例，减少之后新向量被截断
+SQ_RANGE_MARGIN = 0.25
+
+
+@dataclass
+class IndexConfig:
+    """Index selection and tuning parameters (persisted per collection)."""
+    index_type: str = "auto"
+    # auto 模式：超过该向量数时从 flat 迁移到 ivf_flat / ivf_pq
+    ivf_threshold: int = 20_000
+    pq_threshold: int = 1_000_000
+    # IVF: nlist 为空时按 4*sqrt(N) 估算；训练最多使用前 train_size 个向量，
+    # 显式指定 ivf_* 时向量数达到 min_train_size 之前仍使用 flat（int8 存储同理，之前使用 float32）
+    nlist: Optional[int] = None
+    train_size: int = 100_000
+    min_train_size: int = 10_000
+    nprobe: int = 16
+    # IVF-PQ
+    pq_m: int = 16
+    pq_nbits: int = 8
+    # HNSW
+    hnsw_m: int = 32
+    ef_construction: int = 80
+    ef_search: int = 64
+    # 向量存储精度：float32 / float16 / int8
+    storage: str = "float32"
+
+    def __post_init__(self):
+        if self.index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type '{self.index_type}', expected one of {INDEX_TYPES}")
+        if self.storage not in STORAGE_TYPES:
+            raise ValueError(f"Unknown storage '{self.storage}', expected one of {STORAGE_TYPES}")
+
+    def save(self, path: Path):
+        # 每个 worker 启动时都会写配置：先写进程独有的临时文件再原子替换，其他进程不会读到写了一半的文件
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(asdict(self), f, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "IndexConfig":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in data.items() if k in known})
+
+
+def resolve_type(config: IndexConfig, ntotal: int) -> str:
+    """Concrete index type to use for a corpus of `ntotal` vectors."""
+    if config.index_type in ("ivf_flat", "ivf_pq") and ntotal < config.min_train_size:
+        return "flat"
+    if config.index_type != "auto":
+        return config.index_type
+    if ntotal >= config.pq_threshold:
+        return "ivf_pq"
+    if ntotal >= config.ivf_threshold:
+        return "ivf_flat"
+    return "flat"
+
+
+def index_type_of(index: faiss.Index) -> str:
+    """Infer the concrete index type of a loaded index."""
+    if isinstance(index, faiss.IndexIDMap2):
+        inner = faiss.downcast_index(index.index)
+        return "hnsw" if isinstance(inner, faiss.IndexHNSW) else "flat"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def _sq_of(index: faiss.Index) -> Optional[faiss.ScalarQuantizer]:
+    """The ScalarQuantizer of an SQ-backed index, or None for float32 / PQ storage."""
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    if isinstance(inner, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return inner.sq
+    return None
+
+
+def storage_of(index: faiss.Index) -> str:
+    """Infer the vector storage of a loaded index."""
+    sq = _sq_of(index)
+    if sq is None:
+        return "float32"
+    for name, qtype in _SQ_TYPES.items():
+        if sq.qtype == qtype:
+            return name
+    return "float32"
+
+
+def storage_for(config: IndexConfig, index_type: str, ntotal: int) -> str:
+    """
+    Storage an index of `index_type` over `ntotal` vectors gets under `config`
+    (PQ codes ignore the setting; int8 waits for min_train_size vectors).
+    """
+    if index_type == "ivf_pq":
+        return "float32"
+    # int8 的取值范围由训练向量决定：向量太少时（如首次只写入一个 chunk，min == max）
+    # 之后所有向量会被编码成同一个值，先用 float32，积累到足够向量后再训练并迁移
+    if config.storage == "int8" and ntotal < config.min_train_size:
+        return "float32"
+    return config.storage
+
+
+_AUTO_RANK = {"flat": 0, "ivf_flat": 1, "ivf_pq": 2}
+
+
+def should_migrate(config: IndexConfig, current_type: str, ntotal: int,
+                   current_storage: str = "float32") -> Optional[str]:
+    """Return the index type to migrate to, or None to keep the current index."""
+    target = resolve_type(config, ntotal)
+    if target == current_type:
+        # 类型不变但存储精度配置变化（或 int8 积累到足够的训练向量）时，按同一类型重建；
+        # 已是配置的精度时不因删除降回 float32
+        return target if current_storage not in (storage_for(config, target, ntotal), config.storage) else None
+    # auto 模式只向更大的索引迁移，避免删除后在阈值附近来回重建
+    if config.index_type == "auto" and _AUTO_RANK.get(target, 0) <= _AUTO_RANK.get(current_type, 0):
+        return None
+    return target
+
+
+def _nlist_for(config: IndexConfig, ntotal: int) -> int:
+    nlist = config.nlist or int(4 * math.sqrt(max(ntotal, 1)))
+    # faiss 建议每个聚类中心至少 39 个训练点
+    return max(1, min(nlist, ntotal // 39 or 1))
+
+
+def _pq_m_for(config: IndexConfig, dim: int) -> int:
+    """Largest number of sub-quantizers <= pq_m that divides dim."""
+    m = min(config.pq_m, dim)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def needs_training(index_type: str) -> bool:
+    """Whether the index type needs a large training set (IVF coarse quantizer)."""
+    return index_type in ("ivf_flat", "ivf_pq")
+
+
+def _prepare_sq(sq: faiss.ScalarQuantizer):
+    """Train SQ ranges as per-dimension min/max of the training vectors, widened by SQ_RANGE_MARGIN."""
+    sq.rangestat = faiss.ScalarQuantizer.RS_minmax
+    sq.rangestat_arg = SQ_RANGE_MARGIN
+
+
+def create_index(config: IndexConfig, dim: int, index_type: str,
+                 train_vectors: Optional[np.ndarray] = None) -> faiss.Index:
+    """
+    Create an empty index with stable int64 id support, trained if required.
+    `train_vectors` should be the vectors the index is built for: their count
+    decides whether int8 storage applies yet, and IVF / int8 train on them.
+    """
+    storage = storage_for(config, index_type, 0 if train_vectors is None else len(train_vectors))
+    qtype = _SQ_TYPES.get(storage)
+    if needs_training(index_type) and (train_vectors is None or len(train_vectors) == 0):
+        raise ValueError(f"{index_type} index requires training vectors")
+    train = None
+    if train_vectors is not None:
+        train = np.ascontiguousarray(train_vectors[:config.train_size], dtype='float32')
+
+    if index_type in ("flat", "hnsw"):
+        if index_type == "flat":
+            inner = (faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+                     if qtype is not None else faiss.IndexFlatIP(dim))
+        else:
+            inner = (faiss.IndexHNSWSQ(dim, qtype, config.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+                     if qtype is not None else faiss.IndexHNSWFlat(dim, config.hnsw_m, faiss.METRIC_INNER_PRODUCT))
+            inner.hnsw.efConstruction = config.ef_construction
+        if qtype is not None:
+            _prepare_sq(_sq_of(inner))
+            if not inner.is_trained:
+                print(f"  [IndexFactory] Training {storage} storage ranges on {len(train)} vectors...")
+                inner.train(train)
+        index = faiss.IndexIDMap2(inner)
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        nlist = _nlist_for(config, len(train))
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat" and qtype is not None:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, qtype, faiss.METRIC_INNER_PRODUCT)
+            _prepare_sq(index.sq)
+        elif index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_m_for(config, dim),
+                                     config.pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        print(f"  [IndexFactory] Training {index_type}/{storage} (nlist={nlist}) on {len(train)} vectors...")
+        index.train(train)
+        # 哈希表直接映射：支持按任意 int64 id reconstruct / remove
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    else:
+        raise ValueError(f"Unknown index type '{index_type}'")
+    apply_search_params(index, config)
+    return index
+
+
+def apply_search_params(index: faiss.Index, config: IndexConfig,
+                        nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Apply runtime search parameters (nprobe for IVF, efSearch for HNSW)."""
+    if index is None:
+        return
+    index_type = index_type_of(index)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        faiss.extract_index_ivf(index).nprobe = nprobe or config.nprobe
+    elif index_type == "hnsw":
+        faiss.downcast_index(index.index).hnsw.efSearch = ef_search or config.ef_search
+
+
+def search_parameters(index: faiss.Index, config: IndexConfig, sel: faiss.IDSelector) -> faiss.SearchParameters:
+    """Per-call search parameters carrying an IDSelector plus the configured nprobe / efSearch."""
+    index_type = index_type_of(index)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        return faiss.SearchParametersIVF(sel=sel, nprobe=config.nprobe)
+    if index_type == "hnsw":
+        return faiss.SearchParametersHNSW(sel=sel, efSearch=config.ef_search)
+    return faiss.SearchParameters(sel=sel)
+
+
+def supports_remove(index: faiss.Index) -> bool:
+    return index_type_of(index) != "hnsw"
+
+
+def reconstruct(index: faiss.Index, vids: Sequence[int]) -> np.ndarray:
+    """Fetch stored vectors for the given ids (lossy for PQ codes)."""
+    keys = np.asarray(vids, dtype='int64')
+    if len(keys) == 0:
+        return np.zeros((0, index.d), dtype='float32')
+    return index.reconstruct_batch(keys)
+
+
+def rebuild(config: IndexConfig, index: faiss.Index, vids: Sequence[int], index_type: str) -> faiss.Index:
+    """Rebuild `index` as `index_type` from its own stored vectors (no re-encoding; SQ ranges are retrained)."""
+    vectors = reconstruct(index, vids)
+    new_index = create_index(config, index.d, index_type, train_vectors=vectors)
+    if len(vids):
+        new_index.add_with_ids(vectors, np.asarray(vids, dtype='int64'))
+    return new_index
@@ -1,36 +1,112 @@
 from pathlib import Path
 import tempfile
-from knowledge_base.enhanced_system import EnhancedVectorStore, DotsHierarchicalChunker, PDFProcessor
+import time
+from typing import Any, Callable, Dict, List, Optional
+from knowledge_base.enhanced_system import DotsChunk, DotsHierarchicalChunker, PDFProcessor
+from knowledge_base.index_factory import IndexConfig
+from knowledge_base.registry import get_reranker, get_vector_store
+
+# progress(stage, done, total)
+ProgressCallback = Callable[[str, int, int], None]
 
 class KnowledgeBase:
-    def __init__(self, kb_dir: str = "knowledge_base", use_english: bool = True):
+    def __init__(self, kb_dir: str = "knowledge_base", use_english: bool = True,
+                 index_config: Optional[IndexConfig] = None,
+                 nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                 search_mode: str = "dense", rerank: bool = False,
+                 rerank_candidates: int = 20, rerank_budget_ms: Optional[float] = None):
         self.kb_dir = Path(kb_dir)
         self.use_english = use_english
+        self.index_config = index_config
+        # dense：纯向量检索；hybrid：向量 + BM25 融合（公式名、术语等精确词召回更好）
+        self.search_mode = search_mode
+        # 可选的 CrossEncoder 重排序：先取 rerank_candidates 个候选，在延迟预算内重新打分
+        self.rerank = rerank
+        self.rerank_candidates = rerank_candidates
+        self.rerank_budget_ms = rerank_budget_ms
         self.vector_store = None
         self._load_vector_store()
+        self.set_search_params(nprobe=nprobe, ef_search=ef_search)
     
-    def _load_vector_store(self):
+    @staticmethod
+    def store_location(use_english: bool = True):
+        """向量库目录与集合名：(persist_dir, collection_name)"""
         # 根据语言选择不同的向量库目录
-        if self.use_english:
-            persist_dir = Path(tempfile.gettempdir()) / "faiss_db_en"
-            collection_name = "mixing_kb_en"
-        else:
-            persist_dir = Path(tempfile.gettempdir()) / "faiss_db"
-            collection_name = "mixing_kb"
+        if use_english:
+            return Path(tempfile.gettempdir()) / "faiss_db_en", "mixing_kb_en"
+        return Path(tempfile.gettempdir()) / "faiss_db", "mixing_kb"
+
+    def _load_vector_store(self):
+        persist_dir, collection_name = self.store_location(self.use_english)
         
-        # 使用 EnhancedVectorStore
-        self.vector_store = EnhancedVectorStore(
+        # 使用共享的 EnhancedVectorStore（同一集合在进程内只加载一次）
+        self.vector_store = get_vector_store(
             persist_directory=str(persist_dir),
-            collection_name=collection_name
+            collection_name=collection_name,
+            index_config=self.index_config
         )
+
+    def set_search_params(self, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """设置 ANN 检索参数：IVF 的 nprobe、HNSW 的 efSearch（越大召回越高、延迟越大）"""
+        if self.vector_store is not None:
+            self.vector_store.set_search_params(nprobe=nprobe, ef_search=ef_search)
     
-    def retrieve(self, query: str, k: int = 3) -> str:
-        """检索知识库"""
+    def embed_query(self, query: str):
+        """查询的归一化向量（与检索共享查询向量缓存）"""
+        return self.vector_store.embed_query(query)
+
+    def version(self) -> str:
+        """当前索引版本（快照 id）：任何进程写入后都会变化，用于按版本失效的缓存"""
+        return self.vector_store.index_version
+
+    def search_many(self, queries: List[str], k: int = 3, mode: Optional[str] = None,
+                    filter: Optional[Dict[str, Any]] = None, rerank: Optional[bool] = None,
+                    rerank_budget_ms: Optional[float] = None) -> List[List[Dict[str, Any]]]:
+        """
+        检索并返回原始结果（每个查询一个列表）。
+        rerank / rerank_budget_ms 为 None 时使用实例默认值；预算按整个调用计算，
+        超时后剩余候选保持向量检索的顺序。
+        """
+        rerank = self.rerank if rerank is None else rerank
+        fetch_k = max(k, self.rerank_candidates) if rerank else k
+        all_results = self.vector_store.retrieve_many(queries, top_k=fetch_k, mode=mode or self.search_mode,
+                                                      filter=filter)
+        if not rerank:
+            return all_results
+        
+        reranker = get_reranker()
+        budget = self.rerank_budget_ms if rerank_budget_ms is None else rerank_budget_ms
+        start = time.perf_counter()
+        reranked = []
+        for query, results in zip(queries, all_results):
+            remaining = None if budget is None else max(budget - (time.perf_counter() - start) * 1000, 0.0)
+            reranked.append(reranker.rerank(query, results, k, budget_ms=remaining))
+        return reranked
+
+    def search(self, query: str, k: int = 3, **kwargs) -> List[Dict[str, Any]]:
+        """单个查询的 search_many"""
+        return self.search_many([query], k, **kwargs)[0]
+
+    def retrieve(self, query: str, k: int = 3, mode: Optional[str] = None,
+                 filter: Optional[Dict[str, Any]] = None, rerank: Optional[bool] = None) -> str:
+        """检索知识库（mode 默认使用 self.search_mode；filter 按 source / category / page_no 限定范围）"""
         if self.vector_store is None:
             return "知识库未加载" if not self.use_english else "Knowledge base not loaded"
         
-        results = self.vector_store.retrieve(query, top_k=k)
+        results = self.search(query, k, mode=mode, filter=filter, rerank=rerank)
+        return self._format_results(query, results)
+
+    def retrieve_many(self, queries: List[str], k: int = 3, mode: Optional[str] = None,
+                      filter: Optional[Dict[str, Any]] = None, rerank: Optional[bool] = None) -> List[str]:
+        """批量检索：所有查询一次编码、一次 FAISS 搜索，按顺序返回每个查询的格式化结果"""
+        if self.vector_store is None:
+            return ["知识库未加载" if not self.use_english else "Knowledge base not loaded" for _ in queries]
         
+        all_results = self.search_many(queries, k, mode=mode, filter=filter, rerank=rerank)
+        return [self._format_results(q, results) for q, results in zip(queries, all_results)]
+
+    def _format_results(self, query: str, results: List[Dict[str, Any]]) -> str:
+        """将检索结果格式化为供 LLM 阅读的文本"""
         if not results:
             return f"未找到与'{query}'相关的信息" if not self.use_english else f"No information found for '{query}'"
         
@@ -85,9 +161,55 @@ class KnowledgeBase:
         except Exception as e:
             return f"Failed to list documents: {e}"
     
-    def add_document(self, file_path: str, title: str = None):
+    @staticmethod
+    def _parse_markdown(file_path: str) -> List[Dict[str, Any]]:
+        """模拟 PDFProcessor 的输出结构"""
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        
+        layout_info = []
+        for line in content.split('\n'):
+            line = line.strip()
+            if not line: continue
+            layout_info.append({
+                "text": line,
+                "category": "Section-header" if line.startswith('#') else "Text",
+                "page_no": 1
+            })
+        
+        return [{"page_no": 1, "full_layout_info": layout_info}]
+
+    @staticmethod
+    def chunk_file(file_path: str, progress: Optional[ProgressCallback] = None) -> Optional[Dict[int, DotsChunk]]:
+        """
+        解析并按层级切分文件（PDF / Markdown），不支持的格式返回 None
+        """
+        file_ext = Path(file_path).suffix.lower()
+        if file_ext == '.pdf':
+            print(f"  [KB] Using Enhanced PDF Processor...")
+            if progress:
+                progress("parsing", 0, 0)
+            # 1. PDF -> JSON Structure
+            json_doc = PDFProcessor.process(str(file_path))
+            print(f"  [KB] PDF processing complete, starting chunking...")
+        elif file_ext == '.md':
+            print(f"  [KB] Using Enhanced Markdown Processor...")
+            if progress:
+                progress("parsing", 0, 0)
+            json_doc = KnowledgeBase._parse_markdown(file_path)
+        else:
+            return None
+        
+        # 2. Chunking with Hierarchy
+        if progress:
+            progress("chunking", 0, 0)
+        chunker = DotsHierarchicalChunker(chunk_size=500, chunk_overlap=50)
+        return chunker.chunk(json_doc)
+
+    def add_document(self, file_path: str, title: str = None, progress: Optional[ProgressCallback] = None):
         """
-        通用文档添加方法，支持 PDF (使用 Enhanced System)
+        通用文档添加方法，支持 PDF / Markdown (使用 Enhanced System)
+        progress(stage, done, total) 依次报告 parsing / chunking / embedding / indexing 阶段
         """
         if self.vector_store is None:
             return {"success": False, "message": "Knowledge base not loaded"}
@@ -99,59 +221,70 @@ class KnowledgeBase:
         print(f"  [KB] Processing document: {doc_title} ({file_ext})")
         
         try:
-            if file_ext == '.pdf':
-                print(f"  [KB] Using Enhanced PDF Processor...")
-                # 1. PDF -> JSON Structure
-                json_doc = PDFProcessor.process(str(file_path))
-                print(f"  [KB] PDF processing complete, starting chunking...")
-                # 2. Chunking with Hierarchy
-                chunker = DotsHierarchicalChunker(chunk_size=500, chunk_overlap=50)
-                chunks = chunker.chunk(json_doc)
-                print(f"  [KB] Chunking complete, starting write to vector store...")
-                # 3. Store
-                self.vector_store.add_chunks(chunks, source_file=doc_title)
-                print(f"  [KB] Write to vector store successful!")
-                return {
-                    "success": True,
-                    "message": f"Successfully indexed {len(chunks)} chunks",
-                    "chunks": len(chunks),
-                    "title": doc_title
-                }
-            elif file_ext == '.md':
-                print(f"  [KB] Using Enhanced Markdown Processor...")
-                # 模拟 PDFProcessor 的输出结构
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                
-                layout_info = []
-                for line in content.split('\n'):
-                    line = line.strip()
-                    if not line: continue
-                    layout_info.append({
-                        "text": line,
-                        "category": "Section-header" if line.startswith('#') else "Text",
-                        "page_no": 1
-                    })
-                
-                json_doc = [{"page_no": 1, "full_layout_info": layout_info}]
-                chunker = DotsHierarchicalChunker(chunk_size=500, chunk_overlap=50)
-                chunks = chunker.chunk(json_doc)
-                self.vector_store.add_chunks(chunks, source_file=doc_title)
-                
-                return {
-                    "success": True,
-                    "message": f"Successfully indexed {len(chunks)} chunks",
-                    "chunks": len(chunks),
-                    "title": doc_title
-                }
-            else:
+            chunks = self.chunk_file(str(file_path), progress)
+            if chunks is None:
                 return {"success": False, "message": "Currently Enhanced System only supports PDF and MD files"}
+            print(f"  [KB] Chunking complete, starting write to vector store...")
+            
+            # 3. Store
+            self.vector_store.add_chunks(chunks, source_file=doc_title, progress=self._embed_progress(progress))
+            print(f"  [KB] Write to vector store successful!")
+            return {
+                "success": True,
+                "message": f"Successfully indexed {len(chunks)} chunks",
+                "chunks": len(chunks),
+                "title": doc_title
+            }
             
         except Exception as e:
             import traceback
             traceback.print_exc()
             return {"success": False, "message": f"Indexing failed: {str(e)}"}
 
+    def upsert_document(self, file_path: str, title: str = None, progress: Optional[ProgressCallback] = None):
+        """
+        增量更新文档：与已存的同名文档 chunk 按内容哈希比对，只编码新增 / 修改的 chunk，
+        删除不再出现的 chunk。文档不存在时等同于 add_document。
+        """
+        if self.vector_store is None:
+            return {"success": False, "message": "Knowledge base not loaded"}
+        
+        doc_title = title or Path(file_path).name
+        print(f"  [KB] Upserting document: {doc_title}")
+        
+        try:
+            chunks = self.chunk_file(str(file_path), progress)
+            if chunks is None:
+                return {"success": False, "message": "Currently Enhanced System only supports PDF and MD files"}
+            
+            stats = self.vector_store.upsert_chunks(chunks, source_file=doc_title,
+                                                    progress=self._embed_progress(progress))
+            print(f"  [KB] Upsert successful: {stats}")
+            return {
+                "success": True,
+                "message": (f"Indexed {len(chunks)} chunks "
+                            f"({stats['added']} embedded, {stats['removed']} removed)"),
+                "chunks": len(chunks),
+                "title": doc_title,
+                **stats
+            }
+            
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return {"success": False, "message": f"Indexing failed: {str(e)}"}
+
+    @staticmethod
+    def _embed_progress(progress: Optional[ProgressCallback]) -> Optional[Callable[[int, int], None]]:
+        """把向量库的 progress(done, total) 转换为 embedding / indexing 阶段的回调"""
+        if progress is None:
+            return None
+        
+        def embed_progress(done: int, total: int):
+            # 全部编码完成后进入写索引阶段
+            progress("indexing" if done >= total else "embedding", done, total)
+        return embed_progress
+
     def add_pdf_document(self, pdf_path: str, title: str = None):
         """保持向后兼容"""
         return self.add_document(pdf_path, title)
@@ -0,0 +1,250 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# (vid, chunk_id, document, metadata)
+Row = Tuple[int, str, str, Dict[str, Any]]
+
+# 从 metadata 中冗余出来、带 SQLite 索引的过滤字段
+FILTER_FIELDS = ("source", "category", "page_no")
+# where 条件支持的比较运算符（Chroma 风格，如 {"page_no": {"$gte": 2, "$lte": 5}}）
+_OPERATORS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+_FIELD_RE = re.compile(r"\w+")
+# SQLite 内存映射读取的上限（MB）：多个 worker 进程共享同一份页缓存，而不是各自的私有页
+DEFAULT_MMAP_MB = 256
+
+
+class MetadataStore:
+    """
+    SQLite-backed store for chunk documents and metadata, keyed by vector id.
+
+    Rows are appended incrementally, so ingest no longer rewrites the whole
+    sidecar and startup does not need to parse it: callers fetch only the
+    rows they need (e.g. search hits) by vid.
+
+    `source`, `category` and `page_no` are also stored as indexed columns, so
+    metadata filters resolve to vid sets without scanning every row.
+
+    Reads go through a memory-mapped view of the database file (`mmap_mb`,
+    env KB_META_MMAP_MB, 0 disables), so processes serving the same
+    collection share its pages instead of each copying them.
+
+    Writes use a separate connection. Writes staged with commit=False stay
+    invisible to other threads until `commit()`; only the thread that staged
+    them reads through the write connection and sees them.
+    """
+
+    def __init__(self, db_path: str, mmap_mb: Optional[int] = None):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        if mmap_mb is None:
+            mmap_mb = int(os.getenv("KB_META_MMAP_MB", DEFAULT_MMAP_MB))
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.db_path.as_posix(), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA mmap_size={int(mmap_mb) * 1024 * 1024}")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                vid INTEGER PRIMARY KEY,
+                chunk_id TEXT NOT NULL,
+                document TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                source TEXT,
+                category TEXT,
+                page_no INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS idx_chunks_chunk_id ON chunks(chunk_id);
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+        self._add_filter_columns()
+        self._conn.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_chunks_category ON chunks(category);
+            CREATE INDEX IF NOT EXISTS idx_chunks_source_page ON chunks(source, page_no);
+        """)
+        self._conn.commit()
+        self._write_conn = sqlite3.connect(self.db_path.as_posix(), check_same_thread=False)
+        self._write_conn.execute("PRAGMA synchronous=NORMAL")
+        # 持有未提交写入的线程：它的读取走写连接，其他线程只读到已提交的数据
+        self._writer: Optional[int] = None
+
+    def _add_filter_columns(self):
+        """旧库迁移：补上过滤字段列，并从 metadata JSON 回填"""
+        columns = {r[1] for r in self._conn.execute("PRAGMA table_info(chunks)")}
+        missing = [f for f in FILTER_FIELDS if f not in columns]
+        if not missing:
+            return
+        for field in missing:
+            self._conn.execute(f"ALTER TABLE chunks ADD COLUMN {field} {'INTEGER' if field == 'page_no' else 'TEXT'}")
+        updates = [
+            tuple(json.loads(meta).get(f) for f in FILTER_FIELDS) + (vid,)
+            for vid, meta in self._conn.execute("SELECT vid, metadata FROM chunks")
+        ]
+        self._conn.executemany(
+            f"UPDATE chunks SET {', '.join(f'{f} = ?' for f in FILTER_FIELDS)} WHERE vid = ?", updates
+        )
+
+    def _reader(self) -> sqlite3.Connection:
+        """Connection for reads on the calling thread (caller holds the lock)."""
+        return self._write_conn if self._writer == threading.get_ident() else self._conn
+
+    def _written(self, commit: bool):
+        """After a write on the write connection: commit it, or mark this thread as holding staged writes."""
+        if commit:
+            self._write_conn.commit()
+            self._writer = None
+        else:
+            self._writer = threading.get_ident()
+
+    # --- state ---
+
+    def get_state(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            row = self._reader().execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_state(self, key: str, value: Any, commit: bool = True):
+        with self._lock:
+            self._write_conn.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, str(value))
+            )
+            self._written(commit)
+
+    # --- writes ---
+
+    def append(self, rows: Iterable[Row], commit: bool = True):
+        """Append rows; pass commit=False to group several writes into one transaction."""
+        with self._lock:
+            self._write_conn.executemany(
+                "INSERT OR REPLACE INTO chunks (vid, chunk_id, document, metadata, source, category, page_no) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((int(vid), cid, doc, json.dumps(meta, ensure_ascii=False)) + tuple(meta.get(f) for f in FILTER_FIELDS)
+                 for vid, cid, doc, meta in rows)
+            )
+            self._written(commit)
+
+    def delete(self, vids: Sequence[int], commit: bool = True):
+        with self._lock:
+            self._write_conn.executemany("DELETE FROM chunks WHERE vid = ?", ((int(v),) for v in vids))
+            self._written(commit)
+
+    def commit(self):
+        with self._lock:
+            self._written(commit=True)
+
+    def rollback(self):
+        with self._lock:
+            self._write_conn.rollback()
+            self._writer = None
+
+    # --- reads ---
+
+    def count(self) -> int:
+        with self._lock:
+            return self._reader().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def is_empty(self) -> bool:
+        """O(1) unlike count(), which scans the whole table."""
+        with self._lock:
+            return self._reader().execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None
+
+    def all_vids(self) -> List[int]:
+        with self._lock:
+            return [r[0] for r in self._reader().execute("SELECT vid FROM chunks ORDER BY vid")]
+
+    def get_rows(self, vids: Sequence[int]) -> Dict[int, Row]:
+        """Fetch rows for the given vids (missing vids are simply absent)."""
+        vids = [int(v) for v in vids]
+        out: Dict[int, Row] = {}
+        with self._lock:
+            # 分批查询，避免超出 SQLite 参数数量上限
+            for i in range(0, len(vids), 500):
+                batch = vids[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                for vid, cid, doc, meta in self._reader().execute(
+                    f"SELECT vid, chunk_id, document, metadata FROM chunks WHERE vid IN ({placeholders})", batch
+                ):
+                    out[vid] = (vid, cid, doc, json.loads(meta))
+        return out
+
+    def vids_for_ids(self, chunk_ids: Sequence[str]) -> List[int]:
+        chunk_ids = list(chunk_ids)
+        out: List[int] = []
+        with self._lock:
+            for i in range(0, len(chunk_ids), 500):
+                batch = chunk_ids[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                out.extend(r[0] for r in self._reader().execute(
+                    f"SELECT vid FROM chunks WHERE chunk_id IN ({placeholders})", batch
+                ))
+        return out
+
+    def vids_where(self, where: Dict[str, Any]) -> List[int]:
+        """
+        Vids whose metadata matches `where`, in vid order. Values are compared for
+        equality, or given as {"$in": [...]} / {"$gte": ..., "$lte": ...} etc.
+        Filter fields use their indexed columns; other keys fall back to json_extract.
+        """
+        clauses: List[str] = []
+        params: List[Any] = []
+        for key, cond in where.items():
+            if not _FIELD_RE.fullmatch(key):
+                raise ValueError(f"Invalid filter field: {key}")
+            column = key if key in FILTER_FIELDS else f"json_extract(metadata, '$.\"{key}\"')"
+            ops = cond if isinstance(cond, dict) else {"$eq": cond}
+            for op, value in ops.items():
+                if op == "$in":
+                    values = list(value)
+                    if not values:
+                        return []
+                    clauses.append(f"{column} IN ({','.join('?' * len(values))})")
+                    params.extend(values)
+                elif op in _OPERATORS:
+                    clauses.append(f"{column} {_OPERATORS[op]} ?")
+                    params.append(value)
+                else:
+                    raise ValueError(f"Unsupported filter operator: {op}")
+        sql = "SELECT vid FROM chunks"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        with self._lock:
+            return [r[0] for r in self._reader().execute(sql + " ORDER BY vid", params)]
+
+    def iter_rows(self) -> Iterator[Row]:
+        """Iterate over all rows in vid order."""
+        with self._lock:
+            rows = self._reader().execute(
+                "SELECT vid, chunk_id, document, metadata FROM chunks ORDER BY vid"
+            ).fetchall()
+        for vid, cid, doc, meta in rows:
+            yield vid, cid, doc, json.loads(meta)
+
+    # --- migration ---
+
+    def import_json(self, meta_path: str) -> int:
+        """
+        Import a legacy `<collection>_meta.json` sidecar.
+        Returns the number of imported rows.
+        """
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        ids = meta.get("ids", [])
+        vids = meta.get("vids") or list(range(len(ids)))
+        rows = list(zip(vids, ids, meta.get("documents", []), meta.get("metadatas", [])))
+        next_vid = meta.get("next_vid", max(vids, default=-1) + 1)
+        self.append(rows, commit=False)
+        self.set_state("next_vid", next_vid, commit=False)
+        self.commit()
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._write_conn.close()
+            self._conn.close()
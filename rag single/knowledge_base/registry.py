@@ -0,0 +1,103 @@
+"""
+进程级共享注册表
+
+同一进程内所有路由 / Agent 共享：
+- 一个已加载的 SentenceTransformer 嵌入模型（按模型名缓存）
+- 一个 CrossEncoder 重排序模型（按模型名缓存，首次重排序时才加载）
+- 每个缓存目录 + 模型一个持久化嵌入缓存
+- 每个集合一个 EnhancedVectorStore（按持久化目录 + 集合名缓存）
+- 每个知识库目录一个 KnowledgeBase
+
+这样搜索请求不再重复加载模型和索引，上传后的新文档也能立即被搜索和 Agent 看到。
+"""
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+DEFAULT_EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+_lock = threading.RLock()
+_models: Dict[str, "SentenceTransformer"] = {}
+_rerankers: Dict[str, "Reranker"] = {}
+_embedding_caches: Dict[Tuple[str, str], "EmbeddingCache"] = {}
+_stores: Dict[Tuple[str, str], "EnhancedVectorStore"] = {}
+_knowledge_bases: Dict[Tuple[str, bool], "KnowledgeBase"] = {}
+
+
+def get_embedding_model(model_name: str = DEFAULT_EMBEDDING_MODEL):
+    """获取共享的嵌入模型（首次调用时加载）"""
+    with _lock:
+        model = _models.get(model_name)
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+            print(f"  [Registry] Loading embedding model: {model_name}")
+            model = SentenceTransformer(model_name)
+            _models[model_name] = model
+        return model
+
+
+def get_reranker(model_name: Optional[str] = None):
+    """获取共享的 CrossEncoder 重排序器；KB_RERANK_MODEL 可替换默认模型"""
+    from knowledge_base.reranker import DEFAULT_RERANK_MODEL, Reranker
+    model_name = model_name or os.getenv("KB_RERANK_MODEL", DEFAULT_RERANK_MODEL)
+    with _lock:
+        reranker = _rerankers.get(model_name)
+        if reranker is None:
+            from sentence_transformers import CrossEncoder
+            print(f"  [Registry] Loading rerank model: {model_name}")
+            reranker = Reranker(CrossEncoder(model_name))
+            _rerankers[model_name] = reranker
+        return reranker
+
+
+def get_embedding_cache(cache_dir: str, model_name: str = DEFAULT_EMBEDDING_MODEL):
+    """
+    获取共享的持久化嵌入缓存；KB_EMBED_CACHE_SIZE 控制最大条目数，设为 0 则禁用缓存
+    """
+    max_entries = int(os.getenv("KB_EMBED_CACHE_SIZE", 100_000))
+    if max_entries <= 0:
+        return None
+    key = (str(Path(cache_dir).resolve()), model_name)
+    with _lock:
+        cache = _embedding_caches.get(key)
+        if cache is None:
+            from knowledge_base.embedding_cache import EmbeddingCache
+            cache = EmbeddingCache(cache_dir, model_name, max_entries=max_entries)
+            _embedding_caches[key] = cache
+        return cache
+
+
+def get_vector_store(persist_directory: str, collection_name: str = "document_chunks", index_config=None):
+    """获取共享的向量库实例，每个 (目录, 集合) 只创建一次（index_config 仅在首次创建时生效）"""
+    key = (str(Path(persist_directory).resolve()), collection_name)
+    with _lock:
+        store = _stores.get(key)
+        if store is None:
+            from knowledge_base.enhanced_system import EnhancedVectorStore
+            store = EnhancedVectorStore(
+                persist_directory=persist_directory,
+                collection_name=collection_name,
+                index_config=index_config
+            )
+            _stores[key] = store
+        return store
+
+
+def get_knowledge_base(kb_dir: str = "knowledge_base", use_english: bool = True, **kwargs):
+    """获取共享的 KnowledgeBase 实例（kwargs 透传给 KnowledgeBase，仅在首次创建时生效）"""
+    key = (str(Path(kb_dir).resolve()), use_english)
+    with _lock:
+        kb = _knowledge_bases.get(key)
+        if kb is None:
+            from knowledge_base.kb import KnowledgeBase
+            kb = KnowledgeBase(kb_dir, use_english=use_english, **kwargs)
+            _knowledge_bases[key] = kb
+        return kb
+
+
+def reset():
+    """清空注册表（例如索引目录被整体替换后需要重新加载）"""
+    with _lock:
+        _stores.clear()
+        _knowledge_bases.clear()
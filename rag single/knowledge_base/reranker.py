@@ -0,0 +1,57 @@
+import hashlib
+import time
+from typing import Any, Dict, List, Optional
+
+from knowledge_base.lru import LRUCache
+
+DEFAULT_RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+class Reranker:
+    """
+    Cross-encoder second stage over retrieve() results.
+
+    Candidates are scored in batches in their first-stage order; scores are
+    cached per (query, chunk id, chunk text) so repeated queries only pay for
+    new candidates. When `budget_ms` is exceeded, scoring stops and the
+    remaining candidates keep their first-stage order after the scored ones.
+    """
+
+    def __init__(self, model, batch_size: int = 16, cache_size: int = 10000):
+        self.model = model
+        self.batch_size = batch_size
+        self._cache = LRUCache(cache_size)
+
+    @staticmethod
+    def _key(query: str, result: Dict[str, Any]):
+        digest = hashlib.sha1(result.get("full_doc", "").encode("utf-8")).hexdigest()
+        return " ".join(query.split()), result["id"], digest
+
+    def rerank(self, query: str, results: List[Dict[str, Any]], top_k: int,
+               budget_ms: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Return the best `top_k` results with a `rerank_score` field where scored."""
+        start = time.perf_counter()
+        keys = [self._key(query, r) for r in results]
+        scores: Dict[int, float] = {}
+        pending: List[int] = []
+        for i, key in enumerate(keys):
+            cached = self._cache.get(key)
+            if cached is None:
+                pending.append(i)
+            else:
+                scores[i] = cached
+
+        for b in range(0, len(pending), self.batch_size):
+            if budget_ms is not None and (time.perf_counter() - start) * 1000 > budget_ms:
+                print(f"  [Reranker] Budget {budget_ms:.0f} ms exceeded, "
+                      f"{len(pending) - b} of {len(results)} candidates left unscored")
+                break
+            batch = pending[b:b + self.batch_size]
+            pairs = [(query, results[i].get("full_doc") or results[i].get("text", "")) for i in batch]
+            for i, score in zip(batch, self.model.predict(pairs, batch_size=self.batch_size)):
+                scores[i] = float(score)
+                self._cache.put(keys[i], scores[i])
+
+        scored = sorted(scores, key=lambda i: scores[i], reverse=True)
+        unscored = [i for i in range(len(results)) if i not in scores]
+        return [dict(results[i], rerank_score=scores.get(i)) for i in (scored + unscored)[:top_k]]
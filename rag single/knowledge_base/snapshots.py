@@ -0,0 +1,142 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import List, Optional
+
+import faiss
+
+try:
+    import fcntl
+except ImportError:  # Windows：只有进程内的锁，不支持多个进程同时写同一集合
+    fcntl = None
+
+# 除当前快照外保留的旧快照数：刚读到旧指针、还没打开文件的读者有时间完成加载
+SNAPSHOT_KEEP = 2
+
+
+class WriterLock:
+    """
+    Exclusive inter-process lock (flock on a lock file), re-entrant within a
+    process. At most one process writes a collection at a time.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.RLock()
+        self._fd: Optional[int] = None
+        self._depth = 0
+
+    def __enter__(self):
+        self._local.acquire()
+        if self._depth == 0:
+            fd = os.open(self.path.as_posix(), os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            self._fd = fd
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._local.release()
+
+
+class SnapshotStore:
+    """
+    Immutable, versioned FAISS index snapshots for one collection.
+
+    Layout under `root`:
+        {name}_snapshots/<id>/{name}.faiss   one directory per published version
+        {name}_snapshot.json                 pointer to the current version
+        {name}.lock                          writer lock
+
+    A writer (holding `writer_lock`) writes a complete new snapshot directory,
+    then atomically replaces the pointer file. Readers only ever open published
+    snapshots, so they never see a partially written index; a reader that
+    polls the pointer and finds a new id loads that snapshot and swaps it in.
+    Old snapshots are pruned but a process that still maps one keeps reading
+    it until it swaps (the file is unlinked, not truncated).
+    """
+
+    def __init__(self, root: Path, name: str):
+        self.root = Path(root)
+        self.name = name
+        self.snapshots_dir = self.root / f"{name}_snapshots"
+        self.pointer_path = self.root / f"{name}_snapshot.json"
+        self._writer_lock = WriterLock(self.root / f"{name}.lock")
+
+    def writer_lock(self) -> WriterLock:
+        return self._writer_lock
+
+    def current(self) -> Optional[str]:
+        """Id of the published snapshot, or None if nothing has been published yet."""
+        try:
+            with open(self.pointer_path, "r", encoding="utf-8") as f:
+                return json.load(f)["snapshot"]
+        except FileNotFoundError:
+            return None
+
+    def index_path(self, snapshot: str) -> Path:
+        return self.snapshots_dir / snapshot / f"{self.name}.faiss"
+
+    def exists(self, snapshot: str) -> bool:
+        return self.index_path(snapshot).exists()
+
+    def _ids(self) -> List[str]:
+        if not self.snapshots_dir.exists():
+            return []
+        return sorted(p.name for p in self.snapshots_dir.iterdir() if p.is_dir() and not p.name.endswith(".tmp"))
+
+    def _next_id(self) -> str:
+        # 序号递增便于按新旧排序，随机后缀保证 --full 重建后的新目录不会与旧 id 重名
+        ids = self._ids()
+        seq = int(ids[-1].split("-")[0]) + 1 if ids else 1
+        return f"{seq:08d}-{uuid.uuid4().hex[:8]}"
+
+    def write(self, index: faiss.Index) -> str:
+        """Write `index` as a new (unpublished) snapshot and return its id."""
+        snapshot = self._next_id()
+        tmp_dir = self.snapshots_dir / f"{snapshot}.tmp"
+        tmp_dir.mkdir(parents=True)
+        try:
+            faiss.write_index(index, (tmp_dir / f"{self.name}.faiss").as_posix())
+            os.replace(tmp_dir, self.snapshots_dir / snapshot)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return snapshot
+
+    def adopt(self, index_path: Path) -> str:
+        """Move a pre-snapshot index file into a new snapshot and publish it."""
+        snapshot = self._next_id()
+        target = self.index_path(snapshot)
+        target.parent.mkdir(parents=True)
+        os.replace(index_path, target)
+        self.publish(snapshot)
+        return snapshot
+
+    def publish(self, snapshot: str):
+        """Atomically point readers at `snapshot`."""
+        tmp_path = self.pointer_path.with_name(self.pointer_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"snapshot": snapshot, "published": time.time()}, f)
+        os.replace(tmp_path, self.pointer_path)
+
+    def prune(self, keep: int = SNAPSHOT_KEEP):
+        """Remove all but the current snapshot and the `keep` newest others (caller holds the writer lock)."""
+        current = self.current()
+        older = [s for s in self._ids() if s != current]
+        stale = [self.snapshots_dir / s for s in older[:max(len(older) - keep, 0)]]
+        # 写到一半中断留下的临时目录
+        stale += [p for p in self.snapshots_dir.glob("*.tmp") if p.is_dir()]
+        for path in stale:
+            shutil.rmtree(path, ignore_errors=True)
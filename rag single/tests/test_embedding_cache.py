@@ -0,0 +1,99 @@
+"""
+EmbeddingCache 多进程并发测试：两个进程同时写同一缓存目录（uvicorn 多 worker / 构建脚本与服务同时运行）
+"""
+import multiprocessing
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# 将 rag single 目录添加到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+
+from knowledge_base.embedding_cache import EmbeddingCache
+
+DIM = 8
+MODEL = "test-model"
+
+
+def _vector(text: str) -> np.ndarray:
+    seed = int(EmbeddingCache.key(text)[:8], 16)
+    return np.random.default_rng(seed).standard_normal(DIM).astype("float32")
+
+
+def _writer(cache_dir: str, prefix: str, batches: int, batch_size: int, start):
+    # 小的增长步长，让两个进程反复扩展同一个向量文件
+    EmbeddingCache.GROW_ROWS = 16
+    cache = EmbeddingCache(cache_dir, MODEL)
+    start.wait()
+    for b in range(batches):
+        texts = [f"{prefix}-{b}-{i}" for i in range(batch_size)]
+        cache.put_many([EmbeddingCache.key(t) for t in texts], np.stack([_vector(t) for t in texts]))
+        # 读刚写入的和另一进程写入的 key，映射需要跟上文件增长
+        cache.get_many([EmbeddingCache.key(t) for t in texts])
+
+
+def _run_writers(cache_dir: str, batches: int, batch_size: int):
+    ctx = multiprocessing.get_context("spawn")
+    start = ctx.Barrier(2)
+    procs = [ctx.Process(target=_writer, args=(cache_dir, prefix, batches, batch_size, start)) for prefix in ("a", "b")]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(120)
+    assert [p.exitcode for p in procs] == [0, 0]
+
+
+def test_concurrent_writers_keep_keys_and_vectors_consistent(tmp_path):
+    batches, batch_size = 30, 50
+    _run_writers(str(tmp_path), batches, batch_size)
+
+    cache = EmbeddingCache(str(tmp_path), MODEL)
+    texts = [f"{prefix}-{b}-{i}" for prefix in ("a", "b") for b in range(batches) for i in range(batch_size)]
+    assert len(cache) == len(texts)
+    hits = cache.get_many([EmbeddingCache.key(t) for t in texts])
+    assert len(hits) == len(texts)
+    for pos, text in enumerate(texts):
+        np.testing.assert_array_equal(hits[pos], _vector(text))
+
+
+def test_reader_follows_file_grown_by_another_process(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), MODEL)
+    cache.put_many([EmbeddingCache.key("first")], _vector("first")[None, :])
+    rows_before = cache._vectors.shape[0]
+
+    # 另一个进程写入足够多的条目，使向量文件超过本进程映射的大小
+    _run_writers(str(tmp_path), 10, 500)
+    texts = [f"a-9-{i}" for i in range(500)]
+    hits = cache.get_many([EmbeddingCache.key(t) for t in texts])
+    assert cache._vectors.shape[0] > rows_before
+    assert len(hits) == len(texts)
+    for pos, text in enumerate(texts):
+        np.testing.assert_array_equal(hits[pos], _vector(text))
+
+
+def test_reads_do_not_take_the_write_lock(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), MODEL)
+    texts = [f"r-{i}" for i in range(20)]
+    keys = [EmbeddingCache.key(t) for t in texts]
+    cache.put_many(keys, np.stack([_vector(t) for t in texts]))
+
+    # 模拟另一个进程正持有 SQLite 写锁：读取不排队等待
+    blocker = sqlite3.connect((cache.cache_dir / "index.sqlite").as_posix(), isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+    try:
+        start = time.monotonic()
+        hits = cache.get_many(keys[:1])
+        assert time.monotonic() - start < 1.0
+    finally:
+        blocker.execute("ROLLBACK")
+        blocker.close()
+    np.testing.assert_array_equal(hits[0], _vector(texts[0]))
+
+    # 读命中的 LRU 更新随下一次写入生效：刚读过的条目不会被淘汰
+    cache.max_entries = len(texts)
+    cache.put_many([EmbeddingCache.key("new")], _vector("new")[None, :])
+    assert 0 in cache.get_many(keys[:1])
+    assert len(cache.get_many(keys)) == len(texts) - 1
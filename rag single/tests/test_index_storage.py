@@ -0,0 +1,78 @@
+"""
+EnhancedVectorStore 的 int8 存储：训练取值范围所需的向量数、删除全部文档后的重建
+"""
+import hashlib
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# 将 rag single 目录添加到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+
+from knowledge_base.enhanced_system import EnhancedVectorStore
+from knowledge_base.index_factory import IndexConfig, index_type_of, storage_of
+
+DIM = 32
+
+
+class FakeEmbeddingModel:
+    """每段文本对应一个固定的随机向量（不加载 SentenceTransformer）"""
+
+    def encode(self, texts, batch_size=None):
+        return np.stack([
+            np.random.default_rng(int(hashlib.sha1(t.encode("utf-8")).hexdigest()[:8], 16)).standard_normal(DIM)
+            for t in texts
+        ]).astype("float32")
+
+
+def _records(source: str, n: int):
+    return [(f"{source} chunk {i}", f"{source}_chunk_{i}", {"source": source, "original_text": f"chunk {i}"})
+            for i in range(n)]
+
+
+def _store(path: Path, **config) -> EnhancedVectorStore:
+    return EnhancedVectorStore(str(path / "kb"), "test", embedding_model=FakeEmbeddingModel(),
+                               index_config=IndexConfig(storage="int8", **config), mmap=False)
+
+
+def _self_recall(store: EnhancedVectorStore, records) -> float:
+    hits = store.retrieve_many([doc for doc, _, _ in records], top_k=1)
+    return sum(bool(h) and h[0]["id"] == chunk_id for h, (_, chunk_id, _) in zip(hits, records)) / len(records)
+
+
+def test_int8_waits_for_enough_vectors_before_training(tmp_path):
+    store = _store(tmp_path, index_type="flat", min_train_size=256)
+    first = _records("first.pdf", 1)
+    store.add_records(first)
+    # 一个向量无法训练取值范围（min == max）：先用 float32
+    assert storage_of(store.index) == "float32"
+
+    bulk = _records("bulk.pdf", 300)
+    store.add_records(bulk)
+    assert storage_of(store.index) == "int8"
+    assert store.index.ntotal == 301
+    assert _self_recall(store, first + bulk) >= 0.9
+
+    # 重新打开后仍是 int8，删除到阈值以下也不降回 float32
+    store = _store(tmp_path, index_type="flat", min_train_size=256)
+    store.delete_document("bulk.pdf")
+    assert storage_of(store.index) == "int8"
+    assert _self_recall(store, first) == 1.0
+
+
+def test_hnsw_int8_delete_every_document(tmp_path):
+    store = _store(tmp_path, index_type="hnsw", min_train_size=64)
+    store.add_records(_records("a.pdf", 100))
+    store.add_records(_records("b.pdf", 20))
+    assert (index_type_of(store.index), storage_of(store.index)) == ("hnsw", "int8")
+
+    store.delete_document("a.pdf")
+    store.delete_document("b.pdf")
+    assert store.meta.count() == 0
+    assert store.retrieve("a.pdf chunk 1") == []
+
+    # 删空之后可以继续写入
+    again = _records("c.pdf", 10)
+    store.add_records(again)
+    assert _self_recall(_store(tmp_path, index_type="hnsw", min_train_size=64), again) == 1.0
@@ -0,0 +1,49 @@
+"""
+MetadataStore 的暂存写入（commit=False）：提交前只有写入线程可见
+"""
+import sys
+import threading
+from pathlib import Path
+
+# 将 rag single 目录添加到 Python 路径
+sys.path.insert(0, str(Path(__file__).parent.parent.absolute()))
+
+from knowledge_base.meta_store import MetadataStore
+
+
+def _rows(vids):
+    return [(vid, f"a.pdf_chunk_{vid}", f"chunk {vid}", {"source": "a.pdf", "page_no": 1}) for vid in vids]
+
+
+def _from_other_thread(fn):
+    out = []
+    thread = threading.Thread(target=lambda: out.append(fn()))
+    thread.start()
+    thread.join()
+    return out[0]
+
+
+def test_staged_writes_are_invisible_to_other_threads(tmp_path):
+    meta = MetadataStore(str(tmp_path / "meta.sqlite"))
+    meta.append(_rows([0, 1]))
+
+    meta.append(_rows([2, 3]), commit=False)
+    meta.delete([0], commit=False)
+    meta.set_state("next_vid", 4, commit=False)
+    # 写入线程读到自己暂存的修改（如删除后用剩余 vid 重建索引）
+    assert meta.all_vids() == [1, 2, 3]
+    assert meta.get_state("next_vid") == "4"
+    # 其他线程（检索）只看到已提交的数据
+    assert _from_other_thread(meta.all_vids) == [0, 1]
+    assert _from_other_thread(lambda: sorted(meta.get_rows([0, 2]))) == [0]
+    assert _from_other_thread(lambda: meta.vids_where({"source": "a.pdf"})) == [0, 1]
+    assert _from_other_thread(lambda: meta.get_state("next_vid")) is None
+
+    meta.rollback()
+    assert meta.all_vids() == [0, 1]
+    assert _from_other_thread(meta.all_vids) == [0, 1]
+
+    meta.append(_rows([2]), commit=False)
+    meta.commit()
+    assert _from_other_thread(meta.all_vids) == [0, 1, 2]
+    meta.close()
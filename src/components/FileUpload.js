@@ -11,11 +11,58 @@ import {
 import CloudUploadIcon from '@mui/icons-material/CloudUpload';
 import { API_ENDPOINTS } from '../config';
 
+// 索引任务轮询：间隔、最长等待时间、连续出错（网络错误 / 5xx）多少次后放弃
+const JOB_POLL_INTERVAL_MS = 1000;
+const JOB_MAX_WAIT_MS = 10 * 60 * 1000;
+const JOB_MAX_ERRORS = 5;
+
 const FileUpload = ({ onFileParsed }) => {
   const [file, setFile] = useState(null);
   const [loading, setLoading] = useState(false);
   const [status, setStatus] = useState({ type: '', message: '' });
 
+  // 轮询后台索引任务，直到完成或失败；任务不存在、持续出错或超时时抛出错误
+  const waitForJob = async (jobId) => {
+    const deadline = Date.now() + JOB_MAX_WAIT_MS;
+    let errors = 0;
+    while (Date.now() < deadline) {
+      await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+      let response;
+      let result;
+      try {
+        response = await fetch(`${API_ENDPOINTS.JOBS}/${jobId}`);
+        result = await response.json().catch(() => ({}));
+      } catch (error) {
+        // 网络抖动：重试几次再放弃
+        if (++errors >= JOB_MAX_ERRORS) {
+          throw new Error(`the indexing status could not be reached (${error.message})`);
+        }
+        continue;
+      }
+      if (response.status === 404) {
+        // 任务状态保存在处理上传的 worker 进程内：服务重启或请求落到其他 worker 时查不到
+        throw new Error('the server no longer knows this indexing job (it may have restarted, or another worker is handling it)');
+      }
+      if (response.status >= 500) {
+        if (++errors >= JOB_MAX_ERRORS) {
+          throw new Error(`checking the indexing status failed: ${result.detail || response.statusText}`);
+        }
+        continue;
+      }
+      if (!response.ok) {
+        throw new Error(`checking the indexing status failed: ${result.detail || response.statusText}`);
+      }
+      errors = 0;
+      const job = result.data;
+      if (job.status === 'done' || job.status === 'failed') {
+        return job;
+      }
+      const percent = job.total ? ` ${Math.round(job.progress * 100)}%` : '';
+      setStatus({ type: 'info', message: `Indexing document: ${job.status}${percent}...` });
+    }
+    throw new Error(`indexing did not finish within ${JOB_MAX_WAIT_MS / 60000} minutes`);
+  };
+
   const handleFileChange = (event) => {
     const uploadedFile = event.target.files[0];
     if (uploadedFile) {
@@ -45,9 +92,33 @@ const FileUpload = ({ onFileParsed }) => {
       const result = await response.json();
 
       if (response.ok) {
+        let chunks = result.data.chunks || 0;
+        if (result.data.jobId) {
+          let job;
+          try {
+            job = await waitForJob(result.data.jobId);
+          } catch (error) {
+            // 文件已上传成功，只是查询索引任务状态失败
+            console.error('Job status error details:', error);
+            setStatus({ 
+              type: 'warning', 
+              message: `Upload succeeded, but ${error.message}. The document may still be indexing; refresh the document list later to check.` 
+            });
+            setFile(null);
+            if (onFileParsed) {
+              onFileParsed(result.data);
+            }
+            return;
+          }
+          if (job.status === 'failed') {
+            setStatus({ type: 'error', message: `Indexing failed: ${job.message}` });
+            return;
+          }
+          chunks = job.chunks;
+        }
         setStatus({ 
           type: 'success', 
-          message: `Success! Indexed ${result.data.chunks || 0} knowledge chunks.` 
+          message: `Success! Indexed ${chunks || 0} knowledge chunks.` 
         });
         setFile(null);
         // 触发父组件刷新列表
@@ -22,6 +22,7 @@ export const API_ENDPOINTS = {
   PARSE: `${API_BASE_URL}/parse`,
   RETRIEVE: `${API_BASE_URL}/retrieve`,
   DOCUMENTS: `${API_BASE_URL}/documents`,
+  JOBS: `${API_BASE_URL}/jobs`,
   AGENT_CHAT: `${API_BASE_URL}/agent/chat`,
   AGENT_STATUS: `${API_BASE_URL}/agent/status`,
   HEALTH: `http://${currentHostname}:8000/health`